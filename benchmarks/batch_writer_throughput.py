@@ -0,0 +1,130 @@
+"""Rows per second for per-row commits against BatchWriter's batched commits.
+
+Both paths write random heartbeats into sun, battery and imu tables through
+an in-process fake connector: SQLite underneath, with --latency seconds
+added to every execute, executemany and commit to stand in for the round
+trip to the MySQL server (mysql.connector sends an executemany INSERT as
+one multi-row statement). per-row is the old upload_data, one INSERT and
+one commit per heartbeat on the calling thread. batched queues rows into a
+BatchWriter whose write_batch runs executemany per table and commits once,
+as Database.write_rows does. "caller" is the time the receive loop spends
+handing rows over, "total" includes the final flush.
+
+    python -m benchmarks.batch_writer_throughput --rows 5000 --latency 0.0005
+"""
+import argparse
+import random
+import sqlite3
+import time
+
+from lib.batch_writer import BatchWriter
+from lib.radio_utils import HEARTBEAT_LAYOUTS
+
+
+class FakeConnection:
+    """The part of a mysql.connector connection Database uses, over SQLite."""
+
+    def __init__(self, latency) -> None:
+        self.latency = latency
+        self.round_trips = 0
+        self._db = sqlite3.connect(":memory:", check_same_thread=False)
+        for layout in HEARTBEAT_LAYOUTS.values():
+            self._db.execute(f"CREATE TABLE {layout.name} (time INTEGER, {', '.join(layout.fields)})")
+
+    def _round_trip(self):
+        self.round_trips += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self._round_trip()
+        self._db.commit()
+
+    def count(self):
+        return sum(self._db.execute(f"SELECT COUNT(*) FROM {layout.name}").fetchone()[0]
+                   for layout in HEARTBEAT_LAYOUTS.values())
+
+
+class FakeCursor:
+    def __init__(self, connection) -> None:
+        self.connection = connection
+
+    def execute(self, sql, params=()):
+        self.connection._round_trip()
+        self.connection._db.execute(sql.replace("%s", "?"), params)
+
+    def executemany(self, sql, rows):
+        self.connection._round_trip()
+        self.connection._db.executemany(sql.replace("%s", "?"), rows)
+
+
+def insert_sql(layout):
+    columns = ("time",) + layout.fields
+    return f"INSERT INTO {layout.name} ({', '.join(columns)}) VALUES ({', '.join(['%s'] * len(columns))})"
+
+
+def random_rows(count, seed=None):
+    rng = random.Random(seed)
+    layouts = list(HEARTBEAT_LAYOUTS.values())
+    rows = []
+    for i in range(count):
+        layout = rng.choice(layouts)
+        rows.append((layout.name, (i,) + tuple(rng.random() for _ in layout.fields)))
+    return rows
+
+
+def per_row(connection, rows):
+    statements = {layout.name: insert_sql(layout) for layout in HEARTBEAT_LAYOUTS.values()}
+    cursor = connection.cursor()
+    start = time.perf_counter()
+    for table, row in rows:
+        cursor.execute(statements[table], row)
+        connection.commit()
+    elapsed = time.perf_counter() - start
+    return elapsed, elapsed
+
+
+def batched(connection, rows, batch_size, flush_interval):
+    statements = {layout.name: insert_sql(layout) for layout in HEARTBEAT_LAYOUTS.values()}
+    cursor = connection.cursor()
+
+    def write_batch(batch):
+        for table, table_rows in batch.items():
+            cursor.executemany(statements[table], table_rows)
+        connection.commit()
+
+    writer = BatchWriter(write_batch, batch_size, flush_interval)
+    start = time.perf_counter()
+    for table, row in rows:
+        writer.add(table, row)
+    caller = time.perf_counter() - start
+    writer.close()
+    return caller, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=5000)
+    parser.add_argument("--latency", type=float, default=0.0005, help="seconds per database round trip")
+    parser.add_argument("--batch-size", type=int, default=50)
+    parser.add_argument("--flush-interval", type=float, default=1.0)
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    rows = random_rows(args.rows, args.seed)
+    for name in ("per-row", "batched"):
+        connection = FakeConnection(args.latency)
+        if name == "per-row":
+            caller, total = per_row(connection, rows)
+        else:
+            caller, total = batched(connection, rows, args.batch_size, args.flush_interval)
+        assert connection.count() == len(rows)
+        print(f"{name:8} {len(rows) / total:9.0f} rows/s, caller {caller / len(rows) * 1e6:7.1f} us/row, "
+              f"{connection.round_trips} round trips")
+
+
+if __name__ == "__main__":
+    main()
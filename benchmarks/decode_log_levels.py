@@ -0,0 +1,77 @@
+"""Cost of decode logging per packet at each log level.
+
+Runs unpack_message over --packets random heartbeats with the root logger
+set up as main.py does it, at DEBUG, INFO and WARNING, writing to
+os.devnull so the terminal is not measured. "print" is the old decoder,
+which printed the header and every value whatever the level, with stdout
+pointed at os.devnull the same way. Reports microseconds per packet and
+the extra cost over WARNING.
+
+    python -m benchmarks.decode_log_levels --packets 20000
+"""
+import argparse
+import contextlib
+import logging
+import os
+import random
+import time
+
+os.environ.setdefault("GPIOZERO_PIN_FACTORY", "mock")
+
+from benchmarks.rx_throughput import heartbeats, per_byte_unpack  # noqa: E402
+from lib.radio_utils import HEARTBEAT_LAYOUTS, unpack_message  # noqa: E402
+
+
+def printing_unpack(msg):
+    """per_byte_unpack with the prints the old decoder made."""
+    header_info = (f"Header To: {msg.header_to}," +
+                   f"Header From: {msg.header_from}," +
+                   f"Header ID: {msg.header_id}," +
+                   f"Header Flags: {msg.header_flags}," +
+                   f"RSSI: {msg.rssi}," +
+                   f"SNR: {msg.snr}\n")
+    print(f"header info: {header_info.encode('utf-8')}")
+    print(f"system status: {msg.message[5]}, {msg.message[6]}")
+    msg_id, sat_time, values = per_byte_unpack(msg)
+    print(f"{HEARTBEAT_LAYOUTS[msg_id].name} heartbeat")
+    for value in values:
+        print(value)
+    print(f"time: {sat_time}")
+    return msg_id, sat_time, values
+
+
+def per_packet(decode, payloads):
+    start = time.perf_counter()
+    for payload in payloads:
+        decode(payload)
+    return (time.perf_counter() - start) / len(payloads) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--packets", type=int, default=20000)
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    payloads = [payload for msg_id in HEARTBEAT_LAYOUTS for payload in heartbeats(msg_id, args.packets, args.seed)]
+    rng.shuffle(payloads)
+    payloads = payloads[:args.packets]
+
+    with open(os.devnull, "w") as devnull:
+        logging.basicConfig(stream=devnull, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+        root = logging.getLogger()
+        costs = {}
+        for level in ("WARNING", "INFO", "DEBUG"):
+            root.setLevel(level)
+            costs[level] = per_packet(unpack_message, payloads)
+        root.setLevel("WARNING")
+        with contextlib.redirect_stdout(devnull):
+            costs["print"] = per_packet(printing_unpack, payloads)
+
+    for name, cost in costs.items():
+        print(f"{name:7}: {cost:7.2f} us per packet, {cost - costs['WARNING']:+7.2f} us over WARNING")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""Duplicate heartbeats dropped by DedupIndex and by the database key.
+
+Builds a synthetic stream in which --duplicates of the packets repeat a
+heartbeat from the last --window, the way retransmits and a second station
+overlapping the pass would. Every packet goes through
+DedupIndex.add_message as in main.py. Reports messages per second, how
+many duplicates were dropped and whether any new heartbeat was dropped.
+
+The whole stream is then inserted into an SQLite table with the same
+UNIQUE (time, sequence_count) key as db_setup.sql, with a duplicate
+insert being a no-op like ON DUPLICATE KEY UPDATE. That checks the key
+alone stores exactly one row per heartbeat, including the duplicates that
+aged out of the index.
+
+    python -m benchmarks.dedup_stream --messages 100000 --duplicates 0.3
+"""
+import argparse
+import random
+import sqlite3
+import time
+
+from lib.argus_lora import Payload
+from lib.dedup import DedupIndex
+from lib.radio_utils import HEARTBEAT_LAYOUTS, unpack_header, unpack_message
+from lib.sim_radio import pack_heartbeat
+
+
+def heartbeat_stream(count, duplicates, window, seed=None):
+    """
+    :return: (payloads, number of repeats), heartbeats three per satellite second
+    """
+    rng = random.Random(seed)
+    msg_ids = list(HEARTBEAT_LAYOUTS)
+    start = int(time.time())
+    sent = []
+    payloads = []
+    repeats = 0
+    while len(payloads) < count:
+        if sent and rng.random() < duplicates:
+            message = rng.choice(sent[-window:])
+            repeats += 1
+        else:
+            i = len(sent)
+            msg_id = rng.choice(msg_ids)
+            values = tuple(rng.randrange(100) for _ in HEARTBEAT_LAYOUTS[msg_id].fields)
+            message = pack_heartbeat(msg_id, i & 0xffff, start + i // 3, values)
+            sent.append(message)
+        payloads.append(Payload(message, 25, 1, len(payloads) & 0xff, 0, -90.0, 7.5, time.time()))
+    return payloads, repeats
+
+
+def store(payloads):
+    """Insert every payload under the (time, sequence_count) key, returns the rows kept."""
+    db = sqlite3.connect(":memory:")
+    db.execute("CREATE TABLE heartbeats (msg_id INTEGER, time INTEGER, sequence_count INTEGER, "
+               "UNIQUE (msg_id, time, sequence_count))")
+    rows = []
+    for payload in payloads:
+        msg_id, sat_time, _ = unpack_message(payload)
+        rows.append((msg_id, sat_time, unpack_header(payload)[2]))
+    # msg_id stands in for the table each heartbeat type has of its own
+    db.executemany("INSERT INTO heartbeats VALUES (?, ?, ?) ON CONFLICT DO NOTHING", rows)
+    return db.execute("SELECT COUNT(*) FROM heartbeats").fetchone()[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=100000)
+    parser.add_argument("--duplicates", type=float, default=0.3, help="fraction of packets that repeat one")
+    parser.add_argument("--window", type=int, default=256, help="repeats pick from this many recent heartbeats")
+    parser.add_argument("--maxlen", type=int, default=4096, help="DedupIndex size")
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    payloads, repeats = heartbeat_stream(args.messages, args.duplicates, args.window, args.seed)
+    unique = len(payloads) - repeats
+
+    dedup = DedupIndex(maxlen=args.maxlen)
+    start = time.perf_counter()
+    kept = [payload for payload in payloads if dedup.add_message(payload)]
+    elapsed = time.perf_counter() - start
+    print(f"index: {len(payloads) / elapsed:,.0f} messages/s, dropped {dedup.duplicate_count} of {repeats} "
+          f"duplicates, kept {len(kept)} of {unique} heartbeats")
+    if len(kept) < unique:
+        print(f"  {unique - len(kept)} new heartbeats were dropped")
+
+    stored = store(payloads)
+    print(f"database key: {stored} rows stored for {unique} heartbeats from {len(payloads)} packets")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""Packets and passes needed to downlink an image with FileReceiver.
+
+Runs the SAT_IMG_INFO / SAT_IMG_CHUNK / GS_IMG_NACK exchange between two
+LoRa radios on linked SX127xSim chips that drop --loss of the packets in
+either direction. With --pass-budget the satellite stops after that many
+packets and the next pass resumes from the bitmap left on disk.
+
+    python -m benchmarks.file_downlink --size 30000 --chunk-size 200 --loss 0.1
+"""
+import argparse
+import os
+import queue
+import random
+import tempfile
+import threading
+import time
+import zlib
+
+from lib.argus_lora import LoRa
+from lib.file_transfer import FileReceiver, pack_chunk, pack_info, unpack_nack
+from lib.sx127x_sim import SX127xSim, link
+
+
+def _send_image(radio, nacks, data, image_id, chunk_size, budget, nack_wait, ground_station):
+    """Satellite side of simulate_downlink, returns the chunks sent or None once budget runs out."""
+    info = pack_info(image_id, len(data), chunk_size, zlib.crc32(data))
+    sent = 0
+    while sent < budget:
+        radio.send(info, ground_station)
+        radio.wait_packet_sent()
+        radio.set_mode_rx()
+        sent += 1
+        try:
+            message = nacks.get(timeout=nack_wait)
+        except queue.Empty:
+            continue
+        while True:
+            _, wanted = unpack_nack(message)
+            if not wanted:
+                return sent
+            for index in wanted:
+                if sent >= budget:
+                    return None
+                radio.send(pack_chunk(image_id, index, data[index * chunk_size:(index + 1) * chunk_size]),
+                           ground_station)
+                sent += 1
+            radio.wait_packet_sent()
+            radio.set_mode_rx()
+            try:
+                message = nacks.get(timeout=nack_wait)
+            except queue.Empty:
+                # NACK lost, announcing the image again asks for a fresh one
+                break
+    return None
+
+
+def simulate_downlink(directory, size=50000, chunk_size=200, loss=0.1, pass_budget=None, passes=3,
+                      nack_timeout=0.2, seed=None):
+    """
+    :param directory: where the FileReceiver keeps the image
+    :param size: image size in bytes, random content
+    :param chunk_size: bytes per SAT_IMG_CHUNK
+    :param loss: probability each packet is lost, in either direction
+    :param pass_budget: packets the satellite can send per pass, unlimited if None
+    :param passes: passes to try before giving up
+    :return: dict of passes used, packets the satellite sent, NACKs sent and
+             whether the received image matched
+
+    Downlinks an image between two LoRa radios on linked SX127xSim chips,
+    the satellite answering NACKs the way FileReceiver expects. Each pass
+    starts a fresh FileReceiver on the same directory, so passes after the
+    first resume from the bitmap left on disk.
+    """
+    rng = random.Random(seed)
+    data = bytes(rng.getrandbits(8) for _ in range(size))
+    image_id = rng.randrange(1 << 16)
+    satellite_chip = SX127xSim(seed=seed)
+    ground_chip = SX127xSim(seed=None if seed is None else seed + 1)
+    link(satellite_chip, ground_chip, loss)
+    satellite = LoRa(0, None, 1, freq=433, spi=satellite_chip, irq=satellite_chip.dio0)
+    ground = LoRa(0, None, 25, freq=433, spi=ground_chip, irq=ground_chip.dio0)
+    nacks = queue.Queue()
+    satellite.on_recv = lambda payload: nacks.put(payload.message)
+    received = queue.Queue()
+    ground.on_recv = received.put
+
+    stats = {"passes": 0, "sent": 0, "nacks": 0, "complete": False}
+    for _ in range(passes):
+        stats["passes"] += 1
+        receiver = FileReceiver(directory, ground, nack_timeout=nack_timeout)
+        satellite.set_mode_rx()
+        ground.set_mode_rx()
+        result = {}
+        sender = threading.Thread(target=lambda: result.update(sent=_send_image(
+            satellite, nacks, data, image_id, chunk_size, pass_budget or float("inf"), nack_timeout * 5, 25)))
+        sender.start()
+        while sender.is_alive() or not received.empty():
+            try:
+                receiver.handle(received.get(timeout=0.01))
+            except queue.Empty:
+                receiver.poll()
+        receiver.close()
+        if result["sent"] is not None:
+            break
+        # out of view, whatever is still queued is lost
+        while not nacks.empty():
+            nacks.get()
+    stats["sent"] = satellite_chip.transmitted_count
+    stats["nacks"] = ground_chip.transmitted_count
+    path = os.path.join(directory, f"image_{image_id}.bin")
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            stats["complete"] = f.read() == data
+    satellite.close()
+    ground.close()
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=int, default=30000, help="image bytes")
+    parser.add_argument("--chunk-size", type=int, default=200)
+    parser.add_argument("--loss", type=float, default=0.1, help="probability each packet is lost")
+    parser.add_argument("--pass-budget", type=int, help="packets the satellite sends per pass")
+    parser.add_argument("--passes", type=int, default=3)
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        start = time.perf_counter()
+        stats = simulate_downlink(directory, args.size, args.chunk_size, args.loss, args.pass_budget, args.passes,
+                                  seed=args.seed)
+        elapsed = time.perf_counter() - start
+    chunks = -(-args.size // args.chunk_size)
+    print(f"{'complete' if stats['complete'] else 'incomplete'} after {stats['passes']} passes, {elapsed:.1f} s: "
+          f"{stats['sent']} packets sent for {chunks} chunks, {stats['nacks']} NACKs")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""Bytes received over a synthetic pass with and without LinkAdapter.
+
+Flies a LoRa on an SX127xSim chip through a pass whose SNR follows
+pass_snr_profile, with a simulated satellite sending heartbeats back to
+back. The satellite changes preset only on a GS_MODEM_CONFIG command that
+reached it. Runs the adaptive receiver and each fixed preset on the same
+pass, time only advances on a simulated clock.
+
+    python -m benchmarks.link_adaptation_pass --peak-snr 10 --start Bw125Cr45Sf128
+"""
+import argparse
+import math
+import random
+
+from lib.argus_lora import LoRa, ModemConfig
+from lib.link_adaptation import LinkAdapter, airtime, bandwidth, pack_modem_config, required_snr
+from lib.sim_radio import SimulatedClock, random_heartbeat
+from lib.sx127x_sim import SX127xSim, pass_snr_profile, radiohead_packet
+
+
+class _SimulatedSatellite:
+    """Satellite end of the GS_MODEM_CONFIG handshake in simulate_pass.
+
+    Only moves to a preset when the command reaches it on the preset it is
+    on, and goes back to the starting preset after silence_timeout seconds
+    without hearing the ground.
+    """
+
+    def __init__(self, radio, clock, profile, silence_timeout, rng) -> None:
+        self.radio = radio
+        self.clock = clock
+        self.profile = profile
+        self.silence_timeout = silence_timeout
+        self.rng = rng
+        self.initial = self.modem_config = radio.modem_config
+        self.last_heard = clock.now
+
+    def _delivered(self, preset):
+        # same odds as SX127xSim.inject_at_snr without a CRC error
+        snr = self.profile(self.clock.now) + 10 * math.log10(125000 / bandwidth(preset))
+        headroom = snr - required_snr(preset)
+        return self.rng.random() < min(max((headroom + 1) / 2, 0), 1)
+
+    def request_preset(self, preset):
+        """Stands in for LinkAdapter.request_preset, one command and its ACK without retries."""
+        current = self.radio.modem_config
+        self.clock.sleep(airtime(current, 4 + len(pack_modem_config(preset))))
+        if current != self.modem_config or not self._delivered(current):
+            return False
+        self.last_heard = self.clock.now
+        # the ACK goes out on the old preset, then the satellite switches
+        self.modem_config = preset
+        self.clock.sleep(airtime(current, 5))
+        return self._delivered(current)
+
+    def check(self):
+        if self.modem_config != self.initial and self.clock.now - self.last_heard >= self.silence_timeout:
+            self.modem_config = self.initial
+
+
+def simulate_pass(duration=600.0, profile=None, modem_config=ModemConfig.Bw125Cr48Sf4096, adaptive=True,
+                  seed=None, **adapter_args):
+    """
+    :param duration: pass length in simulated seconds
+    :param profile: SNR in dB (125 kHz) against seconds into the pass, pass_snr_profile by default
+    :param modem_config: preset both ends start on, and stay on unless adaptive
+    :param adaptive: steer the preset with a LinkAdapter, adapter_args are passed to it
+    :return: dict of packets sent, received, lost and with CRC errors,
+             payload bytes received, preset switches and refused commands
+
+    Flies a LoRa on an SX127xSim chip through a synthetic pass. The
+    satellite sends heartbeats back to back, each taking its airtime, so
+    faster presets deliver more data while the link holds. It only changes
+    preset on a GS_MODEM_CONFIG command that reached it, and the packets it
+    sends on a preset the receiver is not tuned to are lost. Runs as fast
+    as the simulated chip and the real interrupt path allow, time only
+    advances on a simulated clock.
+    """
+    rng = random.Random(seed)
+    chip = SX127xSim(seed=seed)
+    radio = LoRa(0, None, 25, freq=433, modem_config=modem_config, spi=chip, irq=chip.dio0)
+    received = []
+    radio.on_recv = received.append
+    radio.set_mode_rx()
+
+    clock = SimulatedClock()
+    profile = profile or pass_snr_profile(duration)
+    adapter = LinkAdapter(radio, clock=clock.time, **adapter_args) if adaptive else None
+    satellite = None
+    if adapter is not None:
+        satellite = _SimulatedSatellite(radio, clock, profile, adapter.silence_timeout, rng)
+        adapter.request_preset = satellite.request_preset
+
+    stats = {"sent": 0, "received": 0, "lost": 0, "crc_errors": 0, "bytes": 0, "switches": 0, "refused": 0}
+    sequence_count = 0
+    while clock.now < duration:
+        message = random_heartbeat(sequence_count & 0xffff, rng)
+        packet = radiohead_packet(message)
+        sent_on = satellite.modem_config if satellite is not None else radio.modem_config
+        clock.sleep(airtime(sent_on, len(packet)))
+        sequence_count += 1
+        stats["sent"] += 1
+        crc_errors = radio.crc_error_count
+        if sent_on != radio.modem_config or not chip.inject_at_snr(packet, profile(clock.now)):
+            stats["lost"] += 1
+        chip.wait_interrupts()
+        stats["crc_errors"] += radio.crc_error_count - crc_errors
+        while received:
+            payload = received.pop(0)
+            payload.received_at = clock.now
+            stats["received"] += 1
+            stats["bytes"] += len(payload.message)
+            if adapter is not None:
+                adapter.observe(payload)
+        if adapter is not None:
+            adapter.check()
+            satellite.check()
+    if adapter is not None:
+        stats["switches"] = adapter.switch_count
+        stats["refused"] = adapter.refused_count
+    radio.close()
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--duration", type=float, default=600.0, help="pass length in simulated seconds")
+    parser.add_argument("--peak-snr", type=float, default=10.0, help="SNR in dB at 125 kHz mid pass")
+    parser.add_argument("--start", choices=[preset.name for preset in ModemConfig], default="Bw125Cr45Sf128",
+                        help="preset both ends start the adaptive run on")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    profile = pass_snr_profile(args.duration, peak_snr=args.peak_snr)
+    runs = [("adaptive", ModemConfig[args.start], True)] + [(preset.name, preset, False) for preset in ModemConfig]
+    for name, preset, adaptive in runs:
+        stats = simulate_pass(args.duration, profile, preset, adaptive, args.seed)
+        print(f"{name:16} {stats['bytes']:8} bytes, {stats['received']:6} of {stats['sent']:6} packets, "
+              f"loss {stats['lost'] / max(stats['sent'], 1):6.1%}, {stats['switches']} switches, "
+              f"{stats['refused']} refused")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""Cost per call of the lib.metrics instruments against a no-op.
+
+Times --calls calls each of Counter.inc, Histogram.observe and a
+Histogram.time() block, next to a no-op method call with the same
+signature, from --threads threads at once. The instruments are made on a
+Registry of their own, so the process-wide REGISTRY is left alone. The
+difference to the no-op is what instrumenting one packet costs; compare
+it with the microseconds per packet of benchmarks.rx_throughput.
+
+    python -m benchmarks.metrics_overhead --calls 1000000 --threads 1
+"""
+import argparse
+import threading
+import time
+
+from lib.metrics import Registry
+
+
+class NoOp:
+    def inc(self, amount=1):
+        pass
+
+    def observe(self, value):
+        pass
+
+
+def per_call(function, calls, threads):
+    """Nanoseconds of wall time per call, the calls split over threads."""
+    each = calls // threads
+    start_line = threading.Barrier(threads + 1)
+
+    def run():
+        start_line.wait()
+        for _ in range(each):
+            function()
+
+    workers = [threading.Thread(target=run) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    start_line.wait()
+    start = time.perf_counter()
+    for worker in workers:
+        worker.join()
+    return (time.perf_counter() - start) / (each * threads) * 1e9
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--calls", type=int, default=1000000)
+    parser.add_argument("--threads", type=int, default=1)
+    args = parser.parse_args()
+
+    registry = Registry()
+    counter = registry.counter("benchmark_total")
+    histogram = registry.histogram("benchmark_seconds")
+    noop = NoOp()
+
+    def timed():
+        with histogram.time():
+            pass
+
+    # name, call, the no-op it is compared with
+    cases = (
+        ("no-op inc", lambda: noop.inc(), None),
+        ("Counter.inc", lambda: counter.inc(), "no-op inc"),
+        ("no-op observe", lambda: noop.observe(0.003), None),
+        ("Histogram.observe", lambda: histogram.observe(0.003), "no-op observe"),
+        ("Histogram.time", timed, "no-op observe"),
+    )
+    costs = {}
+    for name, function, baseline in cases:
+        costs[name] = cost = per_call(function, args.calls, args.threads)
+        extra = f", {cost - costs[baseline]:+6.1f} ns over the no-op" if baseline else ""
+        print(f"{name:17}: {cost:6.1f} ns per call{extra}")
+    assert counter.value == args.calls // args.threads * args.threads
+
+
+if __name__ == "__main__":
+    main()
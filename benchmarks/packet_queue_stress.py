@@ -0,0 +1,90 @@
+"""Interrupt-burst stress test for the PacketQueue between LoRa and RadioHead.
+
+Fires packets into an SX127xSim chip at a fixed rate, in bursts of back to
+back packets, so every packet goes through a DIO0 interrupt, the LoRa
+handler and RadioHead.on_recv. The main thread drains the queue with
+receive_message, taking --work seconds per packet to stand in for decoding
+and spooling. Reports where packets were lost:
+- the radio did not get to the FIFO before the next packet (radio),
+- PacketQueue overflowed (queue).
+
+    python -m benchmarks.packet_queue_stress --rate 500 --burst 32 --queue-size 64 --work 0.004
+"""
+import argparse
+import os
+import threading
+import time
+
+# RadioHead drives two LEDs, use gpiozero's mock pins off the Pi
+os.environ.setdefault("GPIOZERO_PIN_FACTORY", "mock")
+
+from lib.argus_lora import LoRa  # noqa: E402
+from lib.packet_queue import DROP_NEWEST, DROP_OLDEST  # noqa: E402
+from lib.radiohead import RadioHead  # noqa: E402
+from lib.sim_radio import random_heartbeat  # noqa: E402
+from lib.sx127x_sim import SX127xSim, radiohead_packet  # noqa: E402
+
+
+def run(rate, burst, bursts, queue_size, policy, work):
+    """
+    :return: dict of packets injected, read out by the radio, dropped by the
+             queue and handed to the main loop, and seconds taken
+    """
+    chip = SX127xSim()
+    radio = LoRa(0, None, 25, freq=433, spi=chip, irq=chip.dio0)
+    radiohead = RadioHead(radio, receive_timeout=0.5, queue_size=queue_size, overflow_policy=policy)
+    radio.set_mode_rx()
+
+    packets = [radiohead_packet(random_heartbeat(i & 0xffff), header_to=25) for i in range(burst)]
+    done = threading.Event()
+
+    def fire():
+        for _ in range(bursts):
+            next_time = time.perf_counter()
+            for packet in packets:
+                next_time += 1 / rate
+                delay = next_time - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                chip.inject(packet)
+            # leave the main loop a gap between bursts, like between heartbeat rounds
+            time.sleep(burst / rate)
+        chip.wait_interrupts()
+        done.set()
+
+    start = time.perf_counter()
+    thread = threading.Thread(target=fire, name="fire", daemon=True)
+    thread.start()
+    consumed = 0
+    while not (done.is_set() and not len(radiohead.packets)):
+        if radiohead.receive_message(0.1) is not None:
+            consumed += 1
+            if work:
+                time.sleep(work)
+    elapsed = time.perf_counter() - start
+    thread.join()
+    radio.close()
+    return {"injected": chip.received_count, "read": radio.received_count,
+            "queue_dropped": radiohead.packets.overflow_count, "consumed": consumed, "seconds": elapsed}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rate", type=float, default=500.0, help="packets per second within a burst")
+    parser.add_argument("--burst", type=int, default=32, help="packets per burst")
+    parser.add_argument("--bursts", type=int, default=10)
+    parser.add_argument("--queue-size", type=int, default=64)
+    parser.add_argument("--policy", choices=(DROP_OLDEST, DROP_NEWEST), default=DROP_OLDEST)
+    parser.add_argument("--work", type=float, default=0.0, help="seconds the main loop spends per packet")
+    args = parser.parse_args()
+
+    stats = run(args.rate, args.burst, args.bursts, args.queue_size, args.policy, args.work)
+    injected = stats["injected"]
+    radio_lost = injected - stats["read"]
+    print(f"{injected} packets injected in {stats['seconds']:.2f} s: "
+          f"{radio_lost} lost at the radio, {stats['queue_dropped']} dropped by the queue ({args.policy}), "
+          f"{stats['consumed']} received, loss {(injected - stats['consumed']) / injected:.1%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""Packets per second through RFM9x.receive_all for a full FIFO.
+
+Fills an SX127xSim FIFO with --batch back-to-back heartbeats addressed
+between valid_ids, then times receive_all three ways:
+- "marked" calls mark_packet on every packet, so each is sliced exactly,
+- "scan" finds the packet starts with packet_starts,
+- "naive" swaps packet_starts for the byte by byte membership scan it
+  replaced.
+Also reports SPI transactions per batch, and the time packet_starts and
+the naive scan take over a full FIFO of heartbeats and over the worst
+case, a FIFO of nothing but valid ids.
+
+    python -m benchmarks.receive_all_throughput --batches 2000 --batch 6
+"""
+import argparse
+import random
+import time
+
+from lib import rfm9x
+from lib.rfm9x import RFM9x, packet_starts
+from lib.sim_radio import random_heartbeat
+from lib.sx127x_sim import SimResetPin, SimSPIDevice, SX127xSim, radiohead_packet
+
+
+def naive_starts(buf, end, ids):
+    starts = []
+    i = 0
+    while i + 1 < end:
+        if buf[i] in ids and buf[i + 1] in ids and buf[i] != buf[i + 1]:
+            starts.append(i)
+            i += 4
+        else:
+            i += 1
+    return starts
+
+
+def run(mode, frames, batches):
+    """
+    :return: (packets per second, SPI transactions per batch)
+    """
+    chip = SX127xSim()
+    radio = RFM9x(None, None, SimResetPin(chip), 433, device=SimSPIDevice(chip))
+    radio.listen()
+    scan = rfm9x.packet_starts
+    if mode == "naive":
+        rfm9x.packet_starts = naive_starts
+    try:
+        elapsed = 0.0
+        transactions = 0
+        received = 0
+        for _ in range(batches):
+            for frame in frames:
+                chip.inject(frame)
+                if mode == "marked":
+                    radio.mark_packet()
+            before = chip.transaction_count
+            start = time.perf_counter()
+            received += sum(1 for _ in radio.receive_all())
+            elapsed += time.perf_counter() - start
+            transactions += chip.transaction_count - before
+    finally:
+        rfm9x.packet_starts = scan
+    assert received == len(frames) * batches
+    return received / elapsed, transactions / batches
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--batches", type=int, default=2000)
+    parser.add_argument("--batch", type=int, default=6, help="packets in the FIFO per receive_all")
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    frames = [radiohead_packet(random_heartbeat(i, rng), header_to=58, header_from=59) for i in range(args.batch)]
+    if sum(map(len, frames)) > 256:
+        parser.error(f"{args.batch} heartbeats do not fit the 256 byte FIFO")
+    for mode in ("marked", "scan", "naive"):
+        rate, transactions = run(mode, frames, args.batches)
+        print(f"{mode:6}: {rate:10,.0f} packets/s, {transactions:.0f} SPI transactions per batch")
+
+    fifo = bytearray(b"".join(frames).ljust(256, b"\0"))
+    dense = bytearray(rng.choice(RFM9x.valid_ids) for _ in range(256))
+    for fill, buf in (("heartbeats", fifo), ("only ids", dense)):
+        for name, function in (("packet_starts", packet_starts), ("naive scan", naive_starts)):
+            start = time.perf_counter()
+            for _ in range(10000):
+                function(buf, 256, RFM9x.valid_ids)
+            print(f"{name:13} over 256 bytes of {fill:10}: {(time.perf_counter() - start) / 10000 * 1e6:5.1f} us")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""CPU time per idle second and wake-up latency of RadioHead.receive_message.
+
+Runs the real LoRa interrupt path on an SX127xSim chip. First the main
+thread waits in receive_message with nothing on the air, then a second
+thread injects packets at random moments and the time from each injection
+to receive_message returning it is recorded.
+
+    python -m benchmarks.receive_idle --idle 5 --packets 200
+"""
+import argparse
+import os
+import random
+import statistics
+import threading
+import time
+
+# RadioHead drives two LEDs, use gpiozero's mock pins off the Pi
+os.environ.setdefault("GPIOZERO_PIN_FACTORY", "mock")
+
+from lib.argus_lora import LoRa  # noqa: E402
+from lib.radiohead import RadioHead  # noqa: E402
+from lib.sim_radio import random_heartbeat  # noqa: E402
+from lib.sx127x_sim import SX127xSim, radiohead_packet  # noqa: E402
+
+
+def measure_idle(radiohead, seconds):
+    """CPU seconds the process used per second spent waiting for nothing."""
+    cpu = time.process_time()
+    wall = time.perf_counter()
+    payload = radiohead.receive_message(seconds)
+    assert payload is None, "nothing was sent"
+    return (time.process_time() - cpu) / (time.perf_counter() - wall)
+
+
+def measure_wakeups(radiohead, chip, count, seed=None):
+    """Seconds from injecting each packet to receive_message returning it."""
+    rng = random.Random(seed)
+    injected = []
+
+    def inject():
+        for sequence_count in range(count):
+            time.sleep(rng.uniform(0.005, 0.02))
+            packet = radiohead_packet(random_heartbeat(sequence_count, rng), header_to=25)
+            injected.append(time.perf_counter())
+            chip.inject(packet)
+
+    thread = threading.Thread(target=inject, name="inject", daemon=True)
+    thread.start()
+    latencies = []
+    for _ in range(count):
+        if radiohead.receive_message(1.0) is None:
+            break
+        latencies.append(time.perf_counter() - injected[len(latencies)])
+    thread.join()
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--idle", type=float, default=5.0, help="seconds to wait with nothing on the air")
+    parser.add_argument("--packets", type=int, default=200, help="packets to time the wake-up of")
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    chip = SX127xSim(seed=args.seed)
+    radio = LoRa(0, None, 25, freq=433, spi=chip, irq=chip.dio0)
+    radiohead = RadioHead(radio, receive_timeout=args.idle)
+
+    cpu = measure_idle(radiohead, args.idle)
+    print(f"idle: {cpu * 1000:.2f} ms CPU per second waiting")
+
+    latencies = sorted(measure_wakeups(radiohead, chip, args.packets, args.seed))
+    if len(latencies) < args.packets:
+        print(f"only {len(latencies)} of {args.packets} packets were received")
+    if latencies:
+        print(f"wake-up: median {statistics.median(latencies) * 1e6:.0f} us, "
+              f"p99 {latencies[int(len(latencies) * 0.99) - 1] * 1e6:.0f} us, "
+              f"max {latencies[-1] * 1e6:.0f} us over {len(latencies)} packets")
+    radio.close()
+
+
+if __name__ == "__main__":
+    main()
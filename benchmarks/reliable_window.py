@@ -0,0 +1,97 @@
+"""Goodput of ReliableSender's sliding window against stop-and-wait.
+
+Sends --count messages between two LoRa radios on linked SX127xSim
+chips through ReliableSender and ReliableReceiver in real time, each chip
+taking the Bw125 airtime of its packets, for every --windows size.
+
+    python -m benchmarks.reliable_window --windows 1 8 32 --loss 0.1
+"""
+import argparse
+import queue
+import random
+import threading
+import time
+
+from lib.argus_lora import LoRa, ModemConfig
+from lib.link_adaptation import airtime
+from lib.reliable import ReliableReceiver, ReliableSender
+from lib.sx127x_sim import SX127xSim, link
+
+
+def simulate_reliable(window=8, count=50, size=200, loss=0.1, modem_config=ModemConfig.Bw125Cr45Sf128, seed=None,
+                      **sender_args):
+    """
+    :param window: ReliableSender window, 1 is stop-and-wait with an adaptive timeout
+    :param count: messages to send
+    :param size: bytes per message
+    :param loss: probability each packet is lost, in either direction
+    :param modem_config: preset both radios use, sets the simulated airtime of data and ack packets
+    :return: dict of goodput in bytes per second, seconds taken, packets
+             sent and retransmitted, and whether everything arrived in order
+
+    Sends count messages between two LoRa radios on linked SX127xSim chips
+    through a ReliableSender and ReliableReceiver, in real time. Each chip
+    takes the airtime of its packets to transmit: full messages from the
+    sender, acks from the receiver.
+    """
+    rng = random.Random(seed)
+    messages = [bytes(rng.getrandbits(8) for _ in range(size)) for _ in range(count)]
+    sender_chip = SX127xSim(seed=seed)
+    receiver_chip = SX127xSim(seed=None if seed is None else seed + 1)
+    link(sender_chip, receiver_chip, loss)
+    sender_chip.tx_time = airtime(modem_config, 4 + size)
+    receiver_chip.tx_time = airtime(modem_config, 4 + (window + 6) // 8)
+    sender_radio = LoRa(0, None, 25, freq=433, modem_config=modem_config, spi=sender_chip, irq=sender_chip.dio0)
+    receiver_radio = LoRa(0, None, 1, freq=433, modem_config=modem_config, spi=receiver_chip,
+                          irq=receiver_chip.dio0)
+    for radio, chip in ((sender_radio, sender_chip), (receiver_radio, receiver_chip)):
+        radio.wait_packet_sent_timeout = chip.tx_time + 0.5
+    sender = ReliableSender(sender_radio, 1, window=window, **sender_args)
+    receiver = ReliableReceiver(receiver_radio, 25, window=window)
+    delivered = []
+    receiver.on_message = lambda payload: delivered.append(payload.message)
+
+    # acks go out from a thread of their own, not the interrupt thread
+    packets = queue.Queue()
+    receiver_radio.on_recv = packets.put
+    stop = threading.Event()
+
+    def receive():
+        while not stop.is_set():
+            try:
+                receiver.handle(packets.get(timeout=0.01))
+            except queue.Empty:
+                pass
+    thread = threading.Thread(target=receive, name="reliable-receiver", daemon=True)
+    thread.start()
+    sender_radio.set_mode_rx()
+    receiver_radio.set_mode_rx()
+
+    start = time.monotonic()
+    done = sender.send(messages, timeout=count * 10 * sender_chip.tx_time)
+    elapsed = time.monotonic() - start
+    stop.set()
+    thread.join()
+    sender_radio.close()
+    receiver_radio.close()
+    return {"goodput": len(delivered) * size / elapsed, "seconds": elapsed, "sent": sender.sent_count,
+            "retransmits": sender.retransmit_count, "complete": done and delivered == messages}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--windows", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--count", type=int, default=50, help="messages to send")
+    parser.add_argument("--size", type=int, default=200, help="bytes per message")
+    parser.add_argument("--loss", type=float, default=0.1, help="probability each packet is lost")
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    for window in args.windows:
+        stats = simulate_reliable(window, args.count, args.size, args.loss, seed=args.seed)
+        print(f"window {window:3}: {stats['goodput']:6.0f} B/s, {stats['seconds']:6.1f} s, {stats['sent']} sent, "
+              f"{stats['retransmits']} retransmits, {'complete' if stats['complete'] else 'INCOMPLETE'}")
+
+
+if __name__ == "__main__":
+    main()
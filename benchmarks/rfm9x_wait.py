@@ -0,0 +1,98 @@
+"""SPI transactions and CPU spent by RFM9x waiting for a packet or TxDone.
+
+Runs RFM9x on an SX127xSim chip three ways:
+- "spin" replaces _wait_done with the loop send and receive had before,
+  reading the IRQ flags over SPI until the flag is set,
+- "backoff" is _wait_done without irq, polling with a doubling sleep,
+- "irq" is _wait_done sleeping on the DIO0 callback.
+
+Receiving, a thread injects --packets heartbeats at --rate Hz while the
+radio calls receive() for each. Sending, the radio sends --packets
+packets with --airtime seconds of simulated airtime each. Reports SPI
+transactions and CPU time of the calling thread per packet.
+
+    python -m benchmarks.rfm9x_wait --packets 40 --rate 20 --airtime 0.05
+"""
+import argparse
+import threading
+import time
+
+from lib.rfm9x import RFM9x
+from lib.sim_radio import random_heartbeat
+from lib.sx127x_sim import SimResetPin, SimSPIDevice, SX127xSim, radiohead_packet
+
+
+def _spin(done, timeout):
+    start = time.monotonic()
+    while not done():
+        if (time.monotonic() - start) >= timeout:
+            return False
+    return True
+
+
+def make_radio(mode, airtime):
+    chip = SX127xSim(tx_time=airtime)
+    radio = RFM9x(None, None, SimResetPin(chip), 433, device=SimSPIDevice(chip),
+                  irq=chip.dio0 if mode == "irq" else None)
+    radio.node = 58
+    if mode == "spin":
+        radio._wait_done = _spin
+    return chip, radio
+
+
+def receive(mode, packets, rate, airtime):
+    """
+    :return: (packets received, SPI transactions per packet, CPU ms per packet)
+    """
+    chip, radio = make_radio(mode, airtime)
+    frames = [radiohead_packet(random_heartbeat(i), header_to=58, header_from=59) for i in range(packets)]
+    radio.listen()
+
+    def feed():
+        for frame in frames:
+            time.sleep(1 / rate)
+            chip.inject(frame)
+
+    feeder = threading.Thread(target=feed, name="rfm9x-feeder")
+    transactions = chip.transaction_count
+    cpu = time.thread_time()
+    feeder.start()
+    received = 0
+    deadline = time.monotonic() + packets / rate + 2
+    while received < packets and time.monotonic() < deadline:
+        if radio.receive(timeout=0.5) is not None:
+            received += 1
+    cpu = time.thread_time() - cpu
+    feeder.join()
+    return received, (chip.transaction_count - transactions) / max(received, 1), cpu / max(received, 1) * 1000
+
+
+def send(mode, packets, airtime):
+    """
+    :return: (packets sent, SPI transactions per packet, CPU ms per packet)
+    """
+    chip, radio = make_radio(mode, airtime)
+    message = bytes(20)
+    transactions = chip.transaction_count
+    cpu = time.thread_time()
+    sent = sum(radio.send(message) for _ in range(packets))
+    cpu = time.thread_time() - cpu
+    return sent, (chip.transaction_count - transactions) / packets, cpu / packets * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--packets", type=int, default=40)
+    parser.add_argument("--rate", type=float, default=20, help="received packets per second")
+    parser.add_argument("--airtime", type=float, default=0.05, help="simulated seconds per transmission")
+    args = parser.parse_args()
+
+    for mode in ("spin", "backoff", "irq"):
+        received, rx_spi, rx_cpu = receive(mode, args.packets, args.rate, args.airtime)
+        sent, tx_spi, tx_cpu = send(mode, args.packets, args.airtime)
+        print(f"{mode:7}: rx {received}/{args.packets}, {rx_spi:8.0f} SPI and {rx_cpu:6.2f} ms CPU per packet; "
+              f"tx {sent}/{args.packets}, {tx_spi:8.0f} SPI and {tx_cpu:6.2f} ms CPU per packet")
+
+
+if __name__ == "__main__":
+    main()
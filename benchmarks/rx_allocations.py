@@ -0,0 +1,85 @@
+"""Allocations and time per received packet in LoRa's interrupt handler.
+
+Feeds heartbeats into an SX127xSim chip and runs LoRa._handle_interrupt on
+the calling thread for each one, the way the DIO0 callback would. Reports:
+- time per packet, with tracemalloc off,
+- blocks and bytes still held per packet by code in lib/argus_lora.py once
+  the packet is handed to on_recv (the Payload and its message), from a
+  tracemalloc snapshot diff with every payload kept,
+- the transient tracemalloc peak while handling one packet, which also
+  counts the lists the simulated chip builds for each SPI transfer, as
+  spidev does.
+
+    python -m benchmarks.rx_allocations --packets 2000 --top 5
+"""
+import argparse
+import os
+import time
+import tracemalloc
+
+from lib import argus_lora
+from lib.argus_lora import LoRa
+from lib.sim_radio import random_heartbeat
+from lib.sx127x_sim import SX127xSim, radiohead_packet
+
+
+def make_radio():
+    chip = SX127xSim()
+    radio = LoRa(0, None, 25, freq=433, spi=chip, irq=chip.dio0)
+    # handle the interrupts here instead of on the chip's dispatcher thread
+    chip.dio0.when_pressed = None
+    radio.set_mode_rx()
+    return chip, radio
+
+
+def receive(chip, radio, packet):
+    chip.inject(packet)
+    radio._handle_interrupt(chip.dio0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--packets", type=int, default=2000)
+    parser.add_argument("--top", type=int, default=0, help="also list the top allocation sites")
+    args = parser.parse_args()
+
+    packets = [radiohead_packet(random_heartbeat(i & 0xffff), header_to=25) for i in range(args.packets)]
+    chip, radio = make_radio()
+    received = []
+    radio.on_recv = received.append
+    for packet in packets[:100]:
+        receive(chip, radio, packet)
+
+    received.clear()
+    start = time.perf_counter()
+    for packet in packets:
+        receive(chip, radio, packet)
+    elapsed = time.perf_counter() - start
+    assert len(received) == len(packets)
+    print(f"time: {elapsed / len(packets) * 1e6:.1f} us per packet")
+
+    received.clear()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    peaks = []
+    for packet in packets:
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        receive(chip, radio, packet)
+        peaks.append(tracemalloc.get_traced_memory()[1] - current)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    own = [tracemalloc.Filter(True, os.path.abspath(argus_lora.__file__))]
+    stats = after.filter_traces(own).compare_to(before.filter_traces(own), "lineno")
+    blocks = sum(stat.count_diff for stat in stats)
+    size = sum(stat.size_diff for stat in stats)
+    print(f"held: {blocks / len(packets):.2f} blocks, {size / len(packets):.0f} bytes per packet")
+    print(f"transient peak: {sum(peaks) / len(peaks):.0f} bytes per packet on average, {max(peaks)} at most")
+    for stat in stats[:args.top]:
+        print(f"  {stat}")
+    radio.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+"""Heartbeats decoded per second, per-byte decoder against unpack_message.
+
+"per-byte" is the decoder radio_utils had before the struct layouts,
+copied below with its prints left out (benchmarks.decode_log_levels
+measures logging): it copies the packet into a list of ints and shifts
+every value together by hand. "struct" is unpack_message as main.py calls
+it. Both run over the same --packets random heartbeats of each type and
+must agree on every value.
+
+"receive path" also runs LoRa._handle_interrupt on an SX127xSim chip for
+each packet before unpack_message, the rate one core can take packets off
+the radio and decode them.
+
+    python -m benchmarks.rx_throughput --packets 20000
+"""
+import argparse
+import os
+import random
+import time
+
+os.environ.setdefault("GPIOZERO_PIN_FACTORY", "mock")
+
+from lib.argus_lora import LoRa, Payload  # noqa: E402
+from lib.constants import Message_IDS  # noqa: E402
+from lib.radio_utils import HEARTBEAT_LAYOUTS, unpack_header, unpack_message  # noqa: E402
+from lib.sim_radio import pack_heartbeat  # noqa: E402
+from lib.sx127x_sim import SX127xSim, radiohead_packet  # noqa: E402
+
+
+def _fixed_point(data):
+    val = 0
+    neg_bit_flag = 0
+    if ((data[0] >> 7) == 1):
+        data[0] &= 0x7F
+        neg_bit_flag = 1
+    val += (data[0] << 8) + data[1]
+    val += ((data[2] << 8) + data[3]) / 65536
+    if (neg_bit_flag == 1):
+        val = -1 * val
+    return val
+
+
+def _fixed_point_hp(data):
+    val = 0
+    neg_bit_flag = 0
+    if ((data[0] >> 7) == 1):
+        data[0] &= 0x7F
+        neg_bit_flag = 1
+    val += data[0]
+    val += ((data[1] << 16) + (data[2] << 8) + data[3] + 1) / 16777216
+    if (neg_bit_flag == 1):
+        val = -1 * val
+    return val
+
+
+def _time(data, i):
+    return ((data[i] & 0xff) << 24 |
+            (data[i + 1] & 0xff) << 16 |
+            (data[i + 2] & 0xff) << 8 |
+            (data[i + 3] & 0xff))
+
+
+def per_byte_unpack(msg):
+    (ack, msg_id, msg_seq_count, msg_size) = unpack_header(msg)
+    data = list(msg.message[6:])
+    if msg_id == Message_IDS.SAT_HEARTBEAT_BATT:
+        return msg_id, _time(data, 4), (data[0], data[1] << 8 | data[2], data[3])
+    elif msg_id == Message_IDS.SAT_HEARTBEAT_SUN:
+        return msg_id, _time(data, 12), (_fixed_point_hp(data[0:4]), _fixed_point_hp(data[4:8]),
+                                         _fixed_point_hp(data[8:12]))
+    elif msg_id == Message_IDS.SAT_HEARTBEAT_IMU:
+        return msg_id, _time(data, 24), (_fixed_point(data[0:4]), _fixed_point(data[4:8]),
+                                         _fixed_point(data[8:12]), _fixed_point(data[12:16]),
+                                         _fixed_point(data[16:20]), _fixed_point(data[20:24]))
+
+
+def heartbeats(msg_id, count, seed=None):
+    rng = random.Random(seed)
+    start = int(time.time())
+    payloads = []
+    for i in range(count):
+        if msg_id == Message_IDS.SAT_HEARTBEAT_BATT:
+            values = (rng.randrange(101), rng.randrange(1 << 16), rng.randrange(256))
+        elif msg_id == Message_IDS.SAT_HEARTBEAT_SUN:
+            values = tuple(rng.uniform(-1, 1) for _ in range(3))
+        else:
+            values = tuple(rng.uniform(-100, 100) for _ in range(6))
+        message = pack_heartbeat(msg_id, i & 0xffff, start + i // 3, values)
+        payloads.append(Payload(message, 25, 1, i & 0xff, 0, -90.0, 7.5, time.time()))
+    return payloads
+
+
+def rate(decode, payloads):
+    start = time.perf_counter()
+    for payload in payloads:
+        decode(payload)
+    return len(payloads) / (time.perf_counter() - start)
+
+
+def receive_path_rate(payloads):
+    chip = SX127xSim()
+    radio = LoRa(0, None, 25, freq=433, spi=chip, irq=chip.dio0)
+    # handle the interrupts here instead of on the chip's dispatcher thread
+    chip.dio0.when_pressed = None
+    radio.set_mode_rx()
+    received = []
+    radio.on_recv = received.append
+    packets = [radiohead_packet(payload.message, header_to=25) for payload in payloads]
+    start = time.perf_counter()
+    for packet in packets:
+        chip.inject(packet)
+        radio._handle_interrupt(chip.dio0)
+        unpack_message(received.pop())
+    return len(packets) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--packets", type=int, default=20000, help="heartbeats of each type")
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    for msg_id, layout in HEARTBEAT_LAYOUTS.items():
+        payloads = heartbeats(msg_id, args.packets, args.seed)
+        for payload in payloads:
+            old, new = per_byte_unpack(payload), unpack_message(payload)
+            assert old[:2] == new[:2] and all(abs(a - b) < 1e-6 for a, b in zip(old[2], new[2]))
+        before = rate(per_byte_unpack, payloads)
+        after = rate(unpack_message, payloads)
+        path = receive_path_rate(payloads)
+        print(f"{layout.name:7}: per-byte {before:10,.0f}/s, struct {after:10,.0f}/s ({after / before:.1f}x), "
+              f"receive path {path:9,.0f}/s")
+
+
+if __name__ == "__main__":
+    main()
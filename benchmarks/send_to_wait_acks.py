@@ -0,0 +1,110 @@
+"""CPU per send and ACK latency of LoRa.send_to_wait.
+
+Sends to a peer LoRa on a linked SX127xSim chip in real time with the
+Bw125 airtime and no loss. The peer answers every message with send_ack
+from a thread of its own. With --senders several threads call
+send_to_wait on the same radio at once.
+
+    python -m benchmarks.send_to_wait_acks --count 50 --senders 1
+"""
+import argparse
+import queue
+import threading
+import time
+
+from lib.argus_lora import LoRa, ModemConfig
+from lib.link_adaptation import airtime
+from lib.sx127x_sim import SX127xSim, link
+
+
+def simulate_send_to_wait(count=50, size=20, senders=1, retries=3, modem_config=ModemConfig.Bw125Cr45Sf128):
+    """
+    :param count: messages each sending thread sends
+    :param size: bytes per message
+    :param senders: threads calling send_to_wait on the same radio at once
+    :param retries: passed to send_to_wait
+    :param modem_config: preset both radios use, sets the simulated airtime of messages and ACKs
+    :return: dict of messages acknowledged, CPU seconds the sending threads spent per message, and
+             the mean and worst seconds from the ACK being read out of the radio to send_to_wait returning
+
+    Sends to a peer LoRa on a linked SX127xSim chip in real time, with no
+    loss. The peer answers every message with send_ack from a thread of its
+    own, the interrupt thread can't see its own TxDone while it waits for it.
+    """
+    sender_chip = SX127xSim()
+    peer_chip = SX127xSim()
+    link(sender_chip, peer_chip)
+    sender_chip.tx_time = airtime(modem_config, 4 + size)
+    peer_chip.tx_time = airtime(modem_config, 5)
+    sender_radio = LoRa(0, None, 25, freq=433, modem_config=modem_config, spi=sender_chip, irq=sender_chip.dio0)
+    peer_radio = LoRa(0, None, 1, freq=433, modem_config=modem_config, spi=peer_chip, irq=peer_chip.dio0)
+    for radio, chip in ((sender_radio, sender_chip), (peer_radio, peer_chip)):
+        radio.wait_packet_sent_timeout = chip.tx_time + 0.5
+
+    # message -> header_id it came with, ACK header_id -> time it was read out
+    header_ids = {}
+    ack_times = {}
+    sender_radio.on_ack = lambda payload: ack_times.__setitem__(payload.header_id, payload.received_at)
+    packets = queue.Queue()
+    peer_radio.on_recv = packets.put
+    stop = threading.Event()
+
+    def answer():
+        while not stop.is_set():
+            try:
+                payload = packets.get(timeout=0.01)
+            except queue.Empty:
+                continue
+            header_ids[payload.message] = payload.header_id
+            peer_radio.send_ack(payload.header_from, payload.header_id)
+            peer_radio.set_mode_rx()
+
+    acked = []
+    cpu = []
+    latencies = []
+
+    def send(index):
+        for i in range(count):
+            message = bytes([index, i]) + bytes(size - 2)
+            start = time.thread_time()
+            ok = sender_radio.send_to_wait(message, 1, retries=retries)
+            returned = time.time()
+            cpu.append(time.thread_time() - start)
+            acked.append(ok)
+            if ok:
+                latencies.append(returned - ack_times[header_ids[message]])
+
+    answering = threading.Thread(target=answer, name="send-to-wait-peer", daemon=True)
+    answering.start()
+    sender_radio.set_mode_rx()
+    peer_radio.set_mode_rx()
+    threads = [threading.Thread(target=send, args=(index,), name=f"send-to-wait-{index}") for index in range(senders)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stop.set()
+    answering.join()
+    sender_radio.close()
+    peer_radio.close()
+    return {"acked": sum(acked), "sent": len(acked), "cpu_per_send": sum(cpu) / len(cpu),
+            "ack_latency": sum(latencies) / len(latencies) if latencies else None,
+            "max_ack_latency": max(latencies, default=None)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--count", type=int, default=50, help="messages each sending thread sends")
+    parser.add_argument("--size", type=int, default=20, help="bytes per message")
+    parser.add_argument("--senders", type=int, default=1)
+    parser.add_argument("--retries", type=int, default=3)
+    args = parser.parse_args()
+
+    stats = simulate_send_to_wait(args.count, args.size, args.senders, args.retries)
+    print(f"{stats['acked']} of {stats['sent']} acked, {stats['cpu_per_send'] * 1000:.2f} ms CPU per send")
+    if stats["ack_latency"] is not None:
+        print(f"ACK latency: mean {stats['ack_latency'] * 1000:.2f} ms, max {stats['max_ack_latency'] * 1000:.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
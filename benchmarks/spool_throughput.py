@@ -0,0 +1,80 @@
+"""Append, replay and reopen rates of the on-disk Spool.
+
+Appends --packets random heartbeats to a Spool in a temporary directory
+(--dir to put it on the disk the ground station uses) once for each
+--sync-every value, so the cost of an fsync every record shows next to
+the batched default. Then reads the spool back in --batch record batches
+committing each one as SpoolReplayer does, and times reopening a full
+spool, which scans every record to find the end.
+
+    python -m benchmarks.spool_throughput --packets 50000 --sync-every 1 32 256
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from lib.argus_lora import Payload
+from lib.sim_radio import random_heartbeat
+from lib.spool import Spool
+
+
+def append_rate(path, payloads, sync_every):
+    spool = Spool(path, sync_every=sync_every, sync_interval=60)
+    start = time.perf_counter()
+    for payload in payloads:
+        spool.append(payload)
+    spool.sync()
+    elapsed = time.perf_counter() - start
+    spool.close()
+    return len(payloads) / elapsed
+
+
+def reopen_seconds(path):
+    start = time.perf_counter()
+    spool = Spool(path)
+    elapsed = time.perf_counter() - start
+    spool.close()
+    return elapsed
+
+
+def replay_rate(path, batch):
+    spool = Spool(path)
+    count = 0
+    start = time.perf_counter()
+    while len(spool):
+        records, end = spool.read(batch)
+        count += len(records)
+        spool.commit(end)
+    elapsed = time.perf_counter() - start
+    spool.close()
+    return count / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--packets", type=int, default=50000)
+    parser.add_argument("--sync-every", type=int, nargs="+", default=[1, 32, 256])
+    parser.add_argument("--batch", type=int, default=500, help="records per read, as SpoolReplayer batch_size")
+    parser.add_argument("--dir", help="directory for the spool file, a temporary one by default")
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    payloads = [Payload(random_heartbeat(i & 0xffff, rng), 25, 1, i & 0xff, 0, -90.0, 7.5, time.time())
+                for i in range(args.packets)]
+    with tempfile.TemporaryDirectory(dir=args.dir) as directory:
+        path = os.path.join(directory, "heartbeats.spool")
+        for sync_every in args.sync_every:
+            for name in (path, path + ".offset"):
+                if os.path.exists(name):
+                    os.remove(name)
+            print(f"append, fsync every {sync_every:4}: {append_rate(path, payloads, sync_every):10,.0f} packets/s")
+        size = os.path.getsize(path)
+        print(f"reopen {size / 1e6:.1f} MB: {reopen_seconds(path) * 1000:.1f} ms")
+        print(f"read and commit, {args.batch} per batch: {replay_rate(path, args.batch):10,.0f} packets/s")
+
+
+if __name__ == "__main__":
+    main()
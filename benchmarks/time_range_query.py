@@ -0,0 +1,73 @@
+"""Time range query cost with and without the (time, sequence_count) key.
+
+No MySQL server is needed: two SQLite tables hold the same --rows
+heartbeats, three per satellite second. "scan" has no index, like the
+tables db_setup.sql used to create. "keyed" has the UNIQUE (time,
+sequence_count) key of the current schema. Each query fetches every row
+in a random --window seconds, the shape of a pass query. SQLite has no
+partitions, so this measures the index alone; partition pruning only
+narrows a MySQL scan further.
+
+    python -m benchmarks.time_range_query --rows 3000000 --window 600
+"""
+import argparse
+import random
+import sqlite3
+import statistics
+import time
+
+START = 1735689600
+PER_SECOND = 3
+
+
+def make_table(db, name, key, rows):
+    db.execute(f"CREATE TABLE {name} (time INTEGER NOT NULL, sequence_count INTEGER, "
+               f"received_at REAL, rssi REAL, snr REAL, x REAL, y REAL, z REAL{key})")
+    db.executemany(f"INSERT INTO {name} VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+    db.commit()
+
+
+def heartbeat_rows(count, seed=None):
+    rng = random.Random(seed)
+    for i in range(count):
+        sat_time = START + i // PER_SECOND
+        yield (sat_time, i & 0xffff, sat_time + 0.5, -90.0, 7.5, rng.random(), rng.random(), rng.random())
+
+
+def time_queries(db, name, windows):
+    """Seconds for each window query and the rows it returned."""
+    sql = f"SELECT * FROM {name} WHERE time >= ? AND time < ?"
+    seconds = []
+    found = 0
+    for start, end in windows:
+        begin = time.perf_counter()
+        found += len(db.execute(sql, (start, end)).fetchall())
+        seconds.append(time.perf_counter() - begin)
+    return seconds, found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=3000000)
+    parser.add_argument("--window", type=int, default=600, help="seconds of satellite time per query")
+    parser.add_argument("--queries", type=int, default=20)
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    db = sqlite3.connect(":memory:")
+    for name, key in (("scan", ""), ("keyed", ", UNIQUE (time, sequence_count)")):
+        begin = time.perf_counter()
+        make_table(db, name, key, heartbeat_rows(args.rows, args.seed))
+        print(f"{name:5}: loaded {args.rows} rows in {time.perf_counter() - begin:.1f} s")
+
+    rng = random.Random(args.seed)
+    last = START + args.rows // PER_SECOND - args.window
+    windows = [(start, start + args.window) for start in (rng.randrange(START, last) for _ in range(args.queries))]
+    for name in ("scan", "keyed"):
+        seconds, found = time_queries(db, name, windows)
+        print(f"{name:5}: median {statistics.median(seconds) * 1000:8.2f} ms, max {max(seconds) * 1000:8.2f} ms "
+              f"per {args.window} s window, {found / len(windows):.0f} rows each")
+
+
+if __name__ == "__main__":
+    main()
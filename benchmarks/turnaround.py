@@ -0,0 +1,59 @@
+"""RX -> TX -> RX turnaround time of LoRa on the SX127x emulator.
+
+Each round starts in receive mode, sends one --size byte packet with
+send, waits for TxDone with wait_packet_sent and goes back to receive
+mode, the path send_to_wait takes for every try. The chip's dispatcher
+thread handles TxDone as the DIO0 callback would. Reports the time per
+round above the --airtime the simulated chip spends transmitting.
+
+"poll" is _wait_mode_ready reading OP_MODE back. "sleep" replaces it
+with the fixed 100 ms sleep set_mode_idle had before, --sleep-rounds
+times as it is slow.
+
+    python -m benchmarks.turnaround --rounds 200 --airtime 0.002
+"""
+import argparse
+import statistics
+import time
+
+from lib.argus_lora import LoRa
+from lib.sx127x_sim import SX127xSim
+
+
+def turnaround(rounds, size, airtime, sleep=False):
+    """
+    :return: seconds each round took above the airtime
+    """
+    chip = SX127xSim(tx_time=airtime)
+    radio = LoRa(0, None, 25, freq=433, spi=chip, irq=chip.dio0)
+    if sleep:
+        radio._wait_mode_ready = lambda mode: time.sleep(0.1)
+    radio.set_mode_rx()
+    message = bytes(size)
+    overhead = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        radio.send(message, 1)
+        assert radio.wait_packet_sent()
+        radio.set_mode_rx()
+        overhead.append(time.perf_counter() - start - airtime)
+    radio.close()
+    return overhead
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rounds", type=int, default=200)
+    parser.add_argument("--sleep-rounds", type=int, default=10)
+    parser.add_argument("--size", type=int, default=20, help="bytes per packet")
+    parser.add_argument("--airtime", type=float, default=0.002, help="simulated seconds per transmission")
+    args = parser.parse_args()
+
+    for name, rounds, sleep in (("poll", args.rounds, False), ("sleep", args.sleep_rounds, True)):
+        overhead = turnaround(rounds, args.size, args.airtime, sleep)
+        print(f"{name:5}: median {statistics.median(overhead) * 1000:7.2f} ms, "
+              f"max {max(overhead) * 1000:7.2f} ms above {args.airtime * 1000:g} ms airtime, {rounds} rounds")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,168 @@
+-- generated by lib.migration.schema_sql, move existing databases over with migrate_db.py
 CREATE DATABASE heartbeats;
 use heartbeats;
-CREATE TABLE sun (time INT, x FLOAT, y FLOAT, z FLOAT);
-CREATE TABLE battery (time INT, batt_soc INT, current INT, boot_count INT);
-CREATE TABLE imu (time INT, mag_x FLOAT, mag_y FLOAT, mag_z FLOAT, gyro_x FLOAT, gyro_y FLOAT, gyro_z FLOAT);
\ No newline at end of file
+CREATE TABLE sun (
+    id BIGINT UNSIGNED NOT NULL AUTO_INCREMENT,
+    time INT UNSIGNED NOT NULL,
+    sequence_count SMALLINT UNSIGNED,
+    received_at DOUBLE,
+    rssi FLOAT,
+    snr FLOAT,
+    x FLOAT,
+    y FLOAT,
+    z FLOAT,
+    PRIMARY KEY (time, id),
+    KEY id (id),
+    UNIQUE KEY heartbeat (time, sequence_count)
+)
+PARTITION BY RANGE (time) (
+    PARTITION p_before VALUES LESS THAN (1735689600),
+    PARTITION p202501 VALUES LESS THAN (1738368000),
+    PARTITION p202502 VALUES LESS THAN (1740787200),
+    PARTITION p202503 VALUES LESS THAN (1743465600),
+    PARTITION p202504 VALUES LESS THAN (1746057600),
+    PARTITION p202505 VALUES LESS THAN (1748736000),
+    PARTITION p202506 VALUES LESS THAN (1751328000),
+    PARTITION p202507 VALUES LESS THAN (1754006400),
+    PARTITION p202508 VALUES LESS THAN (1756684800),
+    PARTITION p202509 VALUES LESS THAN (1759276800),
+    PARTITION p202510 VALUES LESS THAN (1761955200),
+    PARTITION p202511 VALUES LESS THAN (1764547200),
+    PARTITION p202512 VALUES LESS THAN (1767225600),
+    PARTITION p202601 VALUES LESS THAN (1769904000),
+    PARTITION p202602 VALUES LESS THAN (1772323200),
+    PARTITION p202603 VALUES LESS THAN (1775001600),
+    PARTITION p202604 VALUES LESS THAN (1777593600),
+    PARTITION p202605 VALUES LESS THAN (1780272000),
+    PARTITION p202606 VALUES LESS THAN (1782864000),
+    PARTITION p202607 VALUES LESS THAN (1785542400),
+    PARTITION p202608 VALUES LESS THAN (1788220800),
+    PARTITION p202609 VALUES LESS THAN (1790812800),
+    PARTITION p202610 VALUES LESS THAN (1793491200),
+    PARTITION p202611 VALUES LESS THAN (1796083200),
+    PARTITION p202612 VALUES LESS THAN (1798761600),
+    PARTITION p202701 VALUES LESS THAN (1801440000),
+    PARTITION p202702 VALUES LESS THAN (1803859200),
+    PARTITION p202703 VALUES LESS THAN (1806537600),
+    PARTITION p202704 VALUES LESS THAN (1809129600),
+    PARTITION p202705 VALUES LESS THAN (1811808000),
+    PARTITION p202706 VALUES LESS THAN (1814400000),
+    PARTITION p202707 VALUES LESS THAN (1817078400),
+    PARTITION p202708 VALUES LESS THAN (1819756800),
+    PARTITION p202709 VALUES LESS THAN (1822348800),
+    PARTITION p202710 VALUES LESS THAN (1825027200),
+    PARTITION p202711 VALUES LESS THAN (1827619200),
+    PARTITION p202712 VALUES LESS THAN (1830297600),
+    PARTITION pmax VALUES LESS THAN MAXVALUE
+);
+CREATE TABLE battery (
+    id BIGINT UNSIGNED NOT NULL AUTO_INCREMENT,
+    time INT UNSIGNED NOT NULL,
+    sequence_count SMALLINT UNSIGNED,
+    received_at DOUBLE,
+    rssi FLOAT,
+    snr FLOAT,
+    batt_soc INT,
+    current INT,
+    boot_count INT,
+    PRIMARY KEY (time, id),
+    KEY id (id),
+    UNIQUE KEY heartbeat (time, sequence_count)
+)
+PARTITION BY RANGE (time) (
+    PARTITION p_before VALUES LESS THAN (1735689600),
+    PARTITION p202501 VALUES LESS THAN (1738368000),
+    PARTITION p202502 VALUES LESS THAN (1740787200),
+    PARTITION p202503 VALUES LESS THAN (1743465600),
+    PARTITION p202504 VALUES LESS THAN (1746057600),
+    PARTITION p202505 VALUES LESS THAN (1748736000),
+    PARTITION p202506 VALUES LESS THAN (1751328000),
+    PARTITION p202507 VALUES LESS THAN (1754006400),
+    PARTITION p202508 VALUES LESS THAN (1756684800),
+    PARTITION p202509 VALUES LESS THAN (1759276800),
+    PARTITION p202510 VALUES LESS THAN (1761955200),
+    PARTITION p202511 VALUES LESS THAN (1764547200),
+    PARTITION p202512 VALUES LESS THAN (1767225600),
+    PARTITION p202601 VALUES LESS THAN (1769904000),
+    PARTITION p202602 VALUES LESS THAN (1772323200),
+    PARTITION p202603 VALUES LESS THAN (1775001600),
+    PARTITION p202604 VALUES LESS THAN (1777593600),
+    PARTITION p202605 VALUES LESS THAN (1780272000),
+    PARTITION p202606 VALUES LESS THAN (1782864000),
+    PARTITION p202607 VALUES LESS THAN (1785542400),
+    PARTITION p202608 VALUES LESS THAN (1788220800),
+    PARTITION p202609 VALUES LESS THAN (1790812800),
+    PARTITION p202610 VALUES LESS THAN (1793491200),
+    PARTITION p202611 VALUES LESS THAN (1796083200),
+    PARTITION p202612 VALUES LESS THAN (1798761600),
+    PARTITION p202701 VALUES LESS THAN (1801440000),
+    PARTITION p202702 VALUES LESS THAN (1803859200),
+    PARTITION p202703 VALUES LESS THAN (1806537600),
+    PARTITION p202704 VALUES LESS THAN (1809129600),
+    PARTITION p202705 VALUES LESS THAN (1811808000),
+    PARTITION p202706 VALUES LESS THAN (1814400000),
+    PARTITION p202707 VALUES LESS THAN (1817078400),
+    PARTITION p202708 VALUES LESS THAN (1819756800),
+    PARTITION p202709 VALUES LESS THAN (1822348800),
+    PARTITION p202710 VALUES LESS THAN (1825027200),
+    PARTITION p202711 VALUES LESS THAN (1827619200),
+    PARTITION p202712 VALUES LESS THAN (1830297600),
+    PARTITION pmax VALUES LESS THAN MAXVALUE
+);
+CREATE TABLE imu (
+    id BIGINT UNSIGNED NOT NULL AUTO_INCREMENT,
+    time INT UNSIGNED NOT NULL,
+    sequence_count SMALLINT UNSIGNED,
+    received_at DOUBLE,
+    rssi FLOAT,
+    snr FLOAT,
+    mag_x FLOAT,
+    mag_y FLOAT,
+    mag_z FLOAT,
+    gyro_x FLOAT,
+    gyro_y FLOAT,
+    gyro_z FLOAT,
+    PRIMARY KEY (time, id),
+    KEY id (id),
+    UNIQUE KEY heartbeat (time, sequence_count)
+)
+PARTITION BY RANGE (time) (
+    PARTITION p_before VALUES LESS THAN (1735689600),
+    PARTITION p202501 VALUES LESS THAN (1738368000),
+    PARTITION p202502 VALUES LESS THAN (1740787200),
+    PARTITION p202503 VALUES LESS THAN (1743465600),
+    PARTITION p202504 VALUES LESS THAN (1746057600),
+    PARTITION p202505 VALUES LESS THAN (1748736000),
+    PARTITION p202506 VALUES LESS THAN (1751328000),
+    PARTITION p202507 VALUES LESS THAN (1754006400),
+    PARTITION p202508 VALUES LESS THAN (1756684800),
+    PARTITION p202509 VALUES LESS THAN (1759276800),
+    PARTITION p202510 VALUES LESS THAN (1761955200),
+    PARTITION p202511 VALUES LESS THAN (1764547200),
+    PARTITION p202512 VALUES LESS THAN (1767225600),
+    PARTITION p202601 VALUES LESS THAN (1769904000),
+    PARTITION p202602 VALUES LESS THAN (1772323200),
+    PARTITION p202603 VALUES LESS THAN (1775001600),
+    PARTITION p202604 VALUES LESS THAN (1777593600),
+    PARTITION p202605 VALUES LESS THAN (1780272000),
+    PARTITION p202606 VALUES LESS THAN (1782864000),
+    PARTITION p202607 VALUES LESS THAN (1785542400),
+    PARTITION p202608 VALUES LESS THAN (1788220800),
+    PARTITION p202609 VALUES LESS THAN (1790812800),
+    PARTITION p202610 VALUES LESS THAN (1793491200),
+    PARTITION p202611 VALUES LESS THAN (1796083200),
+    PARTITION p202612 VALUES LESS THAN (1798761600),
+    PARTITION p202701 VALUES LESS THAN (1801440000),
+    PARTITION p202702 VALUES LESS THAN (1803859200),
+    PARTITION p202703 VALUES LESS THAN (1806537600),
+    PARTITION p202704 VALUES LESS THAN (1809129600),
+    PARTITION p202705 VALUES LESS THAN (1811808000),
+    PARTITION p202706 VALUES LESS THAN (1814400000),
+    PARTITION p202707 VALUES LESS THAN (1817078400),
+    PARTITION p202708 VALUES LESS THAN (1819756800),
+    PARTITION p202709 VALUES LESS THAN (1822348800),
+    PARTITION p202710 VALUES LESS THAN (1825027200),
+    PARTITION p202711 VALUES LESS THAN (1827619200),
+    PARTITION p202712 VALUES LESS THAN (1830297600),
+    PARTITION pmax VALUES LESS THAN MAXVALUE
+);
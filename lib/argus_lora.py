@@ -1,13 +1,41 @@
+import logging
 import math
+import threading
 import time
-from collections import namedtuple
 from enum import Enum
 from random import random
 
-import spidev
-from gpiozero import Button
-
 from lib.constants import Definitions
+from lib.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+# registers 0x10-0x1a read in one transfer on every interrupt
+_STATUS_BURST_LENGTH = Definitions.REG_1A_PKT_RSSI_VALUE - Definitions.REG_10_FIFO_RX_CURRENT_ADDR + 1
+# positions in a read frame, byte 0 is clocked out while sending the register address
+_RX_CURRENT_ADDR = 1
+_IRQ_FLAGS = Definitions.REG_12_IRQ_FLAGS - Definitions.REG_10_FIFO_RX_CURRENT_ADDR + 1
+_RX_NB_BYTES = Definitions.REG_13_RX_NB_BYTES - Definitions.REG_10_FIFO_RX_CURRENT_ADDR + 1
+_PKT_SNR_VALUE = Definitions.REG_19_PKT_SNR_VALUE - Definitions.REG_10_FIFO_RX_CURRENT_ADDR + 1
+_PKT_RSSI_VALUE = Definitions.REG_1A_PKT_RSSI_VALUE - Definitions.REG_10_FIFO_RX_CURRENT_ADDR + 1
+
+
+class Payload(object):
+    __slots__ = ('message', 'header_to', 'header_from', 'header_id', 'header_flags', 'rssi', 'snr', 'received_at')
+
+    def __init__(self, message, header_to, header_from, header_id, header_flags, rssi, snr, received_at=None):
+        self.message = message
+        self.header_to = header_to
+        self.header_from = header_from
+        self.header_id = header_id
+        self.header_flags = header_flags
+        self.rssi = rssi
+        self.snr = snr
+        # unix time the packet was read out of the radio
+        self.received_at = time.time() if received_at is None else received_at
+
+    def __repr__(self):
+        return "Payload(" + ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__) + ")"
 
 
 class ModemConfig(Enum):
@@ -20,7 +48,9 @@ class ModemConfig(Enum):
 class LoRa(object):
     def __init__(self, channel, interrupt, this_address, freq=915, tx_power=14,
                  modem_config=ModemConfig.Bw125Cr45Sf128, receive_all=False,
-                 acks=False, crypto=None):
+                 acks=False, crypto=None, spi=None, irq=None):
+        # spi and irq default to the Pi hardware (spidev on bus 0 and a gpiozero
+        # Button on the interrupt pin), pass e.g. an SX127xSim and its dio0 instead
 
         self._channel = channel
         self._interrupt = interrupt
@@ -39,23 +69,63 @@ class LoRa(object):
         self._last_payload = None
         self.crypto = crypto
 
+        # (header_to, header_id) -> Event of every send_to_wait waiting for an ACK
+        self._pending_acks = {}
+        self._pending_acks_lock = threading.Lock()
+        # held from loading the FIFO until the packet is out
+        self._tx_lock = threading.RLock()
+        # held while an interrupt is handled or the modem registers are rewritten
+        self._register_lock = threading.RLock()
+        # ident of the thread inside _handle_interrupt, see in_interrupt()
+        self._interrupt_thread = None
+        # clear while a packet is being transmitted
+        self._packet_sent = threading.Event()
+        self._packet_sent.set()
+
         self.cad_timeout = 0
         self.send_retries = 2
         self.wait_packet_sent_timeout = 0.2
         self.retry_timeout = 0.2
+        # longest time to wait for OP_MODE to report a requested mode
+        self.mode_ready_timeout = 0.01
 
+        self.received_count = 0
         self.crc_error_count = 0
+        # number of SPI transfers made, for counting round trips per packet
+        self.spi_transactions = 0
+
+        labels = {"radio": str(channel)}
+        self._interrupt_metric = REGISTRY.histogram(
+            "lora_interrupt_seconds", "Time spent handling a DIO0 interrupt", labels)
+        self._received_metric = REGISTRY.counter(
+            "lora_packets_received_total", "Packets read out of the FIFO", labels)
+        self._crc_error_metric = REGISTRY.counter(
+            "lora_crc_errors_total", "Packets rejected by the hardware CRC check", labels)
+        REGISTRY.gauge("lora_spi_transactions", "SPI transfers made", labels,
+                       function=lambda: self.spi_transactions)
+
+        # receive buffers reused for every interrupt, see _spi_read_into
+        self._read_commands = {}
+        self._status_frame = bytearray(_STATUS_BURST_LENGTH + 1)
+        self._rx_frame = bytearray(256 + 1)
+        self._rx_packet = memoryview(self._rx_frame)[1:]
 
         # Setup the module
-        btn = Button(self._interrupt, pull_up=False)
-        btn.when_pressed = self._handle_interrupt
-
-        self.spi = spidev.SpiDev()
+        if irq is None:
+            from gpiozero import Button
+            irq = Button(self._interrupt, pull_up=False)
+        self._irq = irq
+        self._irq.when_pressed = self._handle_interrupt
+
+        if spi is None:
+            import spidev
+            spi = spidev.SpiDev()
+        self.spi = spi
         self.spi.open(0, self._channel)
         self.spi.max_speed_hz = 5000000
 
         self._spi_write(Definitions.REG_01_OP_MODE, Definitions.MODE_SLEEP | Definitions.LONG_RANGE_MODE)
-        time.sleep(0.1)
+        self._wait_mode_ready(Definitions.MODE_SLEEP)
 
         assert self._spi_read(Definitions.REG_01_OP_MODE) == (Definitions.MODE_SLEEP | Definitions.LONG_RANGE_MODE), \
             "LoRa initialization failed"
@@ -66,9 +136,7 @@ class LoRa(object):
         self.set_mode_idle()
 
         # set modem config (Bw125Cr45Sf128)
-        self._spi_write(Definitions.REG_1D_MODEM_CONFIG1, self._modem_config.value[0])
-        self._spi_write(Definitions.REG_1E_MODEM_CONFIG2, self._modem_config.value[1])
-        self._spi_write(Definitions.REG_26_MODEM_CONFIG3, self._modem_config.value[2])
+        self._write_modem_config(self._modem_config)
 
         # set preamble length (8)
         self._spi_write(Definitions.REG_20_PREAMBLE_MSB, 0)
@@ -105,16 +173,22 @@ class LoRa(object):
 
     def on_recv(self, message):
         # This should be overridden by the user
-        print("Message received!")
+        logger.debug("Message received!")
+
+    def on_ack(self, message):
+        # Override to see ACK packets, e.g. lib.reliable.ReliableSender
         pass
 
     def sleep(self):
         if self._mode != Definitions.MODE_SLEEP:
-            self._spi_write(Definitions.REG_01_OP_MODE, Definitions.MODE_SLEEP)
+            # keep LONG_RANGE_MODE set, it can only change on a write selecting sleep
+            self._spi_write(Definitions.REG_01_OP_MODE, Definitions.MODE_SLEEP | Definitions.LONG_RANGE_MODE)
             self._mode = Definitions.MODE_SLEEP
+            self._packet_sent.set()
 
     def set_mode_tx(self):
         if self._mode != Definitions.MODE_TX:
+            self._packet_sent.clear()
             self._spi_write(Definitions.REG_01_OP_MODE, Definitions.MODE_TX)
             self._spi_write(Definitions.REG_40_DIO_MAPPING1, 0x40)  # Interrupt on TxDone
             self._mode = Definitions.MODE_TX
@@ -124,12 +198,14 @@ class LoRa(object):
             self._spi_write(Definitions.REG_01_OP_MODE, Definitions.MODE_RXCONTINUOUS)
             self._spi_write(Definitions.REG_40_DIO_MAPPING1, 0x00)  # Interrupt on RxDone
             self._mode = Definitions.MODE_RXCONTINUOUS
+            self._packet_sent.set()
 
     def set_mode_cad(self):
         if self._mode != Definitions.MODE_CAD:
             self._spi_write(Definitions.REG_01_OP_MODE, Definitions.MODE_CAD)
             self._spi_write(Definitions.REG_40_DIO_MAPPING1, 0x80)  # Interrupt on CadDone
             self._mode = Definitions.MODE_CAD
+            self._packet_sent.set()
 
     def _is_channel_active(self):
         self.set_mode_cad()
@@ -155,65 +231,121 @@ class LoRa(object):
                 return status
 
     def wait_packet_sent(self):
-        # wait for `_handle_interrupt` to switch the mode back
-        start = time.time()
-        while time.time() - start < self.wait_packet_sent_timeout:
-            if self._mode != Definitions.MODE_TX:
-                return True
+        # `_handle_interrupt` sets it when it switches the mode back on TxDone
+        return self._packet_sent.wait(self.wait_packet_sent_timeout)
 
-        return False
+    @property
+    def channel(self):
+        """SPI chip select the radio is on, also its metrics label."""
+        return self._channel
+
+    @property
+    def modem_config(self):
+        return self._modem_config
+
+    def set_modem_config(self, modem_config):
+        """Switch to another ModemConfig preset, then go back to the current mode."""
+        if modem_config == self._modem_config:
+            return
+        # an interrupt handled halfway through would read the FIFO in standby or switch the mode back
+        with self._register_lock:
+            mode = self._mode
+            self.set_mode_idle()
+            # keep the CRC setting, every preset turns it on but enable_crc may have turned it off
+            crc = self._spi_read(Definitions.REG_1E_MODEM_CONFIG2) & 0x04
+            self._write_modem_config(modem_config, crc)
+            self._modem_config = modem_config
+            if mode == Definitions.MODE_RXCONTINUOUS:
+                self.set_mode_rx()
+            elif mode == Definitions.MODE_SLEEP:
+                self.sleep()
+
+    def _write_modem_config(self, modem_config, crc=None):
+        config1, config2, config3 = modem_config.value
+        if crc is not None:
+            config2 = (config2 & 0xFB) | crc
+        self._spi_write(Definitions.REG_1D_MODEM_CONFIG1, config1)
+        self._spi_write(Definitions.REG_1E_MODEM_CONFIG2, config2)
+        self._spi_write(Definitions.REG_26_MODEM_CONFIG3, config3)
 
     def set_mode_idle(self):
         if self._mode != Definitions.MODE_STDBY:
             self._spi_write(Definitions.REG_01_OP_MODE, Definitions.MODE_STDBY)
-            time.sleep(0.1)
+            self._wait_mode_ready(Definitions.MODE_STDBY)
             self._mode = Definitions.MODE_STDBY
+            self._packet_sent.set()
+
+    def _wait_mode_ready(self, mode):
+        # poll OP_MODE until the chip reports the mode rather than sleeping a fixed time
+        deadline = time.monotonic() + self.mode_ready_timeout
+        while (self._spi_read(Definitions.REG_01_OP_MODE) & 0x07) != mode:
+            if time.monotonic() >= deadline:
+                logger.warning("timed out waiting for mode %d", mode)
+                return False
+        return True
 
     def send(self, data, header_to, header_id=0, header_flags=0):
-        self.wait_packet_sent()
-        self.set_mode_idle()
-        self.wait_cad()
+        with self._tx_lock:
+            self.wait_packet_sent()
+            self.set_mode_idle()
+            self.wait_cad()
 
-        header = [header_to, self._this_address, header_id, header_flags]
-        if isinstance(data, int):
-            data = [data]
-        elif isinstance(data, bytes):
-            data = [p for p in data]
-        elif isinstance(data, str):
-            data = [ord(s) for s in data]
+            header = [header_to, self._this_address, header_id, header_flags]
+            if isinstance(data, int):
+                data = [data]
+            elif isinstance(data, bytes):
+                data = [p for p in data]
+            elif isinstance(data, str):
+                data = [ord(s) for s in data]
 
-        if self.crypto:
-            data = [b for b in self._encrypt(bytes(data))]
+            if self.crypto:
+                data = [b for b in self._encrypt(bytes(data))]
 
-        payload = header + data
+            payload = header + data
 
-        self._spi_write(Definitions.REG_0D_FIFO_ADDR_PTR, 0)
-        self._spi_write(Definitions.REG_00_FIFO, payload)
-        self._spi_write(Definitions.REG_22_PAYLOAD_LENGTH, len(payload))
-        self.set_mode_tx()
+            self._spi_write(Definitions.REG_0D_FIFO_ADDR_PTR, 0)
+            self._spi_write(Definitions.REG_00_FIFO, payload)
+            self._spi_write(Definitions.REG_22_PAYLOAD_LENGTH, len(payload))
+            self.set_mode_tx()
 
-        return True
+            return True
 
     def send_to_wait(self, data, header_to, header_flags=0, retries=3):
-        self._last_header_id += 1
-
-        for _ in range(retries + 1):
-            self.send(data, header_to, header_id=self._last_header_id, header_flags=header_flags)
-            self.set_mode_rx()
-
-            if header_to == Definitions.BROADCAST_ADDRESS:  # Don't wait for acks from a broadcast message
-                return True
-
-            start = time.time()
-            while time.time() - start < self.retry_timeout + (self.retry_timeout * random()):
-                if self._last_payload:
-                    if self._last_payload.header_to == self._this_address and \
-                            self._last_payload.header_flags & Definitions.FLAGS_ACK and \
-                            self._last_payload.header_id == self._last_header_id:
-
-                        # We got an ACK
-                        return True
-        return False
+        """
+        Send data and wait for header_to to acknowledge it, retrying up to retries times.
+        Safe to call from several threads at once, each waits for its own ACK.
+        """
+        with self._pending_acks_lock:
+            # after wraparound skip ids still waiting for an ACK from the same peer,
+            # reusing one would hand that sender's ACK to this one
+            for _ in range(256):
+                self._last_header_id = (self._last_header_id + 1) % 256
+                key = (header_to, self._last_header_id)
+                if key not in self._pending_acks:
+                    break
+            else:
+                raise RuntimeError(f"all 256 header ids are waiting for an ACK from {header_to}")
+            header_id = self._last_header_id
+            acked = self._pending_acks[key] = threading.Event()
+
+        try:
+            for _ in range(retries + 1):
+                with self._tx_lock:
+                    self.send(data, header_to, header_id=header_id, header_flags=header_flags)
+                    # the ACK can't come before the packet is out
+                    self.wait_packet_sent()
+                    self.set_mode_rx()
+
+                if header_to == Definitions.BROADCAST_ADDRESS:  # Don't wait for acks from a broadcast message
+                    return True
+
+                # set by _handle_interrupt when the ACK arrives
+                if acked.wait(self.retry_timeout + (self.retry_timeout * random())):
+                    return True
+            return False
+        finally:
+            with self._pending_acks_lock:
+                del self._pending_acks[key]
 
     def send_ack(self, header_to, header_id):
         self.send(b'!', header_to, header_id, Definitions.FLAGS_ACK)
@@ -227,13 +359,27 @@ class LoRa(object):
         elif isinstance(payload, str):
             payload = [ord(s) for s in payload]
 
+        self.spi_transactions += 1
         self.spi.xfer([register | 0x80] + payload)
 
     def _spi_read(self, register, length=1):
+        self.spi_transactions += 1
         if length == 1:
-            return self.spi.xfer([register] + [0] * length)[1]
+            return self.spi.xfer(self._read_command(register, length))[1]
         else:
-            return self.spi.xfer([register] + [0] * length)[1:]
+            return self.spi.xfer(self._read_command(register, length))[1:]
+
+    def _spi_read_into(self, register, frame, length):
+        # frame[0] receives the byte clocked out with the address, data starts at frame[1]
+        self.spi_transactions += 1
+        frame[:length + 1] = self.spi.xfer(self._read_command(register, length))
+
+    def _read_command(self, register, length):
+        # immutable so the cached commands can be handed to spidev as-is
+        command = self._read_commands.get((register, length))
+        if command is None:
+            command = self._read_commands[(register, length)] = (register,) + (0,) * length
+        return command
 
     def _decrypt(self, message):
         decrypted_msg = self.crypto.decrypt(message)
@@ -247,18 +393,51 @@ class LoRa(object):
         encrypted_msg = self.crypto.encrypt(msg_bytes)
         return encrypted_msg
 
-    def _handle_interrupt(self, channel):
-        irq_flags = self._spi_read(Definitions.REG_12_IRQ_FLAGS)
+    def _signal_ack(self, payload):
+        if payload.header_to != self._this_address:
+            return
+        with self._pending_acks_lock:
+            acked = self._pending_acks.get((payload.header_from, payload.header_id))
+        if acked is not None:
+            acked.set()
+
+    def in_interrupt(self):
+        """True on the thread handling a DIO0 interrupt, e.g. inside on_recv.
 
-        if self._mode == Definitions.MODE_RXCONTINUOUS and (irq_flags & Definitions.RX_DONE) and (self.crc_error() == 0):
-            packet_len = self._spi_read(Definitions.REG_13_RX_NB_BYTES)
-            self._spi_write(Definitions.REG_0D_FIFO_ADDR_PTR, self._spi_read(Definitions.REG_10_FIFO_RX_CURRENT_ADDR))
+        Nothing there may wait for another interrupt of this radio, such as
+        the ACK send_to_wait waits for, it is only handled once on_recv returns.
+        """
+        return self._interrupt_thread == threading.get_ident()
 
-            packet = self._spi_read(Definitions.REG_00_FIFO, packet_len)
+    def _handle_interrupt(self, channel):
+        with self._register_lock, self._interrupt_metric.time():
+            self._interrupt_thread = threading.get_ident()
+            try:
+                self._handle_irq_flags()
+            finally:
+                self._interrupt_thread = None
+
+    def _handle_irq_flags(self):
+        # one burst covers FIFO_RX_CURRENT_ADDR (0x10) through PKT_RSSI_VALUE (0x1a)
+        regs = self._status_frame
+        self._spi_read_into(Definitions.REG_10_FIFO_RX_CURRENT_ADDR, regs, _STATUS_BURST_LENGTH)
+        irq_flags = regs[_IRQ_FLAGS]
+
+        if self._mode == Definitions.MODE_RXCONTINUOUS and (irq_flags & Definitions.RX_DONE) and \
+                (self._crc_error(irq_flags) == 0):
+            packet_len = regs[_RX_NB_BYTES]
+            self._spi_write(Definitions.REG_0D_FIFO_ADDR_PTR, regs[_RX_CURRENT_ADDR])
+
+            self._spi_read_into(Definitions.REG_00_FIFO, self._rx_frame, packet_len)
+            packet = self._rx_packet
             self._spi_write(Definitions.REG_12_IRQ_FLAGS, 0xff)  # Clear all IRQ flags
+            self.received_count += 1
+            self._received_metric.inc()
 
-            snr = self._spi_read(Definitions.REG_19_PKT_SNR_VALUE) / 4
-            rssi = self._spi_read(Definitions.REG_1A_PKT_RSSI_VALUE)
+            # PKT_SNR_VALUE is two's complement in quarter dB
+            snr = regs[_PKT_SNR_VALUE]
+            snr = (snr - 256 if snr > 127 else snr) / 4
+            rssi = regs[_PKT_RSSI_VALUE]
 
             if snr < 0:
                 rssi = snr + rssi
@@ -275,7 +454,8 @@ class LoRa(object):
                 header_from = packet[1]
                 header_id = packet[2]
                 header_flags = packet[3]
-                message = bytes(packet[4:]) if packet_len > 4 else b''
+                # the only copy, the receive buffer is reused for the next packet
+                message = bytes(packet[4:packet_len]) if packet_len > 4 else b''
 
                 # for i in range(0,packet_len):
                 #     print(hex(packet[i]))
@@ -291,15 +471,17 @@ class LoRa(object):
 
                 self.set_mode_rx()
 
-                self._last_payload = namedtuple(
-                    "Payload",
-                    ['message', 'header_to', 'header_from', 'header_id', 'header_flags', 'rssi', 'snr']
-                )(message, header_to, header_from, header_id, header_flags, rssi, snr)
+                self._last_payload = Payload(message, header_to, header_from, header_id, header_flags, rssi, snr)
 
                 if not header_flags & Definitions.FLAGS_ACK:
                     self.on_recv(self._last_payload)
+                else:
+                    self._signal_ack(self._last_payload)
+                    self.on_ack(self._last_payload)
+            # IRQ flags were already cleared after the FIFO read
+            return
 
-        elif self._mode == Definitions.MODE_TX and (irq_flags & Definitions.TX_DONE):
+        if self._mode == Definitions.MODE_TX and (irq_flags & Definitions.TX_DONE):
             self.set_mode_idle()
 
         elif self._mode == Definitions.MODE_CAD and (irq_flags & Definitions.CAD_DONE):
@@ -327,11 +509,15 @@ class LoRa(object):
 
     def crc_error(self):
         """crc status. Taken from PyCubed Repo by Max Holliday"""
-        error = (self._spi_read(Definitions.REG_12_IRQ_FLAGS) & 0x20) >> 5
+        return self._crc_error(self._spi_read(Definitions.REG_12_IRQ_FLAGS))
+
+    def _crc_error(self, irq_flags):
+        error = (irq_flags & Definitions.PAYLOAD_CRC_ERROR) >> 5
 
         if (error == 1):
-            print("CRC Error!")
+            logger.warning("CRC Error!")
             self.crc_error_count += 1
+            self._crc_error_metric.inc()
         return error
 
     def close(self):
@@ -0,0 +1,110 @@
+import asyncio
+import logging
+import signal
+from concurrent.futures import ThreadPoolExecutor
+
+from lib.radio_utils import unpack_header, unpack_message
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncGroundStation:
+    """asyncio version of the main.py receive loop.
+
+    The radio interrupt thread hands packets to the event loop with
+    call_soon_threadsafe. Decoding and database upload run as separate tasks
+    joined by queues, and database calls are made on a single worker thread
+    so they never block the loop. SIGINT puts the radio to sleep, waits for
+    everything already received to be uploaded, then closes the database
+    and the radio.
+    """
+
+    def __init__(self, radio, database, rx_ctrl=None, queue_size=256) -> None:
+        self.radio = radio
+        self.database = database
+        self.rx_ctrl = rx_ctrl
+        self.queue_size = queue_size
+
+        self.dropped_count = 0
+        self._loop = None
+        self._packets = None
+        self._decoded = None
+        self._stopping = None
+        # one worker keeps uploads in order and off the event loop
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-upload")
+
+    def stop(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._stopping.set)
+
+    async def run(self):
+        self._loop = asyncio.get_running_loop()
+        self._packets = asyncio.Queue(self.queue_size)
+        self._decoded = asyncio.Queue()
+        self._stopping = asyncio.Event()
+
+        try:
+            self._loop.add_signal_handler(signal.SIGINT, self._stopping.set)
+        except (NotImplementedError, RuntimeError):
+            # not on the main thread or not supported, rely on stop()
+            pass
+
+        self.radio.on_recv = self._on_recv
+        if self.rx_ctrl is not None:
+            self.rx_ctrl.on()
+        self.radio.set_mode_rx()
+
+        tasks = [asyncio.create_task(self._decode()), asyncio.create_task(self._upload())]
+        await self._stopping.wait()
+
+        # stop receiving, then let packets already handed to the loop reach the queue
+        self.radio.sleep()
+        self.radio.on_recv = lambda payload: None
+        await asyncio.sleep(0)
+        logger.info("shutting down, draining %d packets", self._packets.qsize() + self._decoded.qsize())
+        await self._packets.join()
+        await self._decoded.join()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        await self._loop.run_in_executor(self._executor, self.database.close)
+        self._executor.shutdown()
+        if self.rx_ctrl is not None:
+            self.rx_ctrl.off()
+        self.radio.close()
+
+    def _on_recv(self, payload):
+        # called on the radio interrupt thread
+        self._loop.call_soon_threadsafe(self._enqueue, payload)
+
+    def _enqueue(self, payload):
+        try:
+            self._packets.put_nowait(payload)
+        except asyncio.QueueFull:
+            self.dropped_count += 1
+            logger.warning("packet queue full, dropped %d packets so far", self.dropped_count)
+
+    async def _decode(self):
+        while True:
+            payload = await self._packets.get()
+            try:
+                res = unpack_message(payload)
+                if res is not None:
+                    self._decoded.put_nowait((res, payload))
+            except Exception as e:
+                logger.error("could not decode packet: %s", e)
+            finally:
+                self._packets.task_done()
+
+    async def _upload(self):
+        while True:
+            (msg_id, time, data), payload = await self._decoded.get()
+            try:
+                await self._loop.run_in_executor(self._executor, self.database.upload_data, msg_id, time, data,
+                                                 payload.received_at, payload.rssi, payload.snr,
+                                                 unpack_header(payload)[2])
+            except Exception as e:
+                logger.error("could not upload heartbeat: %s", e)
+            finally:
+                self._decoded.task_done()
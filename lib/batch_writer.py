@@ -0,0 +1,79 @@
+import threading
+
+
+class BatchWriter:
+    """Accumulates rows per table and hands them to write_batch in bulk.
+
+    Rows are written from a background thread once batch_size rows are
+    pending or flush_interval seconds have passed, whichever comes first,
+    so callers never wait on a database round trip. write_batch receives a
+    dict mapping table name to a list of rows.
+    """
+
+    def __init__(self, write_batch, batch_size=50, flush_interval=1.0) -> None:
+        self._write_batch = write_batch
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self._rows = {}
+        self._pending = 0
+        self._closed = False
+        self._interval_changed = False
+        self._cond = threading.Condition()
+        # write_batch is only ever called by one thread at a time
+        self._write_lock = threading.Lock()
+
+        self._thread = threading.Thread(target=self._run, name="batch-writer", daemon=True)
+        self._thread.start()
+
+    def __len__(self):
+        return self._pending
+
+    def add(self, table, row):
+        with self._cond:
+            self._rows.setdefault(table, []).append(row)
+            self._pending += 1
+            if self._pending >= self.batch_size:
+                self._cond.notify()
+
+    def flush(self):
+        """Write everything pending from the calling thread."""
+        with self._write_lock:
+            batch = self._take()
+            if batch:
+                self._write_batch(batch)
+
+    def set_flush_interval(self, flush_interval):
+        """Change the time trigger, None waits for a full batch."""
+        with self._cond:
+            self.flush_interval = flush_interval
+            self._interval_changed = True
+            self._cond.notify()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+        self.flush()
+
+    def _take(self):
+        with self._cond:
+            batch = self._rows
+            self._rows = {}
+            self._pending = 0
+        return batch
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._closed or self._interval_changed or
+                                    self._pending >= self.batch_size,
+                                    self.flush_interval)
+                if self._closed:
+                    return
+                if self._interval_changed:
+                    # start waiting again with the new interval
+                    self._interval_changed = False
+                    continue
+            self.flush()
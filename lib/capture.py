@@ -0,0 +1,218 @@
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+from lib.argus_lora import Payload
+from lib.radio_utils import unpack_header, unpack_message
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"ARGUSCAP"
+VERSION = 2
+
+# magic, version, frame header size, unix time the capture was created
+_FILE_HEADER = struct.Struct("<8sHHd")
+# payload length, crc32 of the rest of the frame
+_FRAME_PREFIX = struct.Struct("<HI")
+# received_at, rssi, snr, RadioHead to/from/id/flags
+_FRAME_META = struct.Struct("<dffBBBB")
+_FRAME_HEADER_SIZE = _FRAME_PREFIX.size + _FRAME_META.size
+# version 1 frames had no crc
+_FRAME_HEADER_V1 = struct.Struct("<HdffBBBB")
+
+
+class CaptureWriter:
+    """Appends every received frame to a capture file.
+
+    Pass as RadioHead(capture=...) to record raw frames from the receive
+    path. The file starts with a fixed header and then holds one frame per
+    packet: a fixed frame header (length, receive time, RSSI, SNR and the
+    RadioHead header bytes, checksummed with the payload) followed by the
+    payload. Writes are buffered, flush() or close() pushes them to disk.
+    Reopening an existing capture appends to it, after cutting off a frame
+    torn by a crash.
+    """
+
+    def __init__(self, path) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, "a+b")
+        try:
+            self._recover()
+        except Exception:
+            self._file.close()
+            raise
+        self.frame_count = 0
+
+    def _recover(self):
+        size = os.fstat(self._file.fileno()).st_size
+        if size < _FILE_HEADER.size:
+            if size:
+                logger.warning("%s has a torn file header, starting it over", self.path)
+                self._file.truncate(0)
+            self._file.write(_FILE_HEADER.pack(MAGIC, VERSION, _FRAME_HEADER_SIZE, time.time()))
+            return
+        with CaptureReader(self.path) as reader:
+            if reader.version != VERSION:
+                raise ValueError(f"{self.path} is capture version {reader.version}, "
+                                 f"start a new file to write version {VERSION}")
+            for _ in reader:
+                pass
+            end = reader.end
+        if end < size:
+            logger.warning("dropping %d bytes of torn frames from the end of %s", size - end, self.path)
+            self._file.truncate(end)
+            os.fsync(self._file.fileno())
+
+    def write(self, payload):
+        message = payload.message
+        meta = _FRAME_META.pack(payload.received_at, payload.rssi, payload.snr, payload.header_to,
+                                payload.header_from, payload.header_id, payload.header_flags)
+        prefix = _FRAME_PREFIX.pack(len(message), zlib.crc32(message, zlib.crc32(meta)))
+        with self._lock:
+            self._file.write(prefix)
+            self._file.write(meta)
+            self._file.write(message)
+            self.frame_count += 1
+
+    def flush(self):
+        with self._lock:
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class CaptureReader:
+    """Memory-mapped iterator over the frames of a capture file.
+
+    Frames are yielded as Payload objects whose message is a memoryview
+    into the mapping, so nothing is copied and they can go straight into
+    unpack_message. The views are only valid until close(), copy them
+    with bytes() to keep them longer. A frame cut short by a crash while
+    writing, or failing its checksum, ends the iteration; end is then the
+    offset just past the last good frame.
+    """
+
+    def __init__(self, path) -> None:
+        self.path = path
+        with open(path, "rb") as f:
+            _check_header(f.read(_FILE_HEADER.size), path)
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mmap)
+        _, self.version, self.frame_header_size, self.created_at = _FILE_HEADER.unpack_from(self._view)
+        self.end = _FILE_HEADER.size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def __iter__(self):
+        if self.version == 1:
+            yield from self._iter_v1()
+            return
+        view = self._view
+        end = len(view)
+        offset = _FILE_HEADER.size
+        # frame headers of newer versions may grow, skip what we don't know
+        frame_header_size = self.frame_header_size
+        while offset + frame_header_size <= end:
+            length, crc = _FRAME_PREFIX.unpack_from(view, offset)
+            start = offset + frame_header_size
+            frame_end = start + length
+            if frame_end > end:
+                logger.warning("%s ends in a truncated frame", self.path)
+                return
+            # covers everything after the prefix, so unknown header fields too
+            if zlib.crc32(view[offset + _FRAME_PREFIX.size:frame_end]) != crc:
+                logger.warning("%s has a corrupt frame at offset %d", self.path, offset)
+                return
+            received_at, rssi, snr, header_to, header_from, header_id, header_flags = \
+                _FRAME_META.unpack_from(view, offset + _FRAME_PREFIX.size)
+            offset = self.end = frame_end
+            yield Payload(view[start:frame_end], header_to, header_from, header_id, header_flags,
+                          rssi, snr, received_at)
+        if offset < end:
+            logger.warning("%s ends in a truncated frame", self.path)
+
+    def _iter_v1(self):
+        view = self._view
+        end = len(view)
+        offset = _FILE_HEADER.size
+        while offset + self.frame_header_size <= end:
+            length, received_at, rssi, snr, header_to, header_from, header_id, header_flags = \
+                _FRAME_HEADER_V1.unpack_from(view, offset)
+            start = offset + self.frame_header_size
+            offset = start + length
+            if offset > end:
+                logger.warning("%s ends in a truncated frame", self.path)
+                return
+            self.end = offset
+            yield Payload(view[start:offset], header_to, header_from, header_id, header_flags,
+                          rssi, snr, received_at)
+
+    def close(self):
+        self._view.release()
+        try:
+            self._mmap.close()
+        except BufferError:
+            # frames are still referenced, the mapping goes when they do
+            pass
+
+
+def _check_header(header, path):
+    if len(header) < _FILE_HEADER.size:
+        raise ValueError(f"{path} is not a capture file")
+    magic, version, frame_header_size, _ = _FILE_HEADER.unpack(header)
+    if magic != MAGIC:
+        raise ValueError(f"{path} is not a capture file")
+    min_frame_header_size = _FRAME_HEADER_V1.size if version == 1 else _FRAME_HEADER_SIZE
+    if version > VERSION or frame_header_size < min_frame_header_size:
+        raise ValueError(f"{path} is capture version {version}, this reader understands {VERSION}")
+
+
+def replay_captures(paths, database, batch_size=500, dedup=None):
+    """
+    :param paths: capture files, replayed in order
+    :param database: Database with make_row and write_rows
+    :param batch_size: frames per write_rows call
+    :param dedup: optional DedupIndex dropping repeated heartbeats
+    :return: number of frames replayed
+
+    Decode every captured frame with unpack_message and write the rows to
+    the database in bulk.
+    """
+    count = 0
+    batch = {}
+    pending = 0
+    for path in paths:
+        with CaptureReader(path) as reader:
+            for payload in reader:
+                count += 1
+                if dedup is not None and not dedup.add_message(payload):
+                    continue
+                res = unpack_message(payload)
+                if res is None:
+                    continue
+                row = database.make_row(*res, payload.received_at, payload.rssi, payload.snr,
+                                        sequence_count=unpack_header(payload)[2])
+                if row is None:
+                    continue
+                table, values = row
+                batch.setdefault(table, []).append(values)
+                pending += 1
+                if pending >= batch_size:
+                    database.write_rows(batch)
+                    batch = {}
+                    pending = 0
+    if batch:
+        database.write_rows(batch)
+    return count
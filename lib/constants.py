@@ -24,8 +24,11 @@ class Message_IDS:
 
     SAT_IMG_INFO = 0x21
     SAT_DEL_IMG = 0x22
+    SAT_IMG_CHUNK = 0x23
+    GS_IMG_NACK = 0x24
 
     GS_STOP = 0x30
+    GS_MODEM_CONFIG = 0x31
 
     SAT_IMG_CMD = 0x50
 
@@ -34,6 +37,10 @@ class Message_IDS:
 
 class Definitions:
     FLAGS_ACK = 0x80
+    FLAGS_RETRY = 0x40
+    # RadioHead reserves the upper 4 flag bits, the lower 4 are left to applications.
+    # Asks the receiver of a reliable window for an ack (see lib.reliable)
+    FLAGS_POLL = 0x01
     BROADCAST_ADDRESS = 255
 
     REG_00_FIFO = 0x00
@@ -53,11 +60,13 @@ class Definitions:
     REG_20_PREAMBLE_MSB = 0x20
     REG_21_PREAMBLE_LSB = 0x21
     REG_22_PAYLOAD_LENGTH = 0x22
+    REG_25_FIFO_RX_BYTE_ADDR = 0x25
     REG_26_MODEM_CONFIG3 = 0x26
 
     REG_4D_PA_DAC = 0x4d
     REG_40_DIO_MAPPING1 = 0x40
     REG_0D_FIFO_ADDR_PTR = 0x0d
+    REG_42_VERSION = 0x42
 
     PA_DAC_ENABLE = 0x07
     PA_DAC_DISABLE = 0x04
@@ -65,6 +74,8 @@ class Definitions:
 
     CAD_DETECTED_MASK = 0x01
     RX_DONE = 0x40
+    PAYLOAD_CRC_ERROR = 0x20
+    VALID_HEADER = 0x10
     TX_DONE = 0x08
     CAD_DONE = 0x04
     CAD_DETECTED = 0x01
@@ -77,5 +88,10 @@ class Definitions:
     MODE_CAD = 0x07
 
     REG_09_PA_CONFIG = 0x09
+
+    # signal bandwidth in Hz for RegModemConfig1 bits 7-4
+    BANDWIDTHS = (7800, 10400, 15600, 20800, 31250, 41700, 62500, 125000, 250000, 500000)
+    # lowest SNR in dB the demodulator decodes at, per spreading factor
+    DEMOD_SNR_LIMIT = {6: -5.0, 7: -7.5, 8: -10.0, 9: -12.5, 10: -15.0, 11: -17.5, 12: -20.0}
     FXOSC = 32000000.0
     FSTEP = (FXOSC / 524288)
@@ -0,0 +1,82 @@
+import threading
+import time
+from collections import OrderedDict
+
+from lib.metrics import REGISTRY
+from lib.radio_utils import HEARTBEAT_DATA_OFFSET, HEARTBEAT_LAYOUTS, unpack_header
+
+_DUPLICATES = REGISTRY.counter("heartbeats_duplicate_total", "Heartbeats dropped as already received")
+
+
+def message_key(msg):
+    """
+    :param msg: received Payload
+    :return: (message_ID, sequence count, satellite time) identifying a
+             heartbeat, or None for other messages and short packets
+    """
+    message = msg.message
+    if len(message) < HEARTBEAT_DATA_OFFSET:
+        return None
+    _, msg_id, sequence_count, _ = unpack_header(msg)
+    layout = HEARTBEAT_LAYOUTS.get(msg_id)
+    if layout is None:
+        return None
+    end = HEARTBEAT_DATA_OFFSET + layout.struct.size
+    if len(message) < end:
+        return None
+    # satellite time is the last word of every heartbeat
+    return msg_id, sequence_count, int.from_bytes(message[end - 4:end], "big")
+
+
+class DedupIndex:
+    """Recently seen heartbeat keys, to drop retransmits before the database.
+
+    Holds at most maxlen keys and forgets each one ttl seconds after it was
+    first seen, oldest first, so lookups and inserts are O(1) and memory is
+    bounded however long the station runs. Duplicates older than that are
+    left to the database unique constraints.
+    """
+
+    def __init__(self, maxlen=4096, ttl=900.0, clock=time.monotonic) -> None:
+        self.maxlen = maxlen
+        self.ttl = ttl
+        self.clock = clock
+
+        # key -> time first seen, in insertion order
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+        self.duplicate_count = 0
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def add(self, key):
+        """Remember key, returns False if it was already seen."""
+        now = self.clock()
+        with self._lock:
+            self._expire(now)
+            if key in self._keys:
+                self.duplicate_count += 1
+                _DUPLICATES.inc()
+                return False
+            self._keys[key] = now
+            if len(self._keys) > self.maxlen:
+                self._keys.popitem(last=False)
+            return True
+
+    def add_message(self, msg):
+        """add() for a received Payload, messages without a key always pass."""
+        key = message_key(msg)
+        return key is None or self.add(key)
+
+    def _expire(self, now):
+        keys = self._keys
+        deadline = now - self.ttl
+        while keys:
+            key, seen = next(iter(keys.items()))
+            if seen > deadline:
+                break
+            keys.popitem(last=False)
@@ -0,0 +1,345 @@
+import logging
+import mmap
+import os
+import struct
+import time
+import zlib
+
+from lib.constants import Message_IDS
+from lib.metrics import REGISTRY
+from lib.radio_utils import _HEADER
+
+logger = logging.getLogger(__name__)
+
+# SAT_IMG_INFO: image id, file size, chunk size, crc32 of the whole file
+_INFO = struct.Struct(">HIHI")
+# SAT_IMG_CHUNK: image id then the chunk bytes, the sequence count is the chunk index
+# GS_IMG_NACK: image id then a bitmap of missing chunks, the sequence count is the first chunk it covers
+_IMAGE_ID = struct.Struct(">H")
+
+# largest chunk that fits a LoRa packet after the RadioHead, message and image id headers
+MAX_CHUNK_SIZE = 255 - 4 - _HEADER.size - _IMAGE_ID.size
+# a NACK asks for at most 8 * NACK_BITMAP_BYTES chunks
+NACK_BITMAP_BYTES = 64
+# chunk indices and the chunk count of a complete NACK travel in the 16 bit sequence count
+MAX_CHUNKS = 0xffff
+
+# state file next to the partial image: magic, image id, size, chunk size, crc32, then one bit per chunk received
+_STATE_MAGIC = b"ARGUSIMG"
+_STATE_HEADER = struct.Struct("<8sHIHI")
+
+_INVERT = bytes(0xff - i for i in range(256))
+
+_CHUNKS = REGISTRY.counter("file_chunks_received_total", "Image chunks written")
+_REJECTED_CHUNKS = REGISTRY.counter("file_chunks_rejected_total", "Image chunks received again or malformed")
+_NACKS = REGISTRY.counter("file_nacks_sent_total", "Missing chunk requests sent")
+_COMPLETED = REGISTRY.counter("files_completed_total", "Images received and verified")
+
+
+def pack_info(image_id, size, chunk_size, crc):
+    return _HEADER.pack(Message_IDS.SAT_IMG_INFO, 0, _INFO.size) + _INFO.pack(image_id, size, chunk_size, crc)
+
+
+def pack_chunk(image_id, index, data):
+    return _HEADER.pack(Message_IDS.SAT_IMG_CHUNK, index, _IMAGE_ID.size + len(data)) + \
+        _IMAGE_ID.pack(image_id) + bytes(data)
+
+
+def pack_nack(image_id, first, bitmap):
+    return _HEADER.pack(Message_IDS.GS_IMG_NACK, first, _IMAGE_ID.size + len(bitmap)) + \
+        _IMAGE_ID.pack(image_id) + bytes(bitmap)
+
+
+def unpack_nack(message):
+    """
+    :param message: GS_IMG_NACK message
+    :return: (image id, chunk indices asked for), no indices once the image is complete
+    """
+    _, first, _ = _HEADER.unpack_from(message)
+    (image_id,) = _IMAGE_ID.unpack_from(message, _HEADER.size)
+    bitmap = message[_HEADER.size + _IMAGE_ID.size:]
+    return image_id, [first + i * 8 + bit for i, byte in enumerate(bitmap) for bit in range(8) if byte >> bit & 1]
+
+
+class Transfer:
+    """One image being received, kept on disk so it survives between passes.
+
+    Chunks are written straight into directory/image_<id>.bin.part, mapped
+    into memory at its full size up front, and a bitmap of the chunks
+    received so far is kept in memory. flush(), called with every NACK,
+    syncs the chunk data and only then writes the bitmap to the .state
+    file next to it, so a bit that reached the disk always stands for data
+    that did. A crash loses at most the chunks since the last NACK. Opening
+    a transfer with the same id, size, chunk size and crc picks up from the
+    bitmap on disk, anything else starts the image over. finish() checks
+    the crc and renames the part file to image_<id>.bin.
+    """
+
+    def __init__(self, directory, image_id, size, chunk_size, crc) -> None:
+        if not 0 < chunk_size <= MAX_CHUNK_SIZE:
+            raise ValueError(f"chunk size {chunk_size} does not fit a packet")
+        self.chunk_count = -(-size // chunk_size)
+        if self.chunk_count > MAX_CHUNKS:
+            raise ValueError(f"{self.chunk_count} chunks of {chunk_size} bytes, at most {MAX_CHUNKS} can be numbered")
+        self.image_id = image_id
+        self.size = size
+        self.chunk_size = chunk_size
+        self.crc = crc
+        self.path = os.path.join(directory, f"image_{image_id}.bin")
+        self.part_path = self.path + ".part"
+        self.state_path = self.path + ".state"
+
+        header = _STATE_HEADER.pack(_STATE_MAGIC, image_id, size, chunk_size, crc)
+        state_size = _STATE_HEADER.size + (self.chunk_count + 7) // 8
+        resumed = False
+        try:
+            with open(self.state_path, "rb") as f:
+                resumed = f.read(_STATE_HEADER.size) == header and os.fstat(f.fileno()).st_size == state_size
+        except FileNotFoundError:
+            pass
+        if not resumed:
+            bitmap = bytearray((self.chunk_count + 7) // 8)
+            if self.chunk_count % 8:
+                # padding bits past the last chunk count as received
+                bitmap[-1] = 0xff << (self.chunk_count % 8) & 0xff
+            with open(self.state_path, "wb") as f:
+                f.write(header + bitmap)
+            with open(self.part_path, "wb"):
+                pass
+
+        self._data_file = open(self.part_path, "r+b")
+        self._data_file.truncate(size)
+        self._state_file = open(self.state_path, "r+b")
+        self._data = mmap.mmap(self._data_file.fileno(), size) if size else None
+        # not mapped, the kernel could write a bit back before the chunk it stands for
+        self._bitmap = bytearray(os.pread(self._state_file.fileno(), state_size, 0)[_STATE_HEADER.size:])
+        padding = len(self._bitmap) * 8 - self.chunk_count
+        self.received_count = sum(bin(b).count("1") for b in self._bitmap) - padding
+        if resumed:
+            logger.info("resuming image %d, %d of %d chunks already received",
+                        image_id, self.received_count, self.chunk_count)
+
+    def matches(self, image_id, size, chunk_size, crc):
+        return (image_id, size, chunk_size, crc) == (self.image_id, self.size, self.chunk_size, self.crc)
+
+    @property
+    def complete(self):
+        return self.received_count == self.chunk_count
+
+    def has_chunk(self, index):
+        return self._bitmap[index >> 3] >> (index & 7) & 1
+
+    def write_chunk(self, index, data):
+        """Store a chunk, returns False for duplicates and chunks that don't belong to the image."""
+        start = index * self.chunk_size
+        if index >= self.chunk_count or len(data) != min(self.chunk_size, self.size - start):
+            logger.warning("image %d: chunk %d has the wrong length %d", self.image_id, index, len(data))
+            return False
+        if self.has_chunk(index):
+            return False
+        self._data[start:start + len(data)] = data
+        self._bitmap[index >> 3] |= 1 << (index & 7)
+        self.received_count += 1
+        return True
+
+    def first_missing(self):
+        """Index of the first chunk not received, chunk_count when complete."""
+        bitmap = bytes(self._bitmap)
+        index = len(bitmap) - len(bitmap.lstrip(b"\xff"))
+        if index == len(bitmap):
+            return self.chunk_count
+        byte = bitmap[index]
+        return index * 8 + ((~byte & (byte + 1)).bit_length() - 1)
+
+    def missing_bitmap(self):
+        """
+        :return: (first chunk, bitmap of missing chunks from there), at most
+                 NACK_BITMAP_BYTES long, (chunk_count, b"") when complete
+        """
+        first = self.first_missing()
+        if first == self.chunk_count:
+            return first, b""
+        start = first >> 3
+        missing = bytes(self._bitmap[start:start + NACK_BITMAP_BYTES]).translate(_INVERT).rstrip(b"\x00")
+        return start * 8, missing
+
+    def flush(self):
+        # data first, the bitmap on disk must never get ahead of it
+        if self._data is not None:
+            self._data.flush()
+        os.pwrite(self._state_file.fileno(), self._bitmap, _STATE_HEADER.size)
+        os.fsync(self._state_file.fileno())
+
+    def finish(self):
+        """Verify the crc and move the image into place, returns its path or None if it didn't match."""
+        crc = zlib.crc32(self._data) if self._data is not None else 0
+        if crc != self.crc:
+            logger.error("image %d failed its crc check, receiving it again", self.image_id)
+            self._bitmap[:] = bytes(len(self._bitmap))
+            if self.chunk_count % 8:
+                self._bitmap[-1] = 0xff << (self.chunk_count % 8) & 0xff
+            self.received_count = 0
+            return None
+        self.close()
+        os.replace(self.part_path, self.path)
+        os.remove(self.state_path)
+        return self.path
+
+    def close(self):
+        if self._state_file.closed:
+            return
+        self.flush()
+        if self._data is not None:
+            self._data.close()
+        self._data_file.close()
+        self._state_file.close()
+
+
+class FileReceiver:
+    """Receives images downlinked in chunks over a LoRa radio.
+
+    The satellite announces an image with SAT_IMG_INFO and the receiver
+    answers with a GS_IMG_NACK: a bitmap of the chunks it still needs from
+    the first missing one on, 8 * NACK_BITMAP_BYTES chunks at most. The
+    satellite sends those as SAT_IMG_CHUNK messages, whose sequence count is
+    the chunk index, and once the last chunk asked for arrives, or nothing
+    has arrived for nack_timeout seconds, the next NACK goes out. A NACK with
+    an empty bitmap tells the satellite the image is complete.
+
+    Feed every received Payload to handle(), it returns True for the
+    messages it consumed, and call poll() at least every poll_timeout()
+    seconds so timeouts fire on time. After
+    max_nacks NACKs without an answer the transfer is closed, its bitmap
+    stays on disk and the next SAT_IMG_INFO for the image resumes it.
+    """
+
+    def __init__(self, directory, radio, nack_timeout=2.0, max_nacks=5, clock=time.monotonic) -> None:
+        self.directory = directory
+        self.radio = radio
+        self.nack_timeout = nack_timeout
+        self.max_nacks = max_nacks
+        self.clock = clock
+        os.makedirs(directory, exist_ok=True)
+
+        self.transfer = None
+        self._peer = None
+        # last chunk index the previous NACK asked for
+        self._window_end = -1
+        self._last_activity = clock()
+        self._unanswered = 0
+        self.completed = []
+
+    def handle(self, payload):
+        message = payload.message
+        if len(message) < _HEADER.size:
+            return False
+        id_byte, index, _ = _HEADER.unpack_from(message)
+        msg_id = id_byte & 0x7f
+        try:
+            if msg_id == Message_IDS.SAT_IMG_INFO:
+                self._on_info(payload.header_from, *_INFO.unpack_from(message, _HEADER.size))
+                return True
+            if msg_id == Message_IDS.SAT_IMG_CHUNK:
+                (image_id,) = _IMAGE_ID.unpack_from(message, _HEADER.size)
+                self._on_chunk(image_id, index, message[_HEADER.size + _IMAGE_ID.size:])
+                return True
+        except struct.error as e:
+            logger.warning("could not decode file transfer message: %s", e)
+            return True
+        return False
+
+    def _on_info(self, peer, image_id, size, chunk_size, crc):
+        self._peer = peer
+        if self._already_received(image_id, size, crc):
+            # the satellite missed the NACK that acknowledged the whole image
+            self._send(pack_nack(image_id, -(-size // chunk_size), b""))
+            return
+        if self.transfer is None or not self.transfer.matches(image_id, size, chunk_size, crc):
+            self.close()
+            logger.info("receiving image %d, %d bytes in chunks of %d", image_id, size, chunk_size)
+            try:
+                self.transfer = Transfer(self.directory, image_id, size, chunk_size, crc)
+            except ValueError as e:
+                logger.warning("not receiving image %d: %s", image_id, e)
+                return
+        self._unanswered = 0
+        self._check_complete()
+
+    def _on_chunk(self, image_id, index, data):
+        transfer = self.transfer
+        if transfer is None or transfer.image_id != image_id:
+            return
+        self._last_activity = self.clock()
+        self._unanswered = 0
+        if transfer.write_chunk(index, data):
+            _CHUNKS.inc()
+        else:
+            _REJECTED_CHUNKS.inc()
+        if transfer.complete:
+            self._check_complete()
+        elif index >= self._window_end:
+            # the satellite is done with the last window
+            self.send_nack()
+
+    def _already_received(self, image_id, size, crc):
+        path = os.path.join(self.directory, f"image_{image_id}.bin")
+        if not os.path.exists(path) or os.path.getsize(path) != size:
+            return False
+        with open(path, "rb") as f:
+            return zlib.crc32(f.read()) == crc
+
+    def _check_complete(self):
+        transfer = self.transfer
+        if transfer.complete:
+            path = transfer.finish()
+            if path is not None:
+                logger.info("image %d complete: %s", transfer.image_id, path)
+                _COMPLETED.inc()
+                self.completed.append(path)
+                self.transfer = None
+                # the empty bitmap acknowledges the whole image
+                self._send(pack_nack(transfer.image_id, transfer.chunk_count, b""))
+                return
+        self.send_nack()
+
+    def send_nack(self):
+        transfer = self.transfer
+        first, bitmap = transfer.missing_bitmap()
+        transfer.flush()
+        # the highest chunk asked for, its arrival ends the window
+        self._window_end = first + (len(bitmap) - 1) * 8 + bitmap[-1].bit_length() - 1
+        self._send(pack_nack(transfer.image_id, first, bitmap))
+
+    def _send(self, message):
+        self.radio.send(message, self._peer)
+        self.radio.wait_packet_sent()
+        self.radio.set_mode_rx()
+        self._last_activity = self.clock()
+        _NACKS.inc()
+
+    def poll_timeout(self, now=None):
+        """Seconds until poll() has a NACK to resend, None without a transfer."""
+        if self.transfer is None:
+            return None
+        now = self.clock() if now is None else now
+        return max(self._last_activity + self.nack_timeout - now, 0)
+
+    def poll(self, now=None):
+        """Resend the NACK after nack_timeout seconds of silence, give up after max_nacks."""
+        if self.transfer is None:
+            return
+        now = self.clock() if now is None else now
+        if now - self._last_activity < self.nack_timeout:
+            return
+        if self._unanswered >= self.max_nacks:
+            logger.info("image %d: no answer, keeping %d of %d chunks for the next pass", self.transfer.image_id,
+                        self.transfer.received_count, self.transfer.chunk_count)
+            self.close()
+            return
+        self._unanswered += 1
+        self.send_nack()
+
+    def close(self):
+        if self.transfer is not None:
+            self.transfer.close()
+            self.transfer = None
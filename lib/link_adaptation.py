@@ -0,0 +1,220 @@
+import logging
+import math
+import time
+from collections import deque
+
+from lib.argus_lora import ModemConfig
+from lib.constants import Definitions, Message_IDS
+from lib.metrics import REGISTRY
+from lib.radio_utils import _HEADER
+
+logger = logging.getLogger(__name__)
+
+
+def pack_modem_config(preset):
+    """GS_MODEM_CONFIG message: RegModemConfig1, 2 and 3 of the preset to switch to."""
+    return _HEADER.pack(Message_IDS.GS_MODEM_CONFIG, 0, len(preset.value)) + bytes(preset.value)
+
+
+def unpack_modem_config(message):
+    """
+    :param message: GS_MODEM_CONFIG message
+    :return: the ModemConfig preset it asks for
+    """
+    return ModemConfig(tuple(message[_HEADER.size:_HEADER.size + 3]))
+
+
+def bandwidth(preset):
+    return Definitions.BANDWIDTHS[preset.value[0] >> 4]
+
+
+def spreading_factor(preset):
+    return preset.value[1] >> 4
+
+
+def coding_rate(preset):
+    return 4 / (4 + ((preset.value[0] >> 1) & 0x07))
+
+
+def bitrate(preset):
+    """Raw LoRa bit rate of a ModemConfig preset in bits per second."""
+    sf = spreading_factor(preset)
+    return sf * bandwidth(preset) / (1 << sf) * coding_rate(preset)
+
+
+def airtime(preset, length, preamble=8):
+    """Seconds on air for a packet of length bytes with explicit header and CRC (SX1276 datasheet 4.1.1.7)."""
+    sf = spreading_factor(preset)
+    symbol_time = (1 << sf) / bandwidth(preset)
+    low_data_rate = 1 if symbol_time > 0.016 else 0
+    cr = (preset.value[0] >> 1) & 0x07
+    payload_symbols = 8 + max(math.ceil((8 * length - 4 * sf + 28 + 16) / (4 * (sf - 2 * low_data_rate))) * (cr + 4), 0)
+    return (preamble + 4.25 + payload_symbols) * symbol_time
+
+
+def required_snr(preset):
+    return Definitions.DEMOD_SNR_LIMIT[spreading_factor(preset)]
+
+
+class LinkAdapter:
+    """Picks the fastest ModemConfig preset the link can currently carry.
+
+    Feed every received packet to observe() and call check() when nothing
+    was received, both from the receive loop and never from on_recv: a
+    switch waits for the satellite's ACK, which the interrupt thread cannot
+    handle while it is blocked in on_recv. They raise RuntimeError there.
+    The controller keeps the SNR of the last window packets
+    and the CRC error rate over them, as counted by the radio. Once
+    min_dwell packets were seen on the current preset it predicts the SNR
+    each preset would get (the measured SNR rescaled by bandwidth) and
+    switches to the fastest one whose demodulator limit is still margin dB
+    below a pessimistic estimate (the 10th percentile). Moving to a faster
+    preset needs another hysteresis dB, and a CRC error rate above
+    per_threshold steps one preset towards robustness right away and keeps
+    the controller off the failed preset for backoff seconds.
+
+    The ground station cannot decode a preset the satellite is not
+    transmitting, so every switch is first sent to the satellite (the
+    sender of the last packet) as a GS_MODEM_CONFIG command with
+    request_preset(), on the current preset. The radio is only retuned once
+    the satellite acknowledged it. While off the starting preset the
+    current one is sent again every keepalive seconds. If nothing arrives
+    for silence_timeout seconds the link is gone and no command would get
+    through, so it falls back to the preset the radio started on without
+    one. The satellite is expected to do the same after silence_timeout
+    without hearing the ground, which also recovers a switch whose ACK was
+    lost.
+    """
+
+    def __init__(self, radio, presets=tuple(ModemConfig), window=32, per_threshold=0.1, margin=1.0,
+                 hysteresis=1.0, min_dwell=16, silence_timeout=30.0, backoff=60.0, keepalive=None,
+                 clock=time.time) -> None:
+        self.radio = radio
+        # where both ends start a pass and return to once the link is lost
+        self.initial = radio.modem_config
+        # fastest first
+        self.presets = sorted(set(presets) | {self.initial}, key=bitrate, reverse=True)
+        self.per_threshold = per_threshold
+        self.margin = margin
+        self.hysteresis = hysteresis
+        self.min_dwell = min_dwell
+        self.silence_timeout = silence_timeout
+        self.backoff = backoff
+        self.keepalive = silence_timeout / 2 if keepalive is None else keepalive
+        self.clock = clock
+        # address the commands go to, learnt from received packets
+        self.peer = None
+
+        self._snrs = deque(maxlen=window)
+        self._counts = deque(maxlen=window)
+        self._switched_at = clock()
+        self._last_packet = self._switched_at
+        self._last_command = self._switched_at
+        # preset -> time before which it is not tried again after too many errors
+        self._blocked_until = {}
+        self.switch_count = 0
+        self.refused_count = 0
+
+        labels = {"radio": str(radio.channel)}
+        self._switch_metric = REGISTRY.counter("link_preset_switches_total", "Modem config changes", labels)
+        self._refused_metric = REGISTRY.counter("link_preset_refusals_total",
+                                                "Modem config changes the satellite did not acknowledge", labels)
+        REGISTRY.gauge("link_bitrate", "Raw bit rate of the current modem config", labels,
+                       function=lambda: bitrate(self.radio.modem_config))
+
+    def predicted_snr(self, snr, preset):
+        """SNR measured on the current preset, rescaled to preset's bandwidth."""
+        return snr + 10 * math.log10(bandwidth(self.radio.modem_config) / bandwidth(preset))
+
+    def packet_error_rate(self):
+        if len(self._counts) < 2:
+            return 0.0
+        (received_0, errors_0), (received_1, errors_1) = self._counts[0], self._counts[-1]
+        errors = errors_1 - errors_0
+        total = received_1 - received_0 + errors
+        return errors / total if total else 0.0
+
+    def observe(self, payload):
+        """Account for a received packet, returns the new preset if it switched."""
+        self._check_thread()
+        # packets queued before the last switch were measured on the old preset
+        if payload.received_at < self._switched_at:
+            return None
+        self.peer = payload.header_from
+        self._last_packet = payload.received_at
+        self._snrs.append(payload.snr)
+        self._counts.append((self.radio.received_count, self.radio.crc_error_count))
+        if len(self._snrs) < self.min_dwell:
+            return None
+
+        current = self.radio.modem_config
+        index = self.presets.index(current)
+        if self.packet_error_rate() > self.per_threshold:
+            if index + 1 < len(self.presets):
+                self._blocked_until[current] = self.clock() + self.backoff
+                return self._switch(self.presets[index + 1], "packet error rate")
+            return None
+
+        now = self.clock()
+        snr = sorted(self._snrs)[len(self._snrs) // 10]
+        for i, preset in enumerate(self.presets):
+            if i < index and self._blocked_until.get(preset, 0) > now:
+                continue
+            headroom = self.predicted_snr(snr, preset) - required_snr(preset) - self.margin
+            if i < index:
+                headroom -= self.hysteresis
+            if headroom >= 0:
+                break
+        else:
+            preset = self.presets[-1]
+        if preset != current:
+            return self._switch(preset, f"SNR {snr:.1f} dB")
+        if current != self.initial and now - self._last_command >= self.keepalive:
+            # keeps the satellite from timing out back to the starting preset
+            self._last_command = now
+            self.request_preset(current)
+        return None
+
+    def check(self, now=None):
+        """Fall back to the starting preset after silence_timeout without packets."""
+        self._check_thread()
+        now = self.clock() if now is None else now
+        if self.radio.modem_config != self.initial and \
+                now - max(self._last_packet, self._switched_at) >= self.silence_timeout:
+            return self._switch(self.initial, "no packets", command=False)
+        return None
+
+    def _check_thread(self):
+        if self.radio.in_interrupt():
+            raise RuntimeError("LinkAdapter waits for ACKs, call it from the receive loop, not from on_recv")
+
+    def request_preset(self, preset):
+        """Ask the satellite to move to preset, returns True once it acknowledged.
+
+        Sent with send_to_wait on the current preset, the satellite switches
+        after its ACK is out.
+        """
+        if self.peer is None:
+            return False
+        return self.radio.send_to_wait(pack_modem_config(preset), self.peer)
+
+    def _switch(self, preset, reason, command=True):
+        current = self.radio.modem_config
+        if command:
+            self._last_command = self.clock()
+            if not self.request_preset(preset):
+                logger.warning("satellite did not acknowledge %s, staying on %s", preset.name, current.name)
+                self.refused_count += 1
+                self._refused_metric.inc()
+                # measure again before the next attempt
+                self._snrs.clear()
+                self._counts.clear()
+                return None
+        logger.info("switching modem config %s -> %s (%s)", current.name, preset.name, reason)
+        self.radio.set_modem_config(preset)
+        self._snrs.clear()
+        self._counts.clear()
+        self._switched_at = self.clock()
+        self.switch_count += 1
+        self._switch_metric.inc()
+        return preset
@@ -0,0 +1,208 @@
+import bisect
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# seconds, suits both packet handling and database round trips
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class Counter:
+    """Incremented with inc(), or pass function to read a running total kept elsewhere at scrape time."""
+
+    kind = "counter"
+
+    def __init__(self, name, help, labels, function=None) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.function = function
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self):
+        value = self.function() if self.function is not None else self.value
+        return [(self.name, self.labels, value)]
+
+
+class Gauge:
+    """Set directly, or pass function to read the value at scrape time."""
+
+    kind = "gauge"
+
+    def __init__(self, name, help, labels, function=None) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.function = function
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self):
+        value = self.function() if self.function is not None else self.value
+        return [(self.name, self.labels, value)]
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, labels, buckets=DEFAULT_BUCKETS) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(sorted(buckets))
+        # one count per bucket plus the +Inf bucket, not cumulative
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def time(self):
+        return _Timer(self)
+
+    def samples(self):
+        with self._lock:
+            counts = list(self.counts)
+            total = self.sum
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            samples.append((self.name + "_bucket", self.labels + (("le", le),), cumulative))
+        samples.append((self.name + "_sum", self.labels, total))
+        samples.append((self.name + "_count", self.labels, cumulative))
+        return samples
+
+
+class _Timer:
+    def __init__(self, histogram) -> None:
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+        return False
+
+
+class Registry:
+    def __init__(self) -> None:
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name, help="", labels=None, function=None):
+        counter = self._get_or_create(Counter, name, help, labels)
+        if function is not None:
+            counter.function = function
+        return counter
+
+    def gauge(self, name, help="", labels=None, function=None):
+        gauge = self._get_or_create(Gauge, name, help, labels)
+        if function is not None:
+            gauge.function = function
+        return gauge
+
+    def histogram(self, name, help="", labels=None, buckets=DEFAULT_BUCKETS):
+        return self._get_or_create(Histogram, name, help, labels, buckets)
+
+    def _get_or_create(self, cls, name, help, labels, *args):
+        labels = tuple(sorted((labels or {}).items()))
+        key = (name, labels)
+        with self._lock:
+            metric = self._metrics.get(key)
+            if metric is None:
+                metric = self._metrics[key] = cls(name, help, labels, *args)
+            elif not isinstance(metric, cls):
+                raise ValueError(f"metric {name} already registered as a {metric.kind}")
+        return metric
+
+    def render(self):
+        """Prometheus text exposition format."""
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda metric: (metric.name, metric.labels))
+        lines = []
+        described = set()
+        for metric in metrics:
+            if metric.name not in described:
+                described.add(metric.name)
+                lines.append(f"# HELP {metric.name} {metric.help}")
+                lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                if labels:
+                    label_text = ",".join(f'{key}="{label}"' for key, label in labels)
+                    lines.append(f"{name}{{{label_text}}} {value}")
+                else:
+                    lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        """Every sample as a flat dict, for writing to a file."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        snapshot = {}
+        for metric in metrics:
+            for name, labels, value in metric.samples():
+                if labels:
+                    name += "{" + ",".join(f"{key}={label}" for key, label in labels) + "}"
+                snapshot[name] = value
+        return snapshot
+
+
+REGISTRY = Registry()
+
+
+def start_http_server(port, addr="127.0.0.1", registry=REGISTRY):
+    """Serve registry.render() on http://addr:port/metrics from a daemon thread."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?", 1)[0] not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((addr, port), Handler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
+
+
+def start_snapshot_writer(path, interval=10.0, registry=REGISTRY):
+    """Rewrite path with a JSON snapshot every interval seconds from a daemon thread."""
+
+    def run():
+        while True:
+            time.sleep(interval)
+            snapshot = registry.snapshot()
+            snapshot["timestamp"] = time.time()
+            with open(path + ".tmp", "w") as f:
+                json.dump(snapshot, f, indent=1, sort_keys=True)
+            # atomic so readers never see a half written file
+            os.replace(path + ".tmp", path)
+
+    thread = threading.Thread(target=run, name="metrics-snapshot", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,178 @@
+import calendar
+import logging
+
+from lib.mysql_server_db import COLUMNS, METADATA_COLUMNS
+
+logger = logging.getLogger(__name__)
+
+COLUMN_TYPES = {
+    "time": "INT UNSIGNED NOT NULL",
+    # NULL for rows backfilled from tables that never stored it
+    "sequence_count": "SMALLINT UNSIGNED",
+    "received_at": "DOUBLE",
+    "rssi": "FLOAT",
+    "snr": "FLOAT",
+    "batt_soc": "INT",
+    "current": "INT",
+    "boot_count": "INT",
+}
+
+# monthly partitions created with a new table, (year, month) inclusive
+FIRST_MONTH = (2025, 1)
+LAST_MONTH = (2027, 12)
+
+
+def month_start(year, month):
+    """Unix time of the first second of a month, UTC."""
+    return calendar.timegm((year, month, 1, 0, 0, 0))
+
+
+def next_month(year, month):
+    return (year + 1, 1) if month == 12 else (year, month + 1)
+
+
+def months(first, last):
+    month = first
+    while month <= last:
+        yield month
+        month = next_month(*month)
+
+
+def month_partitions(first, last):
+    """One partition per month, each holding satellite times up to the start of the next."""
+    return [f"PARTITION p{year:04d}{month:02d} VALUES LESS THAN ({month_start(*next_month(year, month))})"
+            for year, month in months(first, last)]
+
+
+def create_table_sql(table, first=FIRST_MONTH, last=LAST_MONTH):
+    columns = ",\n    ".join(f"{column} {COLUMN_TYPES.get(column, 'FLOAT')}"
+                             for column in METADATA_COLUMNS + COLUMNS[table])
+    # the primary key clusters rows by time, id tells apart rows of the same second and
+    # needs an index of its own to be AUTO_INCREMENT. Every key holds time, the partitioning column.
+    # One row per (time, sequence_count), the satellite sends several heartbeats a second.
+    # Rows without a sequence count never collide, NULLs are distinct in a unique key
+    keys = ("PRIMARY KEY (time, id)", "KEY id (id)", "UNIQUE KEY heartbeat (time, sequence_count)")
+    partitions = ([f"PARTITION p_before VALUES LESS THAN ({month_start(*first)})"] +
+                  month_partitions(first, last) +
+                  ["PARTITION pmax VALUES LESS THAN MAXVALUE"])
+    return (f"CREATE TABLE {table} (\n    id BIGINT UNSIGNED NOT NULL AUTO_INCREMENT,\n    {columns},\n    " +
+            ",\n    ".join(keys) + "\n)\n"
+            "PARTITION BY RANGE (time) (\n    " + ",\n    ".join(partitions) + "\n)")
+
+
+def schema_sql(first=FIRST_MONTH, last=LAST_MONTH):
+    """Contents of db_setup.sql."""
+    return ("-- generated by lib.migration.schema_sql, move existing databases over with migrate_db.py\n"
+            "CREATE DATABASE heartbeats;\nuse heartbeats;\n" +
+            "".join(create_table_sql(table, first, last) + ";\n" for table in COLUMNS))
+
+
+def add_partitions(client, table, last):
+    """Split pmax into monthly partitions up to and including last, (year, month)."""
+    cursor = client.cursor()
+    cursor.execute("SELECT PARTITION_NAME FROM information_schema.PARTITIONS "
+                   "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND PARTITION_NAME LIKE 'p2%%'",
+                   (table,))
+    existing = sorted(name for (name,) in cursor.fetchall())
+    if not existing:
+        raise RuntimeError(f"{table} has no monthly partitions, migrate it first")
+    newest = existing[-1]
+    first = next_month(int(newest[1:5]), int(newest[5:7]))
+    if first > last:
+        return 0
+    partitions = month_partitions(first, last) + ["PARTITION pmax VALUES LESS THAN MAXVALUE"]
+    cursor.execute(f"ALTER TABLE {table} REORGANIZE PARTITION pmax INTO ({', '.join(partitions)})")
+    logger.info("%s: added partitions through %04d-%02d", table, *last)
+    return len(partitions) - 1
+
+
+def _table_exists(cursor, table):
+    cursor.execute("SELECT COUNT(*) FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s",
+                   (table,))
+    return cursor.fetchall()[0][0] > 0
+
+
+def _has_column(cursor, table, column):
+    cursor.execute("SELECT COUNT(*) FROM information_schema.COLUMNS "
+                   "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND COLUMN_NAME = %s", (table, column))
+    return cursor.fetchall()[0][0] > 0
+
+
+def _count(cursor, sql):
+    cursor.execute(sql)
+    return cursor.fetchall()[0][0]
+
+
+def migrate_table(client, table, chunk_size=10000):
+    """
+    :param client: mysql connection
+    :param table: sun, battery or imu
+    :param chunk_size: rows copied per transaction
+    :return: number of rows copied
+
+    Move a table created by the old schema to the partitioned one. The old
+    table is renamed to <table>_old and the new table is created right
+    after it. Inserts landing between the two statements fail and are
+    retried from the spool.
+
+    Old rows are then copied across in their original order, chunk_size
+    rows per transaction. Each old row is numbered by an added migration_id
+    column and the last copied one is checkpointed in schema_migration, so
+    an interrupted run picks up where it stopped. sequence_count,
+    received_at, rssi and snr are NULL for backfilled rows, so rows sharing
+    a time never collide and every one is copied. The copied count is
+    checked against the old table and any difference is logged.
+    """
+    cursor = client.cursor()
+    old = table + "_old"
+    if not _has_column(cursor, table, "received_at"):
+        if _table_exists(cursor, old):
+            raise RuntimeError(f"{old} already exists, rename or drop it first")
+        cursor.execute(f"RENAME TABLE {table} TO {old}")
+        cursor.execute(create_table_sql(table))
+        logger.info("%s: moved old rows to %s", table, old)
+    if not _table_exists(cursor, old):
+        logger.info("%s: nothing to migrate", table)
+        return 0
+
+    # the old tables have no key to page through, number their rows
+    if not _has_column(cursor, old, "migration_id"):
+        logger.info("%s: numbering the rows of %s", table, old)
+        cursor.execute(f"ALTER TABLE {old} ADD COLUMN migration_id BIGINT UNSIGNED AUTO_INCREMENT PRIMARY KEY")
+
+    cursor.execute("CREATE TABLE IF NOT EXISTS schema_migration (table_name VARCHAR(64) PRIMARY KEY, last_id BIGINT)")
+    cursor.execute("SELECT last_id FROM schema_migration WHERE table_name = %s", (table,))
+    progress = cursor.fetchall()
+    last_id = progress[0][0] if progress else 0
+
+    columns = ("time",) + COLUMNS[table]
+    select = f"SELECT migration_id, {', '.join(columns)} FROM {old} WHERE migration_id > %s ORDER BY migration_id LIMIT %s"
+    insert = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join(['%s'] * len(columns))})"
+    copied = _count(cursor, f"SELECT COUNT(*) FROM {old} WHERE migration_id <= {int(last_id)}")
+    while True:
+        cursor.execute(select, (last_id, chunk_size))
+        rows = cursor.fetchall()
+        if not rows:
+            break
+        cursor.executemany(insert, [row[1:] for row in rows])
+        last_id = rows[-1][0]
+        cursor.execute("REPLACE INTO schema_migration (table_name, last_id) VALUES (%s, %s)", (table, last_id))
+        client.commit()
+        copied += len(rows)
+        logger.info("%s: copied %d rows", table, copied)
+
+    total = _count(cursor, f"SELECT COUNT(*) FROM {old}")
+    shared = total - _count(cursor, f"SELECT COUNT(DISTINCT time) FROM {old}")
+    if copied != total:
+        logger.warning("%s: copied %d rows but %s has %d", table, copied, old, total)
+    else:
+        logger.info("%s: copied all %d rows, %d of them share a time with another row", table, total, shared)
+    return copied
+
+
+def drop_old_table(client, table):
+    cursor = client.cursor()
+    cursor.execute(f"DROP TABLE IF EXISTS {table}_old")
+    if _table_exists(cursor, "schema_migration"):
+        cursor.execute("DELETE FROM schema_migration WHERE table_name = %s", (table,))
+    client.commit()
@@ -1,65 +1,158 @@
+import logging
+
 from lib.passwords import CONNECTION_STRING
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 from pymongo.mongo_client import MongoClient
+from lib.batch_writer import BatchWriter
 from lib.constants import Message_IDS
+from lib.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+_DUPLICATE_KEY = 11000
+
+# one document per (satellite time, sequence count), duplicates are rejected by the server.
+# Documents stored before the sequence count was kept have none and stay out of the index,
+# a document with null there would collide with every other one of the same second
+_HEARTBEAT_KEY = [("time", 1), ("sequence_count", 1)]
+_HEARTBEAT_KEY_FILTER = {"sequence_count": {"$type": "int"}}
+
+
+FIELDS = {
+    Message_IDS.SAT_HEARTBEAT_SUN: ("sun", ("x", "y", "z")),
+    Message_IDS.SAT_HEARTBEAT_BATT: ("battery", ("battery_soc", "current", "boot_counter")),
+    Message_IDS.SAT_HEARTBEAT_IMU: ("imu", ("mag_x", "mag_y", "mag_z", "gyro_x", "gyro_y", "gyro_z")),
+}
 
 
 class Database:
-    def __init__(self) -> None:
+    def __init__(self, batch_size=50, flush_interval=1.0) -> None:
         self.client = MongoClient(CONNECTION_STRING)
 
-    def upload_data(self, type, time, data):
-        if type == Message_IDS.SAT_HEARTBEAT_SUN:
-            self.upload_sun(time, data)
-        elif type == Message_IDS.SAT_HEARTBEAT_IMU:
-            self.upload_imu(time, data)
-        elif type == Message_IDS.SAT_HEARTBEAT_BATT:
-            self.upload_batt(time, data)
+        # resolve the collections once instead of per heartbeat
+        database = self.client["heartbeats"]
+        self.collections = {
+            "sun": database["sun"],
+            "battery": database["battery"],
+            "imu": database["imu"],
+        }
+        # collections whose heartbeat key is in place, built on the first write that reaches the server
+        self._indexed = set()
+
+        # documents are queued here and inserted with insert_many off the radio thread,
+        # batch_size None leaves it out for callers that only use write_rows, like SpoolReplayer
+        self.writer = BatchWriter(self.write_batch, batch_size, flush_interval) if batch_size is not None else None
+
+        labels = {"backend": "mongo"}
+        self._write_metric = REGISTRY.histogram("db_write_seconds", "Time to write and commit one batch", labels)
+        self._rows_metric = REGISTRY.counter("db_rows_written_total", "Heartbeat rows committed", labels)
+        self._errors_metric = REGISTRY.counter("db_write_errors_total", "Batches that failed to commit", labels)
+        if self.writer is not None:
+            REGISTRY.gauge("db_rows_pending", "Heartbeat rows waiting for the next batch", labels,
+                           function=lambda: len(self.writer))
+
+    def make_row(self, type, time, data, received_at=None, rssi=None, snr=None, sequence_count=None):
+        """
+        :return: (collection, document) for a decoded heartbeat, or None for other message types
+        """
+        fields = FIELDS.get(type)
+        if fields is None:
+            return None
+        collection, names = fields
+        document = {"time": time}
+        if sequence_count is not None:
+            document["sequence_count"] = sequence_count
+        document.update(zip(names, data))
+        if received_at is not None:
+            document.update(received_at=received_at, rssi=rssi, snr=snr)
+        return collection, document
+
+    def upload_data(self, type, time, data, received_at=None, rssi=None, snr=None, sequence_count=None):
+        row = self.make_row(type, time, data, received_at, rssi, snr, sequence_count)
+        if row is None:
+            return
+        if self.writer is None:
+            self.write_batch({row[0]: [row[1]]})
+        else:
+            self.writer.add(*row)
 
     def upload_sun(self, time, data):
-        (sun_x, sun_y, sun_z) = data
-        upload = {
-            "time": time,
-            "x": sun_x,
-            "y": sun_y,
-            "z": sun_z,
-        }
-        try:
-            database = self.client["heartbeats"]
-            collection = database["sun"]
-            collection.insert_one(upload)
-        except Exception as e:
-            print(f"Could not upload sun heartbeat: {e}")
+        self.upload_data(Message_IDS.SAT_HEARTBEAT_SUN, time, data)
 
     def upload_batt(self, time, data):
-        (batt_soc, current, boot_count) = data
-        upload = {
-            "time": time,
-            "battery_soc": batt_soc,
-            "current": current,
-            "boot_counter": boot_count,
-        }
-        try:
-            database = self.client["heartbeats"]
-            collection = database['battery']
-            collection.insert_one(upload)
-        except Exception as e:
-            print(f"Could not upload battery heartbeat: {e}")
+        self.upload_data(Message_IDS.SAT_HEARTBEAT_BATT, time, data)
 
     def upload_imu(self, time, data):
-        (mag_x, mag_y, mag_z,
-         gyro_x, gyro_y, gyro_z) = data
-        upload = {
-            "time": time,
-            "mag_x": mag_x,
-            "mag_y": mag_y,
-            "mag_z": mag_z,
-            "gyro_x": gyro_x,
-            "gyro_y": gyro_y,
-            "gyro_z": gyro_z,
-        }
+        self.upload_data(Message_IDS.SAT_HEARTBEAT_IMU, time, data)
+
+    def _ensure_index(self, collection):
+        if collection in self._indexed:
+            return
+        documents = self.collections[collection]
+        for name, info in documents.index_information().items():
+            # heartbeats of one second share a time, a unique index on it alone rejects them
+            stale_time = info["key"] == _HEARTBEAT_KEY[:1] and info.get("unique")
+            stale_key = info["key"] == _HEARTBEAT_KEY and info.get("partialFilterExpression") != _HEARTBEAT_KEY_FILTER
+            if stale_time or stale_key:
+                documents.drop_index(name)
         try:
-            database = self.client["heartbeats"]
-            collection = database["imu"]
-            collection.insert_one(upload)
+            documents.create_index(_HEARTBEAT_KEY, unique=True, partialFilterExpression=_HEARTBEAT_KEY_FILTER)
+        except DuplicateKeyError:
+            # stored while no index enforced the key, keep the first copy of each heartbeat
+            removed = self._drop_duplicates(documents)
+            logger.warning("removed %d duplicate %s heartbeats to build the (time, sequence_count) index",
+                           removed, collection)
+            documents.create_index(_HEARTBEAT_KEY, unique=True, partialFilterExpression=_HEARTBEAT_KEY_FILTER)
+        self._indexed.add(collection)
+
+    def _drop_duplicates(self, documents):
+        groups = documents.aggregate([
+            {"$match": _HEARTBEAT_KEY_FILTER},
+            {"$sort": {"_id": 1}},
+            {"$group": {"_id": {"time": "$time", "sequence_count": "$sequence_count"},
+                        "ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+            {"$match": {"count": {"$gt": 1}}},
+        ], allowDiskUse=True)
+        extra = [doc_id for group in groups for doc_id in group["ids"][1:]]
+        if not extra:
+            return 0
+        return documents.delete_many({"_id": {"$in": extra}}).deleted_count
+
+    def write_rows(self, batch):
+        """Insert a {collection: documents} batch, raises if any collection failed."""
+        failed = None
+        for collection, documents in batch.items():
+            try:
+                self._ensure_index(collection)
+                # unordered so one bad document does not stop the rest of the batch
+                with self._write_metric.time():
+                    self.collections[collection].insert_many(documents, ordered=False)
+                self._rows_metric.inc(len(documents))
+            except BulkWriteError as e:
+                errors = e.details.get("writeErrors", [])
+                self._rows_metric.inc(e.details.get("nInserted", 0))
+                if any(error.get("code") != _DUPLICATE_KEY for error in errors) or e.details.get("writeConcernErrors"):
+                    self._errors_metric.inc()
+                    failed = e
+                else:
+                    logger.debug("skipped %d duplicate %s heartbeats", len(errors), collection)
+            except Exception as e:
+                self._errors_metric.inc()
+                failed = e
+        if failed is not None:
+            raise failed
+
+    def write_batch(self, batch):
+        try:
+            self.write_rows(batch)
         except Exception as e:
-            print(f"Could not upload imu heartbeat: {e}")
+            logger.error("Could not upload heartbeats: %s", e)
+
+    def flush(self):
+        if self.writer is not None:
+            self.writer.flush()
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.client.close()
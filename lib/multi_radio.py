@@ -0,0 +1,117 @@
+import logging
+import threading
+
+from lib.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+
+class LockedSpi:
+    """spidev SpiDev wrapper that holds a bus lock for every transfer.
+
+    Radios on different chip selects of one SPI bus each get their own
+    LockedSpi sharing the same lock, so a transfer to one chip can never
+    interleave with a transfer to another from a different interrupt thread.
+    """
+
+    def __init__(self, spi, lock) -> None:
+        self._spi = spi
+        self._lock = lock
+
+    @property
+    def max_speed_hz(self):
+        return self._spi.max_speed_hz
+
+    @max_speed_hz.setter
+    def max_speed_hz(self, value):
+        with self._lock:
+            self._spi.max_speed_hz = value
+
+    def open(self, bus, device):
+        with self._lock:
+            self._spi.open(bus, device)
+
+    def close(self):
+        with self._lock:
+            self._spi.close()
+
+    def xfer(self, data):
+        with self._lock:
+            return self._spi.xfer(data)
+
+    def xfer2(self, data):
+        with self._lock:
+            return self._spi.xfer2(data)
+
+
+class SharedSpiBus:
+    """Hands out LockedSpi devices that serialize access to one bus."""
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+
+    def device(self, spi=None):
+        if spi is None:
+            import spidev
+            spi = spidev.SpiDev()
+        return LockedSpi(spi, self.lock)
+
+
+class RadioGroup:
+    """Several LoRa radios receiving at once, behaving as a single radio.
+
+    Pass it to RadioHead in place of a LoRa: every radio's packets are
+    delivered to the one on_recv, so they all land in RadioHead's packet
+    queue and flow through the same ingest pipeline. Mode changes, sleep
+    and close apply to every radio. The radios can listen on different
+    frequencies or modem configs, give each a device from one SharedSpiBus
+    when they share the SPI bus.
+    """
+
+    def __init__(self, radios) -> None:
+        if not radios:
+            raise ValueError("a radio group needs at least one radio")
+        self.radios = list(radios)
+        self._on_recv = None
+        self._received_metrics = []
+        for radio in self.radios:
+            labels = {"radio": str(radio.channel)}
+            self._received_metrics.append(
+                REGISTRY.counter("radio_group_packets_total", "Packets delivered by each radio of the group", labels))
+        self.on_recv = self._default_on_recv
+
+    @property
+    def on_recv(self):
+        return self._on_recv
+
+    @on_recv.setter
+    def on_recv(self, callback):
+        self._on_recv = callback
+        for radio, metric in zip(self.radios, self._received_metrics):
+            radio.on_recv = self._forward(metric)
+
+    def _forward(self, metric):
+        def on_recv(payload):
+            metric.inc()
+            self._on_recv(payload)
+        return on_recv
+
+    def _default_on_recv(self, payload):
+        # This should be overridden by the user
+        logger.debug("Message received!")
+
+    def set_mode_rx(self):
+        for radio in self.radios:
+            radio.set_mode_rx()
+
+    def set_mode_idle(self):
+        for radio in self.radios:
+            radio.set_mode_idle()
+
+    def sleep(self):
+        for radio in self.radios:
+            radio.sleep()
+
+    def close(self):
+        for radio in self.radios:
+            radio.close()
@@ -1,10 +1,62 @@
+import logging
+
 import mysql.connector
+from lib.batch_writer import BatchWriter
 from lib.constants import Message_IDS
+from lib.metrics import REGISTRY
 from lib.passwords import DB_IP, DB_USER
 
+logger = logging.getLogger(__name__)
+
+
+TABLES = {
+    Message_IDS.SAT_HEARTBEAT_SUN: "sun",
+    Message_IDS.SAT_HEARTBEAT_BATT: "battery",
+    Message_IDS.SAT_HEARTBEAT_IMU: "imu",
+}
+
+# heartbeat columns of each table, after the metadata columns
+COLUMNS = {
+    "sun": ("x", "y", "z"),
+    "battery": ("batt_soc", "current", "boot_count"),
+    "imu": ("mag_x", "mag_y", "mag_z", "gyro_x", "gyro_y", "gyro_z"),
+}
+
+METADATA_COLUMNS = ("time", "sequence_count", "received_at", "rssi", "snr")
+
+
+def insert_sql(table, columns):
+    # a row already stored under the same (time, sequence_count) key is left as is,
+    # unlike INSERT IGNORE any other error still fails the batch
+    return "INSERT INTO {} ({}) VALUES ({}) ON DUPLICATE KEY UPDATE time=time".format(
+        table, ", ".join(columns), ", ".join(["%s"] * len(columns)))
+
+
+INSERT_SQL = {table: insert_sql(table, METADATA_COLUMNS + columns) for table, columns in COLUMNS.items()}
+
 
 class Database:
-    def __init__(self) -> None:
+    def __init__(self, batch_size=50, flush_interval=1.0) -> None:
+        self.client = None
+        self.cursor = None
+        # table -> (INSERT statement, indices of the row values it takes or None for all)
+        self._inserts = {table: (sql, None) for table, sql in INSERT_SQL.items()}
+        self.connect()
+
+        # rows are queued here and inserted with executemany off the radio thread,
+        # batch_size None leaves it out for callers that only use write_rows, like SpoolReplayer
+        self.writer = BatchWriter(self.write_batch, batch_size, flush_interval) if batch_size is not None else None
+
+        labels = {"backend": "mysql"}
+        self._write_metric = REGISTRY.histogram("db_write_seconds", "Time to write and commit one batch", labels)
+        self._rows_metric = REGISTRY.counter("db_rows_written_total", "Heartbeat rows committed", labels)
+        self._errors_metric = REGISTRY.counter("db_write_errors_total", "Batches that failed to commit", labels)
+        if self.writer is not None:
+            REGISTRY.gauge("db_rows_pending", "Heartbeat rows waiting for the next batch", labels,
+                           function=lambda: len(self.writer))
+
+    def connect(self):
+        """(Re)open the connection, returns False if the server is unreachable."""
         try:
             self.client = mysql.connector.connect(
                 host=DB_IP,
@@ -13,48 +65,97 @@ class Database:
                 database="heartbeats",
             )
             self.cursor = self.client.cursor()
+            self._check_schema()
+            return True
         except Exception as e:
-            print(f"could not connect to db: {e}")
-
-    def upload_data(self, type, time, data):
-        if type == Message_IDS.SAT_HEARTBEAT_SUN:
-            self.upload_sun(time, data)
-        elif type == Message_IDS.SAT_HEARTBEAT_IMU:
-            self.upload_imu(time, data)
-        elif type == Message_IDS.SAT_HEARTBEAT_BATT:
-            self.upload_batt(time, data)
-        try:
-            self.client.commit()
-        except Exception as e:
-            print(f"could not commit to table: {e}")
+            logger.error("could not connect to db: %s", e)
+            self.client = None
+            self.cursor = None
+            return False
+
+    def _check_schema(self):
+        """Insert only the columns each table has, so a database migrate_db.py has not run on keeps working."""
+        self.cursor.execute("SELECT TABLE_NAME, COLUMN_NAME FROM information_schema.COLUMNS "
+                            "WHERE TABLE_SCHEMA = DATABASE()")
+        existing = {}
+        for table, column in self.cursor.fetchall():
+            existing.setdefault(table, set()).add(column)
+        for table, columns in COLUMNS.items():
+            columns = METADATA_COLUMNS + columns
+            have = existing.get(table, set())
+            missing = [column for column in columns if column not in have]
+            if not missing:
+                self._inserts[table] = (INSERT_SQL[table], None)
+                continue
+            logger.warning("%s is missing %s, leaving them out until migrate_db.py has run",
+                           table, ", ".join(missing))
+            index = [i for i, column in enumerate(columns) if column in have]
+            self._inserts[table] = (insert_sql(table, [columns[i] for i in index]), index)
+
+    def make_row(self, type, time, data, received_at=None, rssi=None, snr=None, sequence_count=None):
+        """
+        :return: (table, row) for a decoded heartbeat, or None for other message types
+        """
+        table = TABLES.get(type)
+        if table is None:
+            return None
+        return table, (time, sequence_count, received_at, rssi, snr, *data)
+
+    def upload_data(self, type, time, data, received_at=None, rssi=None, snr=None, sequence_count=None):
+        row = self.make_row(type, time, data, received_at, rssi, snr, sequence_count)
+        if row is None:
+            return
+        if self.writer is None:
+            self.write_batch({row[0]: [row[1]]})
+        else:
+            self.writer.add(*row)
 
     def upload_sun(self, time, data):
-        (sun_x, sun_y, sun_z) = data
-        upload = (time, sun_x, sun_y, sun_z)
-        sql = "INSERT INTO sun (time, x, y, z) VALUES (%s, %s, %s, %s)"
-        try:
-            self.cursor.execute(sql, upload)
-            print("uploaded to sun table")
-        except Exception as e:
-            print(f"[ERROR]: Could not upload sun heartbeat: {e}")
+        self.upload_data(Message_IDS.SAT_HEARTBEAT_SUN, time, data)
 
     def upload_batt(self, time, data):
-        (batt_soc, current, boot_count) = data
-        upload = (time, batt_soc, current, boot_count)
-        sql = "INSERT INTO battery (time, batt_soc, current, boot_count) VALUES ( %s, %s, %s, %s)"
-        try:
-            self.cursor.execute(sql, upload)
-            print("uploaded to battery table")
-        except Exception as e:
-            print(f"[ERROR]: Could not upload battery heartbeat: {e}")
+        self.upload_data(Message_IDS.SAT_HEARTBEAT_BATT, time, data)
 
     def upload_imu(self, time, data):
-        (mag_x, mag_y, mag_z,
-         gyro_x, gyro_y, gyro_z) = data
-        upload = (time, mag_x, mag_y, mag_z, gyro_x, gyro_y, gyro_z)
-        sql = "INSERT INTO imu (time, mag_x, mag_y, mag_z, gyro_x, gyro_y, gyro_z) VALUES (%s, %s, %s, %s, %s, %s, %s)"
+        self.upload_data(Message_IDS.SAT_HEARTBEAT_IMU, time, data)
+
+    def write_rows(self, batch):
+        """Insert a {table: rows} batch in one transaction, raises if it was not committed."""
+        if self.client is None and not self.connect():
+            raise ConnectionError("database is unreachable")
+        try:
+            with self._write_metric.time():
+                for table, rows in batch.items():
+                    sql, index = self._inserts[table]
+                    if index is not None:
+                        rows = [[row[i] for i in index] for row in rows]
+                    self.cursor.executemany(sql, rows)
+                self.client.commit()
+        except Exception:
+            self._errors_metric.inc()
+            try:
+                self.client.rollback()
+            except Exception:
+                # connection is gone, reconnect on the next write
+                self.client = None
+            raise
+        row_count = sum(len(rows) for rows in batch.values())
+        self._rows_metric.inc(row_count)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("uploaded %d heartbeats", row_count)
+
+    def write_batch(self, batch):
         try:
-            self.cursor.execute(sql, upload)
-            print("uploaded to imu table")
+            self.write_rows(batch)
         except Exception as e:
-            print(f"[ERROR]: Could not upload imu heartbeat: {e}")
+            logger.error("Could not upload heartbeats: %s", e)
+
+    def flush(self):
+        if self.writer is not None:
+            self.writer.flush()
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        if self.client is not None:
+            self.client.close()
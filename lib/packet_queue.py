@@ -0,0 +1,71 @@
+import threading
+from collections import deque
+
+DROP_OLDEST = "drop_oldest"
+DROP_NEWEST = "drop_newest"
+
+
+class PacketQueue:
+    """Bounded FIFO between the radio interrupt thread and the main loop.
+
+    put() never blocks, so it is safe to call from an interrupt callback.
+    When the queue is full the overflow policy decides which packet is lost:
+    DROP_OLDEST evicts the head of the queue, DROP_NEWEST rejects the packet
+    being pushed. Every loss is counted.
+    """
+
+    def __init__(self, maxlen=64, policy=DROP_OLDEST) -> None:
+        if policy not in (DROP_OLDEST, DROP_NEWEST):
+            raise ValueError(f"unknown overflow policy: {policy}")
+        if maxlen < 1:
+            raise ValueError("maxlen must be at least 1")
+
+        self.maxlen = maxlen
+        self.policy = policy
+        self._packets = deque()
+        self._not_empty = threading.Condition(threading.Lock())
+
+        self.pushed_count = 0
+        self.dropped_oldest_count = 0
+        self.dropped_newest_count = 0
+
+    @property
+    def overflow_count(self):
+        return self.dropped_oldest_count + self.dropped_newest_count
+
+    def __len__(self):
+        return len(self._packets)
+
+    def put(self, packet) -> bool:
+        """Push a packet, returns False if the queue overflowed and a packet was lost."""
+        with self._not_empty:
+            self.pushed_count += 1
+            if len(self._packets) >= self.maxlen:
+                if self.policy == DROP_NEWEST:
+                    self.dropped_newest_count += 1
+                    return False
+                self._packets.popleft()
+                self.dropped_oldest_count += 1
+                self._packets.append(packet)
+                self._not_empty.notify()
+                return False
+            self._packets.append(packet)
+            self._not_empty.notify()
+        return True
+
+    def get(self, timeout=None):
+        """Pop the oldest packet, waiting up to timeout seconds.
+
+        Returns None if nothing arrived in time.
+        """
+        with self._not_empty:
+            if not self._not_empty.wait_for(lambda: self._packets, timeout):
+                return None
+            return self._packets.popleft()
+
+    def drain(self):
+        """Pop every queued packet without waiting."""
+        with self._not_empty:
+            packets = list(self._packets)
+            self._packets.clear()
+        return packets
@@ -0,0 +1,101 @@
+import logging
+import time
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+PassWindow = namedtuple("PassWindow", ["start", "end"])
+
+
+def load_pass_windows(path):
+    """
+    :param path: pass prediction file computed offline from the TLE
+    :return: sorted list of PassWindow
+
+    One pass per line as "start end" (or "start,end") in unix seconds.
+    Blank lines and lines starting with # are ignored.
+    """
+    windows = []
+    with open(path) as f:
+        for line in f:
+            line = line.split("#", 1)[0].strip()
+            if not line:
+                continue
+            start, end = (float(field) for field in line.replace(",", " ").split())
+            if end <= start:
+                raise ValueError(f"pass ends before it starts: {line}")
+            windows.append(PassWindow(start, end))
+    return sorted(windows)
+
+
+class PassScheduler:
+    """Duty-cycles the receiver around predicted satellite passes.
+
+    Drop-in for RadioHead.receive_message in the main loop. Inside a pass
+    window (widened by margin seconds on each side) it receives at full rate
+    and the SpoolReplayer moves packets into the database as usual. Outside
+    a window it puts the radio to sleep, pauses the replayer once it has
+    emptied the spool and sleeps until the next window opens, so nothing
+    runs between passes. clock and sleep can be replaced by a simulated
+    clock.
+    """
+
+    def __init__(self, radiohead, windows, replayer=None, margin=60, idle_sleep=600,
+                 clock=time.time, sleep=time.sleep) -> None:
+        self.radiohead = radiohead
+        self.windows = sorted(windows)
+        self.replayer = replayer
+        self.margin = margin
+        self.idle_sleep = idle_sleep
+        self.clock = clock
+        self.sleep = sleep
+
+        # None until the first call decides which side of a window we start on
+        self.in_pass = None
+
+    def current_window(self, now):
+        for window in self.windows:
+            if window.start - self.margin <= now < window.end + self.margin:
+                return window
+        return None
+
+    def next_window(self, now):
+        for window in self.windows:
+            if window.start - self.margin > now:
+                return window
+        return None
+
+    def receive_message(self, timeout=None):
+        now = self.clock()
+        window = self.current_window(now)
+        if window is None:
+            self._end_pass()
+            upcoming = self.next_window(now)
+            wait = self.idle_sleep if upcoming is None else upcoming.start - self.margin - now
+            self.sleep(min(wait, self.idle_sleep))
+            return None
+
+        self._start_pass(window)
+        # don't keep listening past the end of the window
+        if timeout is None:
+            timeout = self.radiohead.receive_timeout
+        timeout = min(timeout, window.end + self.margin - now)
+        return self.radiohead.receive_message(timeout)
+
+    def _start_pass(self, window):
+        if self.in_pass:
+            return
+        self.in_pass = True
+        logger.info("pass window %s - %s open, receiving", window.start, window.end)
+        if self.replayer is not None:
+            self.replayer.resume()
+
+    def _end_pass(self):
+        if self.in_pass is False:
+            return
+        self.in_pass = False
+        logger.info("pass window closed, sleeping radio")
+        self.radiohead.rx_ctrl.off()
+        self.radiohead.radio.sleep()
+        if self.replayer is not None:
+            self.replayer.pause()
@@ -1,107 +1,160 @@
-import datetime
+import logging
+import re
+import struct
+from collections import namedtuple
 from lib.constants import Message_IDS
+from lib.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+
+# ack/id byte, sequence count, message size
+_HEADER = struct.Struct(">BHB")
+
+# heartbeat fields start after the message header and the system status bytes
+HEARTBEAT_DATA_OFFSET = 6
+
+# 16.16 sign-magnitude fixed point, see convert_floating_point
+FP_SCALE = 1 / 65536
+FP_OFFSET = 0
+# 8.24 sign-magnitude fixed point, see convert_floating_point_hp
+FP_HP_SCALE = 1 / 16777216
+FP_HP_OFFSET = 1
+
+# struct: big-endian layout of the heartbeat data, the last field is always the time
+# fields: names of the data fields (matching the database columns), time excluded
+# scale/offset: fixed point scaling applied to every data field, None for plain integers
+HeartbeatLayout = namedtuple("HeartbeatLayout", ["name", "struct", "fields", "scale", "offset"])
+
+HEARTBEAT_LAYOUTS = {
+    # batt_soc, current, boot_count, time
+    Message_IDS.SAT_HEARTBEAT_BATT: HeartbeatLayout(
+        "battery", struct.Struct(">BHBI"),
+        ("batt_soc", "current", "boot_count"), None, None),
+    # sun vector x, y, z, time
+    Message_IDS.SAT_HEARTBEAT_SUN: HeartbeatLayout(
+        "sun", struct.Struct(">4I"),
+        ("x", "y", "z"), FP_HP_SCALE, FP_HP_OFFSET),
+    # mag x, y, z, gyro x, y, z, time
+    Message_IDS.SAT_HEARTBEAT_IMU: HeartbeatLayout(
+        "imu", struct.Struct(">7I"),
+        ("mag_x", "mag_y", "mag_z", "gyro_x", "gyro_y", "gyro_z"), FP_SCALE, FP_OFFSET),
+}
+
+
+_DECODED = {msg_id: REGISTRY.counter("heartbeats_decoded_total", "Heartbeats decoded", {"type": layout.name})
+            for msg_id, layout in HEARTBEAT_LAYOUTS.items()}
+_UNKNOWN = REGISTRY.counter("messages_unknown_total", "Messages with an ID that is not a heartbeat")
+_DECODE_FAILURES = REGISTRY.counter("decode_failures_total", "Messages too short for their type")
 
 
 def unpack_header(msg):
-    ack_req = (int.from_bytes((msg.message[0:1]), byteorder='big') & 0b10000000) >> 7
-    message_ID = int.from_bytes((msg.message[0:1]), byteorder='big') & 0b01111111
-    message_sequence_count = int.from_bytes(msg.message[1:3], byteorder='big')
-    message_size = int.from_bytes(msg.message[3:4], byteorder='big')
+    id_byte, message_sequence_count, message_size = _HEADER.unpack_from(msg.message)
+    ack_req = (id_byte & 0b10000000) >> 7
+    message_ID = id_byte & 0b01111111
     return ack_req, message_ID, message_sequence_count, message_size
 
 
 def unpack_message(msg):
-    # Get the current time
-    current_time = datetime.datetime.now()
-    # Format the current time
-    formatted_time = current_time.strftime("%Y-%m-%d_%H-%M-%S\n")
-    formatted_time = formatted_time.encode('utf-8')
-
-    header_info = (f"Header To: {msg.header_to}," +
-                   f"Header From: {msg.header_from}," +
-                   f"Header ID: {msg.header_id}," +
-                   f"Header Flags: {msg.header_flags}," +
-                   f"RSSI: {msg.rssi}," +
-                   f"SNR: {msg.snr}\n")
-    header_info = header_info.encode('utf-8')
-    payload = f"Payload: {msg.message}\n\n"
-    payload = payload.encode('utf-8')
+    try:
+        return _unpack_message(msg)
+    except struct.error as e:
+        _DECODE_FAILURES.inc()
+        logger.warning("could not decode message: %s", e)
+        return None
+
+
+def _unpack_message(msg):
     (ack, msg_id, msg_seq_count, msg_size) = unpack_header(msg)
-    system_status = f"{msg.message[5]}, {msg.message[6]}"
-    data = list(msg.message[6:])
-    print(f"header info: {header_info}")
-    print(f"system status: {system_status}")
-    if msg_id == Message_IDS.SAT_HEARTBEAT_BATT:
-        print("battery heartbeat")
-        """
-        byte 0: batt_soc
-        byte 1: current msb
-        byte 2: current lsb
-        byte 3: boot count
-        byte 4: time high
-        byte 5: time mid high
-        byte 6: time mid low
-        byte 7: time low
-        """
-        batt_soc: int = data[0]
-        current: int = data[1] << 8 | data[2]
-        boot_count: int = data[3]
-        time: int = ((data[4] & 0xff) << 24 |
-                     (data[5] & 0xff) << 16 |
-                     (data[6] & 0xff) << 8 |
-                     (data[7] & 0xff))
-        print(f"battery soc: {batt_soc}")
-        print(f"current: {current}")
-        print(f"boot count: {boot_count}")
-        print(f"time: {time}")
-        return msg_id, time, (batt_soc, current, boot_count)
-    elif msg_id == Message_IDS.SAT_HEARTBEAT_SUN:
-        print("sun heartbeat")
-        """
-        byte 0-4: sun vector x
-        byte 4-8: sun vector y
-        byte 8-12: sun vector 1
-        bytes 12-16: time
-        """
-        sun_vec_x = convert_floating_point_hp(data[0:4])
-        sun_vec_y = convert_floating_point_hp(data[4:8])
-        sun_vec_z = convert_floating_point_hp(data[8:12])
-
-        time: int = ((data[12] & 0xff) << 24 |
-                     (data[13] & 0xff) << 16 |
-                     (data[14] & 0xff) << 8 |
-                     (data[15] & 0xff))
-        print(f"sun vector: ({sun_vec_x}, {sun_vec_y}, {sun_vec_z})")
-        print(f"time: {time}")
-        return msg_id, time, (sun_vec_x, sun_vec_y, sun_vec_z)
-    elif msg_id == Message_IDS.SAT_HEARTBEAT_IMU:
-        print("imu heartbeat")
-        """
-        byte 0-4: mag x
-        byte 4-8: mag y
-        byte 8-12: mag z
-        byte 12-16: gyro x
-        byte 16-20: gyro y
-        byte 20-24: gyro z
-        byte 24-28: time
-        """
-        mag_x = convert_floating_point(data[0:4])
-        mag_y = convert_floating_point(data[4:8])
-        mag_z = convert_floating_point(data[8:12])
-
-        gyro_x = convert_floating_point(data[12:16])
-        gyro_y = convert_floating_point(data[16:20])
-        gyro_z = convert_floating_point(data[20:24])
-
-        time: int = ((data[24] & 0xff) << 24 |
-                     (data[25] & 0xff) << 16 |
-                     (data[26] & 0xff) << 8 |
-                     (data[27] & 0xff))
-
-        print(f"mag: ({mag_x}, {mag_y}, {mag_z})")
-        print(f"gyro: ({gyro_x}, {gyro_y}, {gyro_z})")
-        print(f"time: {time}")
-        return msg_id, time, (mag_x, mag_y, mag_z, gyro_x, gyro_y, gyro_z)
+    # keep the hot path free of formatting work unless debugging
+    debug = logger.isEnabledFor(logging.DEBUG)
+    if debug:
+        logger.debug("header to: %s, from: %s, id: %s, flags: %s, RSSI: %s, SNR: %s",
+                     msg.header_to, msg.header_from, msg.header_id, msg.header_flags, msg.rssi, msg.snr)
+        logger.debug("payload: %s", bytes(msg.message))
+        logger.debug("system status: %s", list(msg.message[5:7]))
+
+    layout = HEARTBEAT_LAYOUTS.get(msg_id)
+    if layout is None:
+        _UNKNOWN.inc()
+        return None
+
+    # decode straight from the payload buffer, no intermediate byte list
+    *values, time = layout.struct.unpack_from(msg.message, HEARTBEAT_DATA_OFFSET)
+    if layout.scale is not None:
+        values = scale_fixed_point(values, layout.scale, layout.offset)
+
+    _DECODED[msg_id].inc()
+    if debug:
+        logger.debug("%s heartbeat: %s, time: %s", layout.name, dict(zip(layout.fields, values)), time)
+    return msg_id, time, tuple(values)
+
+
+def unpack_messages(payloads, msg_id):
+    """
+    :param payloads: raw message payloads (msg.message) all of type msg_id
+    :param msg_id: heartbeat Message_IDS type shared by every payload
+    :return: dict of numpy column arrays keyed by database column name,
+             plus "sequence_count" and "time"
+
+    Vectorized unpack_message for replaying large packet logs. Requires numpy.
+    Raises ValueError naming the first payload that is too short or of another type.
+    """
+    import numpy as np
+
+    layout = HEARTBEAT_LAYOUTS[msg_id]
+    size = HEARTBEAT_DATA_OFFSET + layout.struct.size
+    chunks = []
+    for index, payload in enumerate(payloads):
+        # a short payload would shift every record after it
+        if len(payload) < size:
+            raise ValueError(f"payload {index} is {len(payload)} bytes, a {layout.name} heartbeat is {size}")
+        chunks.append(bytes(payload[:size]))
+    records = np.frombuffer(b"".join(chunks), dtype=_numpy_dtype(layout))
+
+    wrong_type = np.flatnonzero((records["id"] & 0b01111111) != msg_id)
+    if len(wrong_type):
+        index = wrong_type[0]
+        raise ValueError(f"payload {index} is message type {records['id'][index] & 0b01111111}, not {msg_id}")
+
+    columns = {
+        "sequence_count": records["sequence_count"].astype(np.uint16),
+        "time": records["time"].astype(np.uint32),
+    }
+    for field in layout.fields:
+        if layout.scale is None:
+            columns[field] = records[field].astype(np.int64)
+        else:
+            raw = records[field].astype(np.int64)
+            magnitude = ((raw & 0x7FFFFFFF) + layout.offset) * layout.scale
+            columns[field] = np.where(raw & 0x80000000, -magnitude, magnitude)
+    return columns
+
+
+_NUMPY_CODES = {"B": "u1", "H": ">u2", "I": ">u4"}
+
+
+def _numpy_dtype(layout):
+    # message header and system status, then the struct fields in order
+    dtype = [("id", "u1"), ("sequence_count", ">u2"), ("size", "u1"), ("status", "V2")]
+    codes = []
+    for count, code in re.findall(r"(\d*)([BHI])", layout.struct.format):
+        codes += [_NUMPY_CODES[code]] * int(count or 1)
+    return dtype + list(zip(layout.fields + ("time",), codes))
+
+
+def scale_fixed_point(raw_values, scale, offset=0):
+    """
+    :param raw_values: 32 bit sign-magnitude fixed point words
+    :param scale: weight of the least significant bit
+    :param offset: integer added to the magnitude before scaling
+    :return: list of floating point values
+
+    Bit 31 is the sign, bits 0-30 are the magnitude.
+    """
+    return [-((raw & 0x7FFFFFFF) + offset) * scale if raw & 0x80000000 else
+            ((raw & 0x7FFFFFFF) + offset) * scale
+            for raw in raw_values]
 
 
 def convert_floating_point(message_list):
@@ -112,21 +165,8 @@ def convert_floating_point(message_list):
     Convert FP value back to floating point
     Range: [-32767.9999], 32767.9999]
     """
-    val = 0
-    neg_bit_flag = 0
-
-    # Check -ve, extract LSB bytes for val, combine
-    if ((message_list[0] >> 7) == 1):
-        message_list[0] &= 0x7F
-        neg_bit_flag = 1
-
-    # Extract bytes for val, combine
-    val += (message_list[0] << 8) + message_list[1]
-    val += ((message_list[2] << 8) + message_list[3]) / 65536
-    if (neg_bit_flag == 1):
-        val = -1 * val
-
-    return val
+    raw = int.from_bytes(bytes(message_list[0:4]), byteorder='big')
+    return scale_fixed_point((raw,), FP_SCALE, FP_OFFSET)[0]
 
 
 def convert_floating_point_hp(message_list):
@@ -137,18 +177,5 @@ def convert_floating_point_hp(message_list):
     Convert HP FP value back to floating point
     Range: [-128.9999999, 128.9999999]
     """
-    val = 0
-    neg_bit_flag = 0
-
-    # Check -ve, extract LSB bytes for val, combine
-    if ((message_list[0] >> 7) == 1):
-        message_list[0] &= 0x7F
-        neg_bit_flag = 1
-
-    # Extract bytes for val, combine
-    val += message_list[0]
-    val += ((message_list[1] << 16) + (message_list[2] << 8) + message_list[3] + 1) / 16777216
-    if (neg_bit_flag == 1):
-        val = -1 * val
-
-    return val
+    raw = int.from_bytes(bytes(message_list[0:4]), byteorder='big')
+    return scale_fixed_point((raw,), FP_HP_SCALE, FP_HP_OFFSET)[0]
@@ -1,32 +1,47 @@
-import time
+import logging
 
 from gpiozero import LED
 
+from lib.metrics import REGISTRY
+from lib.packet_queue import DROP_OLDEST, PacketQueue
+
+logger = logging.getLogger(__name__)
+
 
 class RadioHead:
-    def __init__(self, radio, receive_timeout) -> None:
+    def __init__(self, radio, receive_timeout, queue_size=64, overflow_policy=DROP_OLDEST,
+                 capture=None) -> None:
         self.radio = radio
         self.receive_timeout = receive_timeout
         self.radio.on_recv = self.on_recv
+        # optional CaptureWriter recording every raw frame
+        self.capture = capture
 
         self.rx_ctrl = LED(22)
         self.tx_ctrl = LED(23)
-        self.receive_success = False
+        # filled from the radio interrupt thread, drained by receive_message
+        self.packets = PacketQueue(queue_size, overflow_policy)
+        REGISTRY.gauge("radiohead_queue_depth", "Received packets waiting to be decoded",
+                       function=lambda: len(self.packets))
+        REGISTRY.counter("radiohead_queue_dropped_total", "Received packets lost to queue overflow",
+                         function=lambda: self.packets.overflow_count)
+        self.last_payload = None
 
-    def receive_message(self) -> bytes:
+    def receive_message(self, timeout=None) -> bytes:
+        if timeout is None:
+            timeout = self.receive_timeout
         self.rx_ctrl.on()
-        self.receive_success = False
         self.radio.set_mode_rx()
-        start = time.monotonic()
-        timed_out = False
-        while not self.receive_success and not timed_out:
-            if (time.monotonic() - start) >= self.receive_timeout:
-                timed_out = True
-        if timed_out:
+        # sleep until on_recv queues a packet instead of spinning on a flag
+        payload = self.packets.get(timeout)
+        if payload is None:
             return None
         self.rx_ctrl.off()
-        return self.last_payload
+        self.last_payload = payload
+        return payload
 
     def on_recv(self, payload):
-        self.receive_success = True
-        self.last_payload = payload
+        if self.capture is not None:
+            self.capture.write(payload)
+        if not self.packets.put(payload):
+            logger.warning("packet queue full, dropped %d packets so far", self.packets.overflow_count)
@@ -0,0 +1,275 @@
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+
+from lib.constants import Definitions
+from lib.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+# header_id is the sequence number, compared modulo 256
+SEQ_SPACE = 256
+# selective repeat can't tell old from new packets with a larger window
+MAX_WINDOW = SEQ_SPACE // 2
+
+_SENT = REGISTRY.counter("reliable_packets_sent_total", "Window packets transmitted, retransmits included")
+_RETRANSMITS = REGISTRY.counter("reliable_retransmits_total", "Window packets transmitted again")
+_DUPLICATES = REGISTRY.counter("reliable_duplicates_total", "Window packets received again")
+
+
+def seq_offset(seq, base):
+    """How far seq is past base in the sequence space."""
+    return (seq - base) % SEQ_SPACE
+
+
+class _Outstanding:
+    __slots__ = ("data", "sent_at", "transmissions", "lost")
+
+    def __init__(self, data) -> None:
+        self.data = data
+        self.sent_at = None
+        self.transmissions = 0
+        self.lost = False
+
+
+class ReliableSender:
+    """Selective-repeat sliding window sender on the RadioHead header.
+
+    Up to window packets are in flight to peer at once, numbered by
+    header_id. LoRa is half duplex, so rather than acknowledging every
+    packet the receiver only answers the last packet of each burst, which
+    carries FLAGS_POLL. Its ack (FLAGS_ACK) has the next sequence number it
+    expects in header_id and a bitmap of the packets after that it already
+    holds, so only the holes get sent again, with FLAGS_RETRY. The wait for
+    an ack is an RTO derived from the measured round trip time (smoothed
+    RTT plus four times its deviation, not sampled from retransmits),
+    doubled on every timeout until an ack arrives. A timeout resends just
+    the oldest packet as a probe, the ack to it shows what else is missing.
+    max_retries timeouts in a row without an ack mean the peer is gone.
+
+    Takes over the radio's on_ack. Both ends start at sequence number 0.
+    """
+
+    def __init__(self, radio, peer, window=8, initial_rto=1.0, min_rto=0.05, max_rto=10.0, max_retries=8,
+                 clock=time.monotonic) -> None:
+        if not 1 <= window <= MAX_WINDOW:
+            raise ValueError(f"window must be between 1 and {MAX_WINDOW}")
+        self.radio = radio
+        self.peer = peer
+        self.window = window
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.max_retries = max_retries
+        self.clock = clock
+
+        self.next_seq = 0
+        # seq -> _Outstanding, oldest first
+        self._outstanding = OrderedDict()
+        self._pending = deque()
+        # (header_id, bitmap, time) filled by on_ack from the interrupt thread
+        self._acks = deque()
+        self._ack_ready = threading.Condition()
+        # sequence number that carried the last FLAGS_POLL
+        self._poll_seq = None
+
+        # RTO from the RTT estimate, doubled backoff times after timeouts
+        self.base_rto = initial_rto
+        self.backoff = 0
+        self.timeouts = 0
+        self.srtt = None
+        self.rttvar = None
+        self.sent_count = 0
+        self.retransmit_count = 0
+
+        radio.on_ack = self.on_ack
+
+    @property
+    def rto(self):
+        return min(self.base_rto * 2 ** self.backoff, self.max_rto)
+
+    def on_ack(self, payload):
+        if payload.header_from != self.peer:
+            return
+        with self._ack_ready:
+            self._acks.append((payload.header_id, bytes(payload.message), self.clock()))
+            self._ack_ready.notify()
+
+    def send(self, messages, timeout=None):
+        """
+        :param messages: iterable of payloads, delivered in order
+        :param timeout: seconds to give up after, None to only give up after max_retries timeouts
+        :return: True once every message is acknowledged, False on giving up
+
+        Messages left unacknowledged after giving up go first on the next call.
+        """
+        self._pending.extend(messages)
+        deadline = None if timeout is None else self.clock() + timeout
+        while self._pending or self._outstanding:
+            if deadline is not None and self.clock() >= deadline:
+                return False
+            self._transmit_burst()
+            if self._wait_ack():
+                self.timeouts = 0
+                continue
+            self.timeouts += 1
+            if self.timeouts > self.max_retries:
+                logger.warning("no ack from %d after %d retries", self.peer, self.max_retries)
+                self.timeouts = 0
+                return False
+            self._on_timeout()
+        return True
+
+    def _transmit_burst(self):
+        burst = [seq for seq, packet in self._outstanding.items() if packet.lost]
+        while self._pending and len(self._outstanding) < self.window:
+            seq = self.next_seq
+            self.next_seq = (seq + 1) % SEQ_SPACE
+            self._outstanding[seq] = _Outstanding(self._pending.popleft())
+            burst.append(seq)
+        for i, seq in enumerate(burst):
+            packet = self._outstanding[seq]
+            flags = Definitions.FLAGS_RETRY if packet.transmissions else 0
+            if i == len(burst) - 1:
+                flags |= Definitions.FLAGS_POLL
+                self._poll_seq = seq
+            packet.sent_at = self.clock()
+            self.radio.send(packet.data, self.peer, header_id=seq, header_flags=flags)
+            if packet.transmissions:
+                self.retransmit_count += 1
+                _RETRANSMITS.inc()
+            packet.transmissions += 1
+            packet.lost = False
+            self.sent_count += 1
+            _SENT.inc()
+        if burst:
+            self.radio.wait_packet_sent()
+            self.radio.set_mode_rx()
+
+    def _wait_ack(self):
+        """Handle the acks that arrive within an RTO of the last poll, returns False on a timeout."""
+        poll = self._outstanding.get(self._poll_seq)
+        deadline = (poll.sent_at if poll is not None else self.clock()) + self.rto
+        with self._ack_ready:
+            while not self._acks:
+                remaining = deadline - self.clock()
+                if remaining <= 0 or not self._ack_ready.wait(remaining):
+                    if not self._acks:
+                        return False
+            acks = list(self._acks)
+            self._acks.clear()
+        for ack in acks:
+            self._handle_ack(*ack)
+        return True
+
+    def _handle_ack(self, expected, bitmap, received_at):
+        outstanding = self._outstanding
+        if not outstanding:
+            return
+        base = next(iter(outstanding))
+        acked = []
+        # everything before expected arrived, unless the ack is older than base
+        limit = seq_offset(expected, base)
+        if limit <= seq_offset(self.next_seq, base):
+            while outstanding and seq_offset(next(iter(outstanding)), base) < limit:
+                acked.append(outstanding.popitem(last=False))
+        # the bitmap holds packets received after expected
+        for i, byte in enumerate(bitmap):
+            for bit in range(8):
+                if byte >> bit & 1:
+                    seq = (expected + 1 + i * 8 + bit) % SEQ_SPACE
+                    packet = outstanding.pop(seq, None)
+                    if packet is not None:
+                        acked.append((seq, packet))
+        if not acked:
+            return
+
+        # the link is back, retransmits can't give an RTT sample so don't wait for one
+        self.backoff = 0
+        for seq, packet in acked:
+            # Karn: a retransmitted packet's ack can't tell which copy it answers
+            if seq == self._poll_seq and packet.transmissions == 1:
+                self._update_rto(received_at - packet.sent_at)
+        # LoRa doesn't reorder, anything sent before the newest acked packet is lost
+        newest = max(seq_offset(seq, base) for seq, _ in acked)
+        for seq, packet in outstanding.items():
+            if seq_offset(seq, base) < newest:
+                packet.lost = True
+
+    def _update_rto(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.base_rto = min(max(self.srtt + 4 * self.rttvar, self.min_rto), self.max_rto)
+
+    def _on_timeout(self):
+        if self.rto < self.max_rto:
+            self.backoff += 1
+        if self._outstanding:
+            # probe with the oldest packet, its ack shows what else is missing
+            next(iter(self._outstanding.values())).lost = True
+
+
+class ReliableReceiver:
+    """Receiving end of ReliableSender.
+
+    Feed received Payloads to handle(), every packet peer sends is taken as
+    part of the window. Packets are passed to on_message in sequence order,
+    those arriving early are held until the gap before them is filled. The
+    ack sent for every FLAGS_POLL packet covers the whole window. Run it
+    with the radio's own acks off, on a thread that may transmit.
+    """
+
+    def __init__(self, radio, peer=None, window=8) -> None:
+        if not 1 <= window <= MAX_WINDOW:
+            raise ValueError(f"window must be between 1 and {MAX_WINDOW}")
+        self.radio = radio
+        self.peer = peer
+        self.window = window
+
+        self.expected = 0
+        # seq -> Payload received ahead of expected
+        self._held = {}
+        self.duplicate_count = 0
+
+    def on_message(self, payload):
+        # This should be overridden by the user
+        logger.debug("Message received!")
+
+    def handle(self, payload):
+        """Take a received packet, returns False for packets not sent through a ReliableSender."""
+        if payload.header_flags & Definitions.FLAGS_ACK:
+            return False
+        if self.peer is not None and payload.header_from != self.peer:
+            return False
+
+        seq = payload.header_id
+        offset = seq_offset(seq, self.expected)
+        if offset >= self.window or seq in self._held:
+            self.duplicate_count += 1
+            _DUPLICATES.inc()
+        elif offset:
+            self._held[seq] = payload
+        else:
+            self.on_message(payload)
+            self.expected = (self.expected + 1) % SEQ_SPACE
+            while self.expected in self._held:
+                self.on_message(self._held.pop(self.expected))
+                self.expected = (self.expected + 1) % SEQ_SPACE
+
+        if payload.header_flags & Definitions.FLAGS_POLL:
+            self.send_ack(payload.header_from)
+        return True
+
+    def send_ack(self, header_to):
+        bitmap = bytearray((self.window + 6) // 8)
+        for seq in self._held:
+            offset = seq_offset(seq, self.expected) - 1
+            bitmap[offset >> 3] |= 1 << (offset & 7)
+        self.radio.send(bytes(bitmap).rstrip(b"\x00"), header_to, header_id=self.expected,
+                        header_flags=Definitions.FLAGS_ACK)
+        self.radio.wait_packet_sent()
+        self.radio.set_mode_rx()
@@ -12,9 +12,24 @@ Library Repo: https://github.com/pycubed/library_pycubed.py
 """
 import time
 from random import random
-import digitalio
-from micropython import const
-import adafruit_bus_device.spi_device as spidev
+try:
+    import threading
+except ImportError:
+    threading = None
+try:
+    from micropython import const
+except ImportError:
+    def const(x):
+        return x
+# Board libraries are only needed for real hardware; a simulated chip can be
+# passed in through the device argument instead.
+try:
+    import digitalio
+    import adafruit_bus_device.spi_device as spidev
+    _PULL_UP = digitalio.Pull.UP
+except (ImportError, NotImplementedError):
+    spidev = None
+    _PULL_UP = None
 
 
 # pylint: disable=bad-whitespace
@@ -114,6 +129,33 @@ VR3X=b'\xff'
 # pylint: disable=too-many-instance-attributes
 
 _bigbuffer=bytearray(256)
+# valid_ids tuple -> 256 byte translate table marking those ids with 1
+_id_tables={}
+
+def packet_starts(buf, end, ids):
+    """Offsets in buf[:end] that look like the start of a RadioHead header:
+       two different bytes from ids (to, from), with at least 4 bytes
+       between starts. Scans with bytes.translate and find instead of a
+       per-byte membership check.
+    """
+    table = _id_tables.get(ids)
+    if table is None:
+        marks = bytearray(256)
+        for i in ids:
+            marks[i] = 1
+        table = _id_tables[ids] = bytes(marks)
+    marks = bytes(buf[:end]).translate(table)
+    starts = []
+    i = marks.find(b'\x01\x01')
+    while i >= 0:
+        if buf[i] != buf[i+1]:
+            starts.append(i)
+            i += 4
+        else:
+            i += 1
+        i = marks.find(b'\x01\x01', i)
+    return starts
+
 bw_bins = (7800, 10400, 15600, 20800, 31250, 41700, 62500, 125000, 250000)
 class RFM9x:
     """Interface to a RFM95/6/7/8 LoRa radio module.  Allows sending and
@@ -228,22 +270,38 @@ class RFM9x:
         high_power=True,
         baudrate=5000000,
         max_output=False,
-        hot_start=False
+        hot_start=False,
+        device=None,
+        irq=None
     ):
         self.hot_start=hot_start
         self.high_power = high_power
         self.max_output=max_output
         self.dio0=False
+        # irq is an optional gpiozero Button-like input on DIO0. With it send
+        # and receive sleep until the DIO0 edge instead of polling IRQ flags.
+        self._dio0_event = None
+        if irq is not None:
+            self.dio0 = irq
+            self._dio0_event = threading.Event()
+            irq.when_pressed = self._handle_dio0
+        # fallback polling without irq starts at poll_interval and doubles up to poll_interval_max
+        self.poll_interval = 0.0005
+        self.poll_interval_max = 0.01
         self.gen_node=_RH_BROADCAST_ADDRESS
         # Device support SPI mode 0 (polarity & phase = 0) up to a max of 10mhz.
         # Set Default Baudrate to 5MHz to avoid problems
-        self._device = spidev.SPIDevice(spi, cs, baudrate=baudrate, polarity=0, phase=0)
+        # An SPIDevice-like object (e.g. sx127x_sim.SimSPIDevice) may be passed
+        # as device to run without the board libraries.
+        if device is None:
+            device = spidev.SPIDevice(spi, cs, baudrate=baudrate, polarity=0, phase=0)
+        self._device = device
         # Setup reset as a digital input (default state for reset line according
         # to the datasheet).  This line is pulled low as an output quickly to
         # trigger a reset.  Note that reset MUST be done like this and set as
         # a high impedence input or else the chip cannot change modes (trust me!).
         self._reset = reset
-        self._reset.switch_to_input(pull=digitalio.Pull.UP)
+        self._reset.switch_to_input(pull=_PULL_UP)
 
         ## ------ hot-start jump point ------
         if self.hot_start:
@@ -374,6 +432,8 @@ class RFM9x:
            Fourth byte of the RadioHead header.
         """
         self.crc_error_count = 0
+        # FIFO start of every packet received since the last receive_all, see mark_packet
+        self.rx_starts = []
 
         self.auto_agc=True
         self.pa_ramp=0   # mode agnostic
@@ -484,7 +544,7 @@ class RFM9x:
         # See section 7.2.2 of the datasheet for reset description.
         self._reset.switch_to_output(value=False)
         time.sleep(0.0001)  # 100 us
-        self._reset.switch_to_input(pull=digitalio.Pull.UP)
+        self._reset.switch_to_input(pull=_PULL_UP)
         time.sleep(0.005)  # 5 ms
 
     def idle(self):
@@ -782,6 +842,34 @@ class RFM9x:
         else:
             return (self._read_u8(_RH_RF95_REG_12_IRQ_FLAGS) & 0x40) >> 6
 
+    def _handle_dio0(self, pin=None):
+        # runs on the GPIO callback thread, only wake the waiting caller
+        self._dio0_event.set()
+
+    def _wait_done(self, done, timeout):
+        """Wait up to timeout seconds for done() (rx_done or tx_done) to report True.
+           Sleeps on the DIO0 interrupt when irq was given, otherwise polls with
+           an exponential backoff. Returns False if it timed out.
+        """
+        deadline = time.monotonic() + timeout
+        if self._dio0_event is not None:
+            # clear first, an edge after the check below still wakes the wait
+            self._dio0_event.clear()
+            while not done():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self._dio0_event.wait(remaining):
+                    return bool(done())
+                self._dio0_event.clear()
+            return True
+        delay = self.poll_interval
+        while not done():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, self.poll_interval_max)
+        return True
+
     # async def await_rx(self,timeout=60):
     #     # TODO check for listening here?
     #     _t=time.monotonic()+timeout
@@ -878,13 +966,8 @@ class RFM9x:
         self._write_u8(_RH_RF95_REG_22_PAYLOAD_LENGTH, l)
         # Turn on transmit mode to send out the packet.
         self.transmit()
-        # Wait for tx done interrupt with explicit polling (not ideal but
-        # best that can be done right now without interrupts).
-        start = time.monotonic()
-        timed_out = False
-        while not timed_out and not self.tx_done():
-            if (time.monotonic() - start) >= self.xmit_timeout:
-                timed_out = True
+        # Wait for tx done on the DIO0 interrupt or by polling with backoff.
+        timed_out = not self._wait_done(self.tx_done, self.xmit_timeout)
 
         if hasattr(self,'txrx'): # RX
             self.txrx[0].value=False
@@ -966,17 +1049,11 @@ class RFM9x:
         if timeout is None:
             timeout = self.receive_timeout
         if timeout is not None:
-            # Wait for the payload_ready signal.  This is not ideal and will
-            # surely miss or overflow the FIFO when packets aren't read fast
-            # enough, however it's the best that can be done from Python without
-            # interrupt supports.
+            # Wait for the payload_ready signal, on the DIO0 interrupt when
+            # irq was given or by polling with backoff otherwise.
             # Make sure we are listening for packets.
             self.listen()
-            start = time.monotonic()
-            timed_out = False
-            while not timed_out and not self.rx_done():
-                if (time.monotonic() - start) >= timeout:
-                    timed_out = True
+            timed_out = not self._wait_done(self.rx_done, timeout)
         # Payload ready is set, a packet is in the FIFO.
         packet = None
         # save last RSSI reading
@@ -1070,10 +1147,26 @@ class RFM9x:
             return bytes(packet)
         return packet
 
+    def mark_packet(self):
+        """Record where the packet that just raised rx_done starts in the FIFO
+           and clear the flag, staying in receive mode. Call it on every
+           rx_done while collecting packets for receive_all so it can slice
+           them exactly instead of scanning the FIFO for headers.
+        """
+        self.rx_starts.append(self._read_u8(_RH_RF95_REG_10_FIFO_RX_CURRENT_ADDR))
+        self._write_u8(_RH_RF95_REG_12_IRQ_FLAGS, 0xFF)
+
     def receive_all(self, only_for_me=True,debug=False):
-        # msg=[]
-        l=0
+        """Yield every packet received back-to-back in the FIFO since listen().
+           The last packet is sliced exactly from RX_CURRENT_ADDR and
+           RX_NB_BYTES. Earlier ones end where the next one starts, taken
+           from mark_packet when it was called for each of them, otherwise
+           found by scanning for valid_ids header bytes. Packets are
+           memoryviews into a shared buffer, valid until the next read.
+        """
         fifo_length=0
+        starts=self.rx_starts
+        self.rx_starts=[]
         self.idle()
         if self.enable_crc and self.crc_error():
             self.crc_error_count += 1
@@ -1085,50 +1178,33 @@ class RFM9x:
 
         if fifo_length > 0:
             current_addr = self._read_u8(_RH_RF95_REG_10_FIFO_RX_CURRENT_ADDR)
+            end = current_addr+fifo_length
+            # only read what was written since listen(), stale bytes past the
+            # last packet are never scanned so the FIFO needn't be cleared
             self._write_u8(_RH_RF95_REG_0D_FIFO_ADDR_PTR, _RH_RF95_REG_00_FIFO)
-            self._read_into(_RH_RF95_REG_00_FIFO,_bigbuffer)
-            for i in range(4):
-                self._write_from(_RH_RF95_REG_00_FIFO, bytes(64))
-            self._write_u8(_RH_RF95_REG_0D_FIFO_ADDR_PTR,_RH_RF95_REG_00_FIFO)
+            self._read_into(_RH_RF95_REG_00_FIFO,_bigbuffer,length=min(end,256))
             self.listen()
             # Clear interrupt.
             self._write_u8(_RH_RF95_REG_12_IRQ_FLAGS, 0xFF)
-            packetindex=[]
-            i=0
-            while i < 253: # 256-4 = 252
-                # check first
-                if self.buffview[i] in self.valid_ids:
-                    # check second
-                    if self.buffview[i+1] in self.valid_ids:
-                        # make sure not the same
-                        if self.buffview[i]!=self.buffview[i+1]:
-                            # append first
-                            packetindex.append(i)
-                            i=i+4
-                            l+=1
-                            continue
-                i+=1
-            for i in range(l-1):
-                # assume packets are back-to-back (read till index of next one)
-                # if (packetindex[i+1]-packetindex[i]) <= 10:
-                    # msg.append(bytes(self.buffview[packetindex[i]:packetindex[i+1]]))
-                yield self.buffview[packetindex[i]:packetindex[i+1]]
-            # last packet so read until the end of our fifo_length
-            if packetindex:
-                # if (packetindex[-1]-(current_addr+fifo_length)) <= 10:
-                    # print('{},{},{}'.format(packetindex[-1],current_addr,fifo_length))
-                    # msg.append(bytes(self.buffview[packetindex[-1]:current_addr+fifo_length]))
-                yield self.buffview[packetindex[-1]:current_addr+fifo_length]
+            if end > 256:
+                # the last packet wrapped around and overwrote the first ones
+                yield self.buffview[current_addr:].tobytes() + self.buffview[:end-256].tobytes()
+                return
+            if starts and starts[-1] == current_addr and all(a < b for a, b in zip(starts, starts[1:])):
+                starts = starts[:-1]
+            else:
+                starts = packet_starts(_bigbuffer, current_addr, self.valid_ids)
+            starts.append(current_addr)
+            for i in range(len(starts)-1):
+                # packets are back-to-back, read till the start of the next one
+                yield self.buffview[starts[i]:starts[i+1]]
+            # last packet, exactly fifo_length bytes
+            yield self.buffview[current_addr:end]
         else:
             self.listen()
             # Clear interrupt.
             self._write_u8(_RH_RF95_REG_12_IRQ_FLAGS, 0xFF)
 
-        # if only_for_me:
-        #     return [i for i in msg if msg[0] is self.node]
-        # else:
-        #     return msg
-
     def send_fast(self,data,l):
         self.idle()
         self._write_u8(_RH_RF95_REG_0D_FIFO_ADDR_PTR, 0x00) # set fifo position
@@ -1138,12 +1214,9 @@ class RFM9x:
         self._write_u8(_RH_RF95_REG_22_PAYLOAD_LENGTH, l)
         # Turn on transmit mode to send out the packet.
         self.transmit()
-        # Wait for tx done interrupt with explicit polling (not ideal but
-        # best that can be done right now without interrupts).
-        _t = time.monotonic() + 5
+        # Wait for tx done on the DIO0 interrupt or by polling with backoff.
         print(l)
-        while time.monotonic() < _t and not self.tx_done():
-            pass
+        self._wait_done(self.tx_done, 5)
         self.idle()
         # Clear interrupt.
         self._write_u8(_RH_RF95_REG_12_IRQ_FLAGS, 0xFF)
@@ -0,0 +1,101 @@
+import itertools
+import random
+import threading
+import time
+
+from lib.argus_lora import Payload
+from lib.constants import Message_IDS
+from lib.radio_utils import HEARTBEAT_DATA_OFFSET, HEARTBEAT_LAYOUTS
+
+
+def pack_heartbeat(msg_id, sequence_count, time, values, system_status=(0, 0)):
+    """Inverse of radio_utils.unpack_message for the heartbeat types."""
+    layout = HEARTBEAT_LAYOUTS[msg_id]
+    if layout.scale is not None:
+        values = [_to_fixed_point(value, layout.scale, layout.offset) for value in values]
+    header = bytes([msg_id, (sequence_count >> 8) & 0xff, sequence_count & 0xff,
+                    layout.struct.size, *system_status])
+    assert len(header) == HEARTBEAT_DATA_OFFSET
+    return header + layout.struct.pack(*values, time)
+
+
+def _to_fixed_point(value, scale, offset):
+    magnitude = max(round(abs(value) / scale) - offset, 0) & 0x7FFFFFFF
+    return magnitude | 0x80000000 if value < 0 else magnitude
+
+
+def random_heartbeat(sequence_count, rng=random):
+    msg_id = rng.choice((Message_IDS.SAT_HEARTBEAT_BATT, Message_IDS.SAT_HEARTBEAT_SUN,
+                         Message_IDS.SAT_HEARTBEAT_IMU))
+    if msg_id == Message_IDS.SAT_HEARTBEAT_BATT:
+        values = (rng.randrange(101), rng.randrange(1 << 16), rng.randrange(256))
+    elif msg_id == Message_IDS.SAT_HEARTBEAT_SUN:
+        values = tuple(rng.uniform(-1, 1) for _ in range(3))
+    else:
+        values = tuple(rng.uniform(-100, 100) for _ in range(6))
+    return pack_heartbeat(msg_id, sequence_count, int(time.time()), values)
+
+
+class SimulatedRadio:
+    """Stands in for LoRa without any hardware.
+
+    Once set_mode_rx() is called a background thread delivers random
+    heartbeats to on_recv at rate_hz packets per second, from a thread just
+    like the gpiozero interrupt callback. Stops after count packets if given.
+    """
+
+    def __init__(self, rate_hz=10.0, count=None, this_address=25, seed=None) -> None:
+        self.rate_hz = rate_hz
+        self.count = count
+        self._this_address = this_address
+        self._rng = random.Random(seed)
+        self._stop = threading.Event()
+        self._thread = None
+
+        self.sent_count = 0
+
+    def on_recv(self, message):
+        # This should be overridden by the user
+        pass
+
+    def set_mode_rx(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="simulated-radio", daemon=True)
+            self._thread.start()
+
+    def sleep(self):
+        self.close()
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+        self._stop.clear()
+
+    def _run(self):
+        period = 1 / self.rate_hz
+        next_time = time.monotonic()
+        for sequence_count in itertools.count():
+            if self.count is not None and sequence_count >= self.count:
+                return
+            next_time += period
+            if self._stop.wait(max(next_time - time.monotonic(), 0)):
+                return
+            message = random_heartbeat(sequence_count & 0xffff, self._rng)
+            self.on_recv(Payload(message, self._this_address, 1, sequence_count & 0xff, 0,
+                                 self._rng.uniform(-120, -60), self._rng.uniform(-10, 10)))
+            self.sent_count += 1
+
+
+class SimulatedClock:
+    """time()/sleep() pair for driving PassScheduler, sleep advances time instantly."""
+
+    def __init__(self, start=0.0) -> None:
+        self.now = start
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += max(seconds, 0)
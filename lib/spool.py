@@ -0,0 +1,254 @@
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+
+from lib.argus_lora import Payload
+from lib.metrics import REGISTRY
+from lib.radio_utils import unpack_header, unpack_message
+
+logger = logging.getLogger(__name__)
+
+# record length and crc32 of the record body
+_RECORD_HEADER = struct.Struct("<II")
+# received_at, rssi, snr, header to/from/id/flags, then the message bytes
+_RECORD_META = struct.Struct("<dffBBBB")
+
+# larger than any LoRa packet, anything bigger is a torn or corrupt header
+_MAX_RECORD = _RECORD_META.size + 256
+
+_READ_CHUNK = 1 << 16
+
+
+def pack_record(payload):
+    body = _RECORD_META.pack(payload.received_at, payload.rssi, payload.snr, payload.header_to,
+                             payload.header_from, payload.header_id, payload.header_flags) + bytes(payload.message)
+    return _RECORD_HEADER.pack(len(body), zlib.crc32(body)) + body
+
+
+def unpack_record(body):
+    received_at, rssi, snr, header_to, header_from, header_id, header_flags = _RECORD_META.unpack_from(body)
+    return Payload(bytes(body[_RECORD_META.size:]), header_to, header_from, header_id, header_flags,
+                   rssi, snr, received_at)
+
+
+class Spool:
+    """Append-only on-disk log of received packets.
+
+    Every packet is appended here before anything touches the database, so
+    a slow or unreachable database never stalls the radio loop and nothing
+    is lost while it is down. Records are length prefixed and checksummed,
+    and the file is fsynced every sync_every records or sync_interval
+    seconds, whichever comes first. A crash can lose at most that unsynced
+    tail, and a torn last record is cut off when the spool is reopened.
+
+    A single reader (SpoolReplayer) takes records with read() and marks them
+    done with commit(), which is checkpointed to path + ".offset". Once
+    everything has been committed the file is truncated back to empty.
+    """
+
+    def __init__(self, path, sync_every=32, sync_interval=1.0) -> None:
+        self.path = path
+        self.offset_path = path + ".offset"
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+
+        self._lock = threading.Lock()
+        self._file = open(path, "a+b")
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+        self.committed = self._load_checkpoint()
+        self.size = self._recover()
+
+        REGISTRY.gauge("spool_bytes_pending", "Spooled bytes not yet written to the database",
+                       function=lambda: self.size - self.committed)
+
+    def _load_checkpoint(self):
+        try:
+            with open(self.offset_path) as f:
+                return int(f.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def _recover(self):
+        size = os.fstat(self._file.fileno()).st_size
+        if self.committed > size:
+            logger.warning("spool checkpoint %d is past the end of %s, replaying from the start",
+                           self.committed, self.path)
+            self.committed = 0
+        end = self.committed
+        while True:
+            records, next_end = self._scan(end, _READ_CHUNK, size)
+            if not records:
+                break
+            end = next_end
+        if end < size:
+            logger.warning("dropping %d bytes of torn records from the end of %s", size - end, self.path)
+            self._file.truncate(end)
+            os.fsync(self._file.fileno())
+        return end
+
+    def _scan(self, offset, max_records, size):
+        """Valid records from offset up to size, stops at the first bad one."""
+        records = []
+        fd = self._file.fileno()
+        buffer = b""
+        buffer_offset = offset
+        while len(records) < max_records and offset < size:
+            start = offset - buffer_offset
+            if len(buffer) - start < _RECORD_HEADER.size + _MAX_RECORD:
+                buffer = buffer[start:] + os.pread(fd, _READ_CHUNK, buffer_offset + len(buffer))
+                buffer_offset = offset
+                start = 0
+            if len(buffer) - start < _RECORD_HEADER.size:
+                break
+            length, crc = _RECORD_HEADER.unpack_from(buffer, start)
+            body_start = start + _RECORD_HEADER.size
+            body = buffer[body_start:body_start + length]
+            if length < _RECORD_META.size or length > _MAX_RECORD or len(body) < length or zlib.crc32(body) != crc:
+                break
+            records.append(unpack_record(body))
+            offset += _RECORD_HEADER.size + length
+        return records, offset
+
+    def append(self, payload):
+        record = pack_record(payload)
+        with self._lock:
+            self._file.write(record)
+            self.size += len(record)
+            self._unsynced += 1
+            if self._unsynced >= self.sync_every or time.monotonic() - self._last_sync >= self.sync_interval:
+                self._sync()
+
+    def sync(self):
+        with self._lock:
+            self._sync()
+
+    def _sync(self):
+        self._file.flush()
+        if self._unsynced:
+            os.fsync(self._file.fileno())
+            self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def __len__(self):
+        return self.size - self.committed
+
+    def read(self, max_records):
+        """
+        :return: (payloads, end) for up to max_records uncommitted packets,
+                 pass end to commit() once they are in the database
+        """
+        with self._lock:
+            self._sync()
+            return self._scan(self.committed, max_records, self.size)
+
+    def commit(self, end):
+        with self._lock:
+            if end >= self.size:
+                # fully drained, start the file over so it does not grow forever
+                self._file.truncate(0)
+                os.fsync(self._file.fileno())
+                self.size = 0
+                end = 0
+            self._write_checkpoint(end)
+            self.committed = end
+
+    def _write_checkpoint(self, end):
+        with open(self.offset_path + ".tmp", "w") as f:
+            f.write(str(end))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.offset_path + ".tmp", self.offset_path)
+
+    def close(self):
+        with self._lock:
+            self._sync()
+            self._file.close()
+
+
+class SpoolReplayer:
+    """Drains a Spool into the database in bulk from a background thread.
+
+    Records are decoded, grouped with database.make_row and written with
+    database.write_rows, batch_size at a time. The spool is only committed
+    after the database accepted the batch, so a failed write is retried
+    every retry_interval seconds and nothing is dropped while the database
+    is down. A crash between the write and the commit replays that batch,
+    delivery is at least once. While paused it empties the spool and then
+    sleeps until resume() instead of polling every interval.
+    """
+
+    def __init__(self, spool, database, batch_size=500, interval=1.0, retry_interval=5.0) -> None:
+        self.spool = spool
+        self.database = database
+        self.batch_size = batch_size
+        self.interval = interval
+        self.retry_interval = retry_interval
+
+        self._stop = threading.Event()
+        self._resumed = threading.Event()
+        self._resumed.set()
+        # cuts a wait short on pause(), resume() and stop()
+        self._wake = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="spool-replayer", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                count = self.drain_once()
+            except Exception as e:
+                logger.error("could not replay spool, retrying in %ss: %s", self.retry_interval, e)
+                self._wait(self.retry_interval)
+                continue
+            if count < self.batch_size:
+                # the spool is empty, paused waits for resume() with nothing left to write
+                self._wait(self.interval if self._resumed.is_set() else None)
+
+    def _wait(self, timeout):
+        self._wake.wait(timeout)
+        self._wake.clear()
+
+    def drain_once(self):
+        """Write one batch to the database, returns the number of records replayed."""
+        payloads, end = self.spool.read(self.batch_size)
+        if not payloads:
+            return 0
+        batch = {}
+        for payload in payloads:
+            res = unpack_message(payload)
+            if res is None:
+                continue
+            row = self.database.make_row(*res, payload.received_at, payload.rssi, payload.snr,
+                                          sequence_count=unpack_header(payload)[2])
+            if row is not None:
+                table, values = row
+                batch.setdefault(table, []).append(values)
+        if batch:
+            self.database.write_rows(batch)
+        self.spool.commit(end)
+        return len(payloads)
+
+    def pause(self):
+        """Stop polling the spool once it is empty, e.g. between passes."""
+        self._resumed.clear()
+        self._wake.set()
+
+    def resume(self):
+        self._resumed.set()
+        self._wake.set()
+
+    def stop(self):
+        """Stop the thread and make one last attempt to empty the spool."""
+        self._stop.set()
+        self._wake.set()
+        self._thread.join()
+        try:
+            while self.drain_once():
+                pass
+        except Exception as e:
+            logger.error("%d spooled bytes left for the next run: %s", len(self.spool), e)
@@ -0,0 +1,359 @@
+import math
+import queue
+import random
+import threading
+import time
+
+from lib.constants import Definitions
+
+# DIO0 source for each value of RegDioMapping1 bits 7-6 in LoRa mode
+_DIO0_SOURCES = (Definitions.RX_DONE, Definitions.TX_DONE, Definitions.CAD_DONE, 0)
+
+_MODE_MASK = 0x07
+
+
+def radiohead_packet(message, header_to=Definitions.BROADCAST_ADDRESS, header_from=1, header_id=0, header_flags=0):
+    """Frame a message with the 4 byte RadioHead header."""
+    return bytes([header_to, header_from, header_id, header_flags]) + bytes(message)
+
+
+class SimPin:
+    """Stands in for the gpiozero Button wired to DIO0."""
+
+    def __init__(self) -> None:
+        self.when_pressed = None
+        self.is_pressed = False
+
+    @property
+    def value(self):
+        return int(self.is_pressed)
+
+    def close(self):
+        self.when_pressed = None
+
+
+class SimResetPin:
+    """Stands in for the digitalio reset line passed to RFM9x."""
+
+    def __init__(self, chip) -> None:
+        self.chip = chip
+
+    def switch_to_output(self, value=False):
+        if not value:
+            self.chip.reset()
+
+    def switch_to_input(self, pull=None):
+        pass
+
+
+class SimSPIDevice:
+    """adafruit_bus_device.spi_device.SPIDevice interface over an SX127xSim, for RFM9x."""
+
+    def __init__(self, chip) -> None:
+        self.chip = chip
+        self._address = None
+
+    def __enter__(self):
+        self._address = None
+        return self
+
+    def __exit__(self, *exc):
+        self.chip.transaction_count += 1
+        return False
+
+    def write(self, buf, *, start=0, end=None):
+        data = bytes(buf[start:end])
+        if self._address is None:
+            self._address, data = data[0], data[1:]
+        if data:
+            self.chip.transfer(self._address | 0x80, data)
+            self._address += 0 if self._address & 0x7f == Definitions.REG_00_FIFO else len(data)
+
+    def readinto(self, buf, *, start=0, end=None):
+        end = len(buf) if end is None else end
+        buf[start:end] = self.chip.transfer(self._address & 0x7f, bytes(end - start))
+
+
+class SX127xSim:
+    """In-process emulation of the SX127x LoRa register file and FIFO.
+
+    Implements the spidev SpiDev interface (open/xfer/close) used by LoRa,
+    and through SimSPIDevice/SimResetPin the interface used by RFM9x, so
+    the receive path can be exercised without hardware. Register bursts
+    auto-increment except on the FIFO register, IRQ flags clear on write,
+    and DIO0 raises dio0.when_pressed on its own thread on every rising
+    edge of the mapped IRQ flag, like the gpiozero callback thread.
+
+    Packets are delivered with inject() or replay(). A transmitted packet
+    raises TxDone after tx_time seconds and is injected into the linked
+    peer (see link()), dropped with probability peer_loss.
+    """
+
+    def __init__(self, tx_time=0.005, cad_time=0.001, channel_active=False, seed=None) -> None:
+        self.tx_time = tx_time
+        self.cad_time = cad_time
+        self.channel_active = channel_active
+
+        self.peer = None
+        self.peer_loss = 0.0
+        self._rng = random.Random(seed)
+
+        self.dio0 = SimPin()
+        self.max_speed_hz = 0
+        self.mode = 0
+
+        self.transaction_count = 0
+        self.received_count = 0
+        self.missed_count = 0
+        self.transmitted_count = 0
+
+        self._lock = threading.RLock()
+        self._edges = queue.Queue()
+        self._dispatcher = threading.Thread(target=self._dispatch, name="sx127x-dio0", daemon=True)
+        self._dispatcher.start()
+
+        self.reset()
+
+    # spidev interface
+
+    def open(self, bus, device):
+        pass
+
+    def close(self):
+        pass
+
+    def xfer(self, data):
+        self.transaction_count += 1
+        return [0] + list(self.transfer(data[0], bytes(data[1:])))
+
+    xfer2 = xfer
+
+    # chip
+
+    def reset(self):
+        with self._lock:
+            self.registers = bytearray(0x80)
+            self.fifo = bytearray(256)
+            self.registers[Definitions.REG_01_OP_MODE] = 0x09  # FSK, low frequency, standby
+            self.registers[Definitions.REG_0E_FIFO_TX_BASE_ADDR] = 0x80
+            self.registers[Definitions.REG_42_VERSION] = 0x12
+            self.mode = Definitions.MODE_STDBY
+            self._rx_address = 0
+            self._update_dio0()
+
+    def transfer(self, command, data):
+        """One chip select cycle: command byte then data, returns the bytes read."""
+        address = command & 0x7f
+        step = 0 if address == Definitions.REG_00_FIFO else 1
+        out = bytearray(len(data))
+        with self._lock:
+            if command & 0x80:
+                for i, value in enumerate(data):
+                    self._write(address + i * step, value)
+            else:
+                for i in range(len(data)):
+                    out[i] = self._read(address + i * step)
+        return out
+
+    def _read(self, address):
+        if address == Definitions.REG_00_FIFO:
+            pointer = self.registers[Definitions.REG_0D_FIFO_ADDR_PTR]
+            self.registers[Definitions.REG_0D_FIFO_ADDR_PTR] = (pointer + 1) & 0xff
+            return self.fifo[pointer]
+        return self.registers[address & 0x7f]
+
+    def _write(self, address, value):
+        address &= 0x7f
+        if address == Definitions.REG_00_FIFO:
+            pointer = self.registers[Definitions.REG_0D_FIFO_ADDR_PTR]
+            self.fifo[pointer] = value
+            self.registers[Definitions.REG_0D_FIFO_ADDR_PTR] = (pointer + 1) & 0xff
+        elif address == Definitions.REG_12_IRQ_FLAGS:
+            self.registers[address] &= ~value & 0xff
+            self._update_dio0()
+        elif address == Definitions.REG_01_OP_MODE:
+            self._set_op_mode(value)
+        elif address == Definitions.REG_40_DIO_MAPPING1:
+            self.registers[address] = value
+            self._update_dio0()
+        elif address != Definitions.REG_42_VERSION:
+            self.registers[address] = value
+
+    def _set_op_mode(self, value):
+        current = self.registers[Definitions.REG_01_OP_MODE]
+        mode = value & _MODE_MASK
+        if mode != Definitions.MODE_SLEEP:
+            # LongRangeMode only changes on writes selecting sleep mode
+            value = (value & 0x7f) | (current & Definitions.LONG_RANGE_MODE)
+        self.registers[Definitions.REG_01_OP_MODE] = value
+        if mode == self.mode:
+            return
+        self.mode = mode
+
+        if mode == Definitions.MODE_RXCONTINUOUS:
+            self._rx_address = self.registers[Definitions.REG_0F_FIFO_RX_BASE_ADDR]
+        elif mode == Definitions.MODE_TX:
+            base = self.registers[Definitions.REG_0E_FIFO_TX_BASE_ADDR]
+            length = self.registers[Definitions.REG_22_PAYLOAD_LENGTH]
+            packet = bytes(self.fifo[(base + i) & 0xff] for i in range(length))
+            self._after(self.tx_time, self._tx_done, packet)
+        elif mode == Definitions.MODE_CAD:
+            self._after(self.cad_time, self._cad_done)
+
+    def _after(self, delay, function, *args):
+        timer = threading.Timer(delay, function, args)
+        timer.daemon = True
+        timer.start()
+
+    def _tx_done(self, packet):
+        with self._lock:
+            if self.mode != Definitions.MODE_TX:
+                return
+            self._enter_standby()
+            self.registers[Definitions.REG_12_IRQ_FLAGS] |= Definitions.TX_DONE
+            self.transmitted_count += 1
+            self._update_dio0()
+        peer = self.peer
+        if peer is not None and self._rng.random() >= self.peer_loss:
+            peer.inject(packet)
+
+    def _cad_done(self):
+        with self._lock:
+            if self.mode != Definitions.MODE_CAD:
+                return
+            self._enter_standby()
+            flags = Definitions.CAD_DONE
+            if self.channel_active:
+                flags |= Definitions.CAD_DETECTED
+            self.registers[Definitions.REG_12_IRQ_FLAGS] |= flags
+            self._update_dio0()
+
+    def _enter_standby(self):
+        self.mode = Definitions.MODE_STDBY
+        current = self.registers[Definitions.REG_01_OP_MODE]
+        self.registers[Definitions.REG_01_OP_MODE] = (current & ~_MODE_MASK) | Definitions.MODE_STDBY
+
+    def _update_dio0(self):
+        source = _DIO0_SOURCES[self.registers[Definitions.REG_40_DIO_MAPPING1] >> 6]
+        level = bool(self.registers[Definitions.REG_12_IRQ_FLAGS] & source)
+        if level and not self.dio0.is_pressed:
+            self._edges.put(time.monotonic())
+        self.dio0.is_pressed = level
+
+    def _dispatch(self):
+        while True:
+            self._edges.get()
+            callback = self.dio0.when_pressed
+            try:
+                if callback is not None:
+                    callback(self.dio0)
+            finally:
+                self._edges.task_done()
+
+    def wait_interrupts(self):
+        """Block until every DIO0 callback raised so far has returned."""
+        self._edges.join()
+
+    # packet sources
+
+    def inject(self, packet, snr=8.0, rssi=-80.0, crc_error=False):
+        """Receive a packet over the air, returns False if the chip was not listening."""
+        packet = bytes(packet)
+        with self._lock:
+            if self.mode != Definitions.MODE_RXCONTINUOUS:
+                self.missed_count += 1
+                return False
+            start = self._rx_address
+            for i, value in enumerate(packet):
+                self.fifo[(start + i) & 0xff] = value
+            self._rx_address = (start + len(packet)) & 0xff
+
+            self.registers[Definitions.REG_10_FIFO_RX_CURRENT_ADDR] = start
+            self.registers[Definitions.REG_13_RX_NB_BYTES] = len(packet)
+            self.registers[Definitions.REG_25_FIFO_RX_BYTE_ADDR] = self._rx_address
+            self.registers[Definitions.REG_19_PKT_SNR_VALUE] = int(round(snr * 4)) & 0xff
+            self.registers[Definitions.REG_1A_PKT_RSSI_VALUE] = min(max(int(round(rssi)) + self._rssi_offset(), 0), 255)
+
+            flags = Definitions.RX_DONE | Definitions.VALID_HEADER
+            if crc_error:
+                flags |= Definitions.PAYLOAD_CRC_ERROR
+            self.registers[Definitions.REG_12_IRQ_FLAGS] |= flags
+            self.received_count += 1
+            self._update_dio0()
+        return True
+
+    def modem_settings(self):
+        """(bandwidth in Hz, spreading factor) currently set in the modem config registers."""
+        bandwidth = Definitions.BANDWIDTHS[self.registers[Definitions.REG_1D_MODEM_CONFIG1] >> 4]
+        return bandwidth, self.registers[Definitions.REG_1E_MODEM_CONFIG2] >> 4
+
+    def inject_at_snr(self, packet, snr, rssi=-110.0, reference_bandwidth=125000):
+        """Receive a packet whose SNR is snr dB when measured in reference_bandwidth.
+
+        The SNR is rescaled to the configured bandwidth and compared with the
+        demodulator limit of the configured spreading factor. More than 1 dB
+        below it the packet is never seen, within 1 dB either side it arrives
+        with a CRC error with a probability falling from 1 to 0, above that it
+        is received normally. Returns False if the packet was lost.
+        """
+        bandwidth, spreading_factor = self.modem_settings()
+        snr += 10 * math.log10(reference_bandwidth / bandwidth)
+        headroom = snr - Definitions.DEMOD_SNR_LIMIT[spreading_factor]
+        if headroom < -1:
+            with self._lock:
+                self.missed_count += 1
+            return False
+        crc_error = headroom < 1 and self._rng.random() < (1 - headroom) / 2
+        return self.inject(packet, snr, rssi, crc_error)
+
+    def _rssi_offset(self):
+        frf = int.from_bytes(self.registers[Definitions.REG_06_FRF_MSB:Definitions.REG_08_FRF_LSB + 1], "big")
+        return 157 if frf * Definitions.FSTEP >= 779e6 else 164
+
+    def replay(self, trace, rate_hz=None, background=False):
+        """Inject a packet trace, rate_hz packets per second or as fast as possible.
+
+        Each trace entry is either packet bytes or a (packet, snr, rssi) tuple.
+        With background=True the replay runs on its own thread, which is returned.
+        """
+        if background:
+            thread = threading.Thread(target=self.replay, args=(trace, rate_hz), name="sx127x-replay", daemon=True)
+            thread.start()
+            return thread
+
+        next_time = time.monotonic()
+        for entry in trace:
+            if rate_hz:
+                next_time += 1 / rate_hz
+                delay = next_time - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            if isinstance(entry, tuple):
+                self.inject(*entry)
+            else:
+                self.inject(entry)
+
+
+def pass_snr_profile(duration, peak_snr=10.0, horizon_snr=-22.0):
+    """
+    :param duration: length of the pass in seconds
+    :param peak_snr: SNR in dB at the highest elevation, mid pass
+    :param horizon_snr: SNR in dB at acquisition and loss of signal
+    :return: function of seconds into the pass giving the SNR in a 125 kHz bandwidth
+
+    Synthetic SNR curve for an overhead pass, following the free space path
+    loss as the slant range shrinks towards the middle of the pass.
+    """
+    def snr(t):
+        # elevation rises from 0 to 90 degrees and back over the pass
+        elevation = math.pi / 2 * (1 - abs(2 * t / duration - 1))
+        # 0 at the horizon, 1 at zenith, shaped like the inverse slant range in dB
+        gain = math.log10(1 + 9 * math.sin(elevation))
+        return horizon_snr + (peak_snr - horizon_snr) * gain
+    return snr
+
+
+def link(a, b, loss=0.0):
+    """Connect two simulated chips so each receives what the other transmits."""
+    a.peer, b.peer = b, a
+    a.peer_loss = b.peer_loss = loss
@@ -1,31 +1,98 @@
-import signal
-import sys
+import logging
+import os
 
 from lib.argus_lora import LoRa, ModemConfig
-from lib.radio_utils import unpack_message
+from lib.capture import CaptureWriter
+from lib.dedup import DedupIndex
+from lib.file_transfer import FileReceiver
 from lib.radiohead import RadioHead
+from lib.metrics import start_http_server, start_snapshot_writer
+from lib.multi_radio import RadioGroup, SharedSpiBus
 from lib.mysql_server_db import Database
+from lib.pass_scheduler import PassScheduler, load_pass_windows
+from lib.spool import Spool, SpoolReplayer
 
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"),
+                    format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+logger = logging.getLogger(__name__)
 
-radio = LoRa(0, 19, 25, modem_config=ModemConfig.Bw125Cr45Sf128, acks=False, freq=433)
-radiohead = RadioHead(radio, 10)
+if os.environ.get("METRICS_PORT"):
+    start_http_server(int(os.environ["METRICS_PORT"]))
+if os.environ.get("METRICS_FILE"):
+    start_snapshot_writer(os.environ["METRICS_FILE"])
 
-database = Database()
 
+def make_radios(specs):
+    """
+    :param specs: "channel:interrupt:freq:modem_config" per radio, comma separated,
+                  e.g. "0:19:433:Bw125Cr45Sf128,1:26:433:Bw125Cr48Sf4096"
+    """
+    bus = SharedSpiBus()
+    radios = []
+    for spec in specs.split(","):
+        channel, interrupt, freq, modem_config = spec.split(":")
+        radios.append(LoRa(int(channel), int(interrupt), 25, modem_config=ModemConfig[modem_config], acks=False,
+                           freq=float(freq), spi=bus.device()))
+    return RadioGroup(radios)
 
-def hard_exit(radio, signum, fram):
-    radio.close()
-    database.client.close()
-    sys.exit(0)
 
+# listen on several chip selects at once when LORA_RADIOS is given
+if os.environ.get("LORA_RADIOS"):
+    radio = make_radios(os.environ["LORA_RADIOS"])
+else:
+    radio = LoRa(0, 19, 25, modem_config=ModemConfig.Bw125Cr45Sf128, acks=False, freq=433)
+
+# receive downlinked images into a directory, answering with NACKs needs a single LoRa
+if os.environ.get("FILE_DOWNLINK_DIR") and isinstance(radio, LoRa):
+    file_receiver = FileReceiver(os.environ["FILE_DOWNLINK_DIR"], radio)
+else:
+    file_receiver = None
+
+# keep the raw frames as well when a capture file is given
+capture = CaptureWriter(os.environ["CAPTURE_PATH"]) if os.environ.get("CAPTURE_PATH") else None
+radiohead = RadioHead(radio, 10, capture=capture)
+
+# every row reaches the database through the spool replayer, no batch writer needed
+database = Database(batch_size=None)
+
+# packets hit the disk first, the replayer moves them into the database
+spool = Spool(os.environ.get("SPOOL_PATH", "heartbeats.spool"))
+replayer = SpoolReplayer(spool, database)
+# retransmitted heartbeats are dropped here instead of costing a database round trip
+dedup = DedupIndex()
+
+# only listen during predicted passes when a pass window file is given
+if os.environ.get("PASS_WINDOWS"):
+    receiver = PassScheduler(radiohead, load_pass_windows(os.environ["PASS_WINDOWS"]), replayer)
+else:
+    receiver = radiohead
+
+
+def shutdown():
+    if file_receiver is not None:
+        file_receiver.close()
+    radio.close()
+    if capture is not None:
+        capture.close()
+    replayer.stop()
+    spool.close()
+    database.close()
 
-signal.signal(signal.SIGINT, lambda signum, frame: hard_exit(radio, signum, frame))
 
-while True:
-    print("receiving...")
-    msg = radiohead.receive_message()
-    if msg is not None:
-        res = unpack_message(msg)
-        if res is not None:
-            id, time, data = res
-            database.upload_data(id, time, data)
+# Ctrl-C raises KeyboardInterrupt wherever the loop is, cleanup runs once it has unwound and released its locks
+try:
+    while True:
+        logger.debug("receiving...")
+        # wake up for the next NACK timeout while an image is coming in, not after the full receive timeout
+        timeout = file_receiver.poll_timeout() if file_receiver is not None else None
+        msg = receiver.receive_message(timeout)
+        if file_receiver is not None:
+            if msg is not None and file_receiver.handle(msg):
+                continue
+            file_receiver.poll()
+        if msg is not None and dedup.add_message(msg):
+            spool.append(msg)
+except KeyboardInterrupt:
+    logger.info("interrupted, shutting down")
+finally:
+    shutdown()
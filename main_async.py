@@ -0,0 +1,29 @@
+import argparse
+import asyncio
+import logging
+import os
+
+from lib.async_station import AsyncGroundStation
+from lib.mysql_server_db import Database
+
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"),
+                    format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+parser = argparse.ArgumentParser(description="asyncio ground station receive loop")
+parser.add_argument("--simulate", type=float, metavar="RATE",
+                    help="replace the radio with a simulated one sending RATE heartbeats per second")
+args = parser.parse_args()
+
+if args.simulate:
+    from lib.sim_radio import SimulatedRadio
+    radio = SimulatedRadio(args.simulate)
+    rx_ctrl = None
+else:
+    from gpiozero import LED
+    from lib.argus_lora import LoRa, ModemConfig
+    radio = LoRa(0, 19, 25, modem_config=ModemConfig.Bw125Cr45Sf128, acks=False, freq=433)
+    rx_ctrl = LED(22)
+
+database = Database()
+
+asyncio.run(AsyncGroundStation(radio, database, rx_ctrl).run())
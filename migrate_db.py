@@ -0,0 +1,33 @@
+import argparse
+import logging
+import os
+
+from lib.migration import add_partitions, drop_old_table, migrate_table
+from lib.mysql_server_db import COLUMNS, Database
+
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"),
+                    format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+
+def year_month(text):
+    year, month = text.split("-")
+    return int(year), int(month)
+
+
+parser = argparse.ArgumentParser(description="move heartbeat tables to the partitioned schema in db_setup.sql")
+parser.add_argument("--tables", nargs="+", choices=list(COLUMNS), default=list(COLUMNS))
+parser.add_argument("--chunk-size", type=int, default=10000, help="rows copied per transaction")
+parser.add_argument("--drop-old", action="store_true", help="drop the <table>_old copies once migrated")
+parser.add_argument("--partitions-through", type=year_month, metavar="YYYY-MM",
+                    help="only add monthly partitions up to this month, run before pmax starts filling")
+args = parser.parse_args()
+
+database = Database(batch_size=None)
+for table in args.tables:
+    if args.partitions_through:
+        add_partitions(database.client, table, args.partitions_through)
+        continue
+    migrate_table(database.client, table, args.chunk_size)
+    if args.drop_old:
+        drop_old_table(database.client, table)
+database.close()
@@ -0,0 +1,28 @@
+import argparse
+import logging
+import os
+import time
+
+from lib.capture import replay_captures
+
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"),
+                    format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+logger = logging.getLogger(__name__)
+
+parser = argparse.ArgumentParser(description="replay raw packet captures into the database")
+parser.add_argument("captures", nargs="+", help="capture files written with CAPTURE_PATH, replayed in order")
+parser.add_argument("--mongo", action="store_true", help="write to MongoDB instead of MySQL")
+parser.add_argument("--batch-size", type=int, default=500, help="rows per database write")
+args = parser.parse_args()
+
+if args.mongo:
+    from lib.mondo_db import Database
+else:
+    from lib.mysql_server_db import Database
+
+database = Database(batch_size=None)
+start = time.perf_counter()
+count = replay_captures(args.captures, database, args.batch_size)
+elapsed = time.perf_counter() - start
+logger.info("replayed %d frames in %.2fs (%.0f frames/s)", count, elapsed, count / elapsed if elapsed else 0)
+database.close()
@@ -0,0 +1,68 @@
+"""Crash recovery and checksums of capture files.
+
+    python -m pytest -q tests
+"""
+import os
+import random
+
+from lib.argus_lora import Payload
+from lib.capture import CaptureReader, CaptureWriter
+from lib.sim_radio import random_heartbeat
+
+
+def random_payloads(count, seed=0):
+    rng = random.Random(seed)
+    return [Payload(random_heartbeat(i, rng), 25, 1, i & 0xff, 0, -90.0, 7.5, 1000.0 + i) for i in range(count)]
+
+
+def write_capture(path, payloads):
+    writer = CaptureWriter(path)
+    for payload in payloads:
+        writer.write(payload)
+    writer.close()
+
+
+def read_messages(path):
+    with CaptureReader(path) as reader:
+        return [bytes(payload.message) for payload in reader]
+
+
+def test_torn_tail_is_dropped_on_reopen(tmp_path):
+    path = str(tmp_path / "pass.cap")
+    payloads = random_payloads(5)
+    write_capture(path, payloads)
+    size = os.path.getsize(path)
+
+    # power cut halfway through writing the next frame
+    write_capture(path, random_payloads(1, seed=1))
+    with open(path, "r+b") as f:
+        f.truncate(os.path.getsize(path) - 3)
+
+    writer = CaptureWriter(path)
+    assert os.path.getsize(path) == size
+    # frames continue after the cut instead of after the garbage
+    writer.write(payloads[0])
+    writer.close()
+    assert read_messages(path) == [payload.message for payload in payloads + payloads[:1]]
+
+
+def test_corrupt_frame_ends_the_capture(tmp_path):
+    path = str(tmp_path / "pass.cap")
+    payloads = random_payloads(5)
+    write_capture(path, payloads[:3])
+    good = os.path.getsize(path)
+    write_capture(path, payloads[3:])
+
+    # flip a payload byte of the fourth frame, its length still fits the file
+    with open(path, "r+b") as f:
+        f.seek(good + 30)
+        byte = f.read(1)
+        f.seek(good + 30)
+        f.write(bytes([byte[0] ^ 0xff]))
+
+    assert read_messages(path) == [payload.message for payload in payloads[:3]]
+    with CaptureReader(path) as reader:
+        list(reader)
+        assert reader.end == good
+    CaptureWriter(path).close()
+    assert os.path.getsize(path) == good
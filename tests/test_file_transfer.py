@@ -0,0 +1,50 @@
+"""Transfer bitmap persistence and limits.
+
+    python -m pytest -q tests
+"""
+import zlib
+
+import pytest
+
+from lib.file_transfer import MAX_CHUNKS, Transfer
+
+
+def make_image(size=1000):
+    return bytes(i * 31 & 0xff for i in range(size))
+
+
+def saved_bits(state_path):
+    """Chunks marked received in the state file of a 10 chunk image."""
+    with open(state_path, "rb") as f:
+        bitmap = f.read()[-2:]
+    # the 6 padding bits after the last chunk are always set
+    return sum(bin(byte).count("1") for byte in bitmap) - 6
+
+
+def test_bitmap_reaches_disk_only_on_flush(tmp_path):
+    image = make_image()
+    crc = zlib.crc32(image)
+    transfer = Transfer(str(tmp_path), 7, len(image), 100, crc)
+    for index in (0, 3, 9):
+        assert transfer.write_chunk(index, image[index * 100:(index + 1) * 100])
+    # a crash now loses the bits, never a bit without its chunk
+    assert saved_bits(transfer.state_path) == 0
+
+    transfer.flush()
+    assert saved_bits(transfer.state_path) == 3
+    transfer.close()
+
+    resumed = Transfer(str(tmp_path), 7, len(image), 100, crc)
+    assert [resumed.has_chunk(index) for index in range(10)] == [i in (0, 3, 9) for i in range(10)]
+    for index in range(10):
+        if not resumed.has_chunk(index):
+            resumed.write_chunk(index, image[index * 100:(index + 1) * 100])
+    assert resumed.complete
+    with open(resumed.finish(), "rb") as f:
+        assert f.read() == image
+
+
+def test_too_many_chunks_is_rejected(tmp_path):
+    Transfer(str(tmp_path), 1, MAX_CHUNKS * 10, 10, 0).close()
+    with pytest.raises(ValueError):
+        Transfer(str(tmp_path), 2, MAX_CHUNKS * 10 + 1, 10, 0)
@@ -0,0 +1,82 @@
+"""RadioGroup with two emulated radios on one shared SPI bus.
+
+    python -m pytest -q tests
+"""
+import threading
+import time
+
+from lib.argus_lora import LoRa
+from lib.metrics import REGISTRY
+from lib.multi_radio import RadioGroup, SharedSpiBus
+from lib.sim_radio import random_heartbeat
+from lib.sx127x_sim import SX127xSim, radiohead_packet
+
+
+class BusMonitor:
+    """Wraps the chips' transfers and records how many ran at the same time."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.active = 0
+        self.max_active = 0
+        self.transfers = 0
+
+    def wrap(self, chip):
+        def xfer(data, transfer=chip.xfer):
+            with self._lock:
+                self.active += 1
+                self.transfers += 1
+                self.max_active = max(self.max_active, self.active)
+            try:
+                # widen the window another thread's transfer could land in
+                time.sleep(0.0001)
+                return transfer(data)
+            finally:
+                with self._lock:
+                    self.active -= 1
+
+        chip.xfer = chip.xfer2 = xfer
+
+
+def received_count(channel):
+    # the group's per radio counter, the registry hands back the existing one
+    return REGISTRY.counter("radio_group_packets_total", labels={"radio": str(channel)}).value
+
+
+def test_two_radios_on_a_shared_bus():
+    bus = SharedSpiBus()
+    monitor = BusMonitor()
+    chips = [SX127xSim(), SX127xSim()]
+    for chip in chips:
+        monitor.wrap(chip)
+    radios = [LoRa(channel, None, 25, freq=freq, spi=bus.device(chip), irq=chip.dio0)
+              for channel, freq, chip in ((0, 433, chips[0]), (1, 435, chips[1]))]
+    group = RadioGroup(radios)
+    received = []
+    group.on_recv = received.append
+    before = [received_count(radio.channel) for radio in radios]
+    group.set_mode_rx()
+
+    counts = (40, 25)
+
+    def feed(chip, count, first):
+        for i in range(count):
+            chip.inject(radiohead_packet(random_heartbeat(first + i), header_to=25))
+            # the next packet would overwrite this one in the FIFO before it is read
+            chip.wait_interrupts()
+
+    feeders = [threading.Thread(target=feed, args=(chip, count, first))
+               for chip, count, first in zip(chips, counts, (0, 1000))]
+    for feeder in feeders:
+        feeder.start()
+    for feeder in feeders:
+        feeder.join()
+
+    assert len(received) == sum(counts)
+    assert sorted(payload.message[1] << 8 | payload.message[2] for payload in received) == \
+        sorted(list(range(40)) + list(range(1000, 1025)))
+    assert [received_count(radio.channel) - start for radio, start in zip(radios, before)] == list(counts)
+    assert [chip.received_count for chip in chips] == list(counts)
+    assert monitor.transfers > sum(counts)
+    assert monitor.max_active == 1
+    group.close()
@@ -0,0 +1,104 @@
+"""PassScheduler window transitions on a simulated clock.
+
+    python -m pytest -q tests
+"""
+from unittest.mock import MagicMock
+
+from lib.pass_scheduler import PassScheduler, PassWindow, load_pass_windows
+from lib.sim_radio import SimulatedClock
+
+
+class FakeReplayer:
+    """Records pause() and resume() in order, stands in for SpoolReplayer."""
+
+    def __init__(self) -> None:
+        self.calls = []
+
+    def pause(self):
+        self.calls.append("pause")
+
+    def resume(self):
+        self.calls.append("resume")
+
+
+def make_scheduler(windows, start=0.0, margin=60, idle_sleep=600):
+    clock = SimulatedClock(start)
+    radiohead = MagicMock()
+    radiohead.receive_timeout = 10
+
+    def receive_message(timeout):
+        # nothing heard, the radio listens for the whole timeout
+        clock.sleep(timeout)
+        return None
+
+    radiohead.receive_message.side_effect = receive_message
+    replayer = FakeReplayer()
+    scheduler = PassScheduler(radiohead, windows, replayer, margin=margin, idle_sleep=idle_sleep,
+                              clock=clock.time, sleep=clock.sleep)
+    return scheduler, clock, radiohead, replayer
+
+
+def run_until(scheduler, clock, end):
+    while clock.time() < end:
+        scheduler.receive_message()
+
+
+def test_pauses_between_passes_and_resumes_inside():
+    windows = [PassWindow(1000, 1605), PassWindow(7000, 7500)]
+    scheduler, clock, radiohead, replayer = make_scheduler(windows)
+
+    scheduler.receive_message()
+    # starts outside a window: the radio sleeps and the replayer pauses until the first window opens
+    assert scheduler.in_pass is False
+    assert replayer.calls == ["pause"]
+    assert radiohead.radio.sleep.call_count == 1
+    assert clock.time() == 600
+
+    run_until(scheduler, clock, 1000 - 60)
+    assert clock.time() == 940
+    scheduler.receive_message()
+    assert scheduler.in_pass is True
+    assert replayer.calls == ["pause", "resume"]
+
+    run_until(scheduler, clock, 1605 + 60)
+    assert clock.time() == 1665
+    # the last receive was cut short at the end of the window plus margin
+    assert radiohead.receive_message.call_args.args == (5,)
+    scheduler.receive_message()
+    assert scheduler.in_pass is False
+    assert replayer.calls == ["pause", "resume", "pause"]
+    assert radiohead.radio.sleep.call_count == 2
+
+    run_until(scheduler, clock, 7500 + 60 + 1)
+    assert replayer.calls == ["pause", "resume", "pause", "resume", "pause"]
+    assert radiohead.radio.sleep.call_count == 3
+
+
+def test_no_receive_outside_windows():
+    scheduler, clock, radiohead, replayer = make_scheduler([PassWindow(5000, 5100)], idle_sleep=600)
+    sleeps = []
+    while clock.time() < 5000 - 60:
+        before = clock.time()
+        scheduler.receive_message()
+        sleeps.append(clock.time() - before)
+    # idle_sleep caps every sleep, the last one ends right at the margin
+    assert max(sleeps) == 600
+    assert clock.time() == 4940
+    radiohead.receive_message.assert_not_called()
+    assert replayer.calls == ["pause"]
+
+
+def test_after_last_window_sleeps_idle():
+    scheduler, clock, radiohead, replayer = make_scheduler([PassWindow(0, 100)], start=1000, idle_sleep=300)
+    for _ in range(3):
+        scheduler.receive_message()
+    assert clock.time() == 1900
+    radiohead.receive_message.assert_not_called()
+    # pause once, not on every idle call
+    assert replayer.calls == ["pause"]
+
+
+def test_load_pass_windows(tmp_path):
+    path = tmp_path / "passes.txt"
+    path.write_text("# start end\n7000,7500\n\n1000 1600  # first pass\n")
+    assert load_pass_windows(str(path)) == [PassWindow(1000, 1600), PassWindow(7000, 7500)]
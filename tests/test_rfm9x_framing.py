@@ -0,0 +1,99 @@
+"""RFM9x.receive_all framing against a naive byte by byte parser.
+
+    python -m pytest -q tests
+"""
+import random
+
+from lib.rfm9x import RFM9x, packet_starts
+from lib.sx127x_sim import SimResetPin, SimSPIDevice, SX127xSim, radiohead_packet
+
+IDS = RFM9x.valid_ids
+
+
+def naive_starts(buf, end, ids):
+    """The per byte membership scan packet_starts replaced."""
+    starts = []
+    i = 0
+    while i + 1 < end:
+        if buf[i] in ids and buf[i + 1] in ids and buf[i] != buf[i + 1]:
+            starts.append(i)
+            i += 4
+        else:
+            i += 1
+    return starts
+
+
+def make_radio():
+    chip = SX127xSim()
+    radio = RFM9x(None, None, SimResetPin(chip), 433, device=SimSPIDevice(chip))
+    radio.listen()
+    return chip, radio
+
+
+def random_frame(rng, garbage):
+    """A RadioHead frame between two valid ids. garbage payloads are drawn from the ids,
+    so they hold what looks like more headers, other payloads never contain an id."""
+    to, source = rng.sample(IDS, 2)
+    alphabet = IDS if garbage else [i for i in range(256) if i not in IDS]
+    payload = bytes(rng.choice(alphabet) for _ in range(rng.randrange(1, 40)))
+    return radiohead_packet(payload, header_to=to, header_from=source)
+
+
+def receive_all(radio):
+    return [bytes(packet) for packet in radio.receive_all()]
+
+
+def test_packet_starts_matches_naive_scan():
+    rng = random.Random(0)
+    for _ in range(2000):
+        # bytes mostly from the ids so header-like pairs, repeats and overlaps are common
+        buf = bytearray(rng.choice(IDS) if rng.random() < 0.6 else rng.randrange(256) for _ in range(256))
+        end = rng.randrange(257)
+        ids = tuple(rng.sample(IDS, rng.randrange(1, len(IDS) + 1)))
+        assert packet_starts(buf, end, ids) == naive_starts(buf, end, ids)
+
+
+def test_marked_packets_are_sliced_exactly():
+    rng = random.Random(1)
+    # receive_all listens again, the next frames start over at the bottom of the FIFO
+    chip, radio = make_radio()
+    for _ in range(100):
+        frames = []
+        while sum(map(len, frames)) < 200:
+            frames.append(random_frame(rng, garbage=True))
+            chip.inject(frames[-1])
+            radio.mark_packet()
+        assert receive_all(radio) == frames
+
+
+def test_unmarked_packets_match_naive_split():
+    rng = random.Random(2)
+    chip, radio = make_radio()
+    for _ in range(100):
+        frames = []
+        garbage = rng.random() < 0.5
+        while sum(map(len, frames)) < 200:
+            frames.append(random_frame(rng, garbage))
+            chip.inject(frames[-1])
+        fifo = b"".join(frames)
+        last = len(fifo) - len(frames[-1])
+        starts = naive_starts(fifo, last, IDS) + [last]
+        expected = [fifo[a:b] for a, b in zip(starts, starts[1:])] + [frames[-1]]
+        assert receive_all(radio) == expected
+        if not garbage:
+            # without header-like bytes inside the payloads the scan finds every frame
+            assert expected == frames
+
+
+def test_packet_wrapping_the_fifo_is_joined():
+    chip, radio = make_radio()
+    first = radiohead_packet(bytes(200), header_to=58, header_from=59)
+    wrapped = radiohead_packet(bytes(range(100)), header_to=58, header_from=60)
+    chip.inject(first)
+    chip.inject(wrapped)
+    assert receive_all(radio) == [wrapped]
+
+
+def test_empty_fifo_yields_nothing():
+    chip, radio = make_radio()
+    assert receive_all(radio) == []